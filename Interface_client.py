@@ -1,16 +1,33 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from tafahom_profilage import begin_profile
+
+# Profilage de cette exécution (outil de développement activé dans la barre latérale), démarré avant les autres imports
+begin_profile(get_script_run_ctx().session_id, st.session_state.get("profiler_enabled", False), "portail", __file__)
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import plotly.express as px
 import json
 import os
-import re
-from datetime import datetime
 import tempfile
 from PIL import Image
 from together import Together
 import os
 from dotenv import load_dotenv
+from tafahom_journal import export_events, list_segments, log_event, render_transcript
+from tafahom_llm import LLMQuotaError, LLMUnavailableError, chat_completion, take_last_call
+from tafahom_local import select_chat_client
+from tafahom_memoire import all_messages, discard_spilled, enforce_budget, ensure_loaded, format_size, memory_report, message_count, message_slice, per_session_budget, touch_session
+from tafahom_metriques import export as export_metrics
+from tafahom_profilage import end_profile, flame_graph_svg, folded, hotspots, profile_summary, reset_profiles, tag_profile
+from tafahom_modeles import Profile, extract_json, validated
+from tafahom_outbox import enqueue, job_status, service_status, start_worker
+from tafahom_questions import precompute_questions
+from tafahom_reception import announce_profile
+from tafahom_recherche import index_comments, index_turn
+from tafahom_stockage import atomic_write_json, new_conversation_id, profile_path, read_json
+from tafahom_traces import begin_run, end_run, span
 
 # Charger les variables d'environnement depuis le fichier .env
 load_dotenv()
@@ -19,6 +36,13 @@ load_dotenv()
 client = Together(api_key=os.getenv("TOGETHER_API_KEY")) # Remplacer par votre clé API
 MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
 
+# Client des échanges: modèle local sur CPU si TAFAHOM_CHAT_BACKEND=local (chargé une fois par processus),
+# sinon le modèle distant; la génération du profil utilise toujours le client distant
+chat_client, chat_backend = select_chat_client(client)
+
+# Traitement en arrière-plan des travaux mis en file pendant une panne du service (une fois par processus)
+start_worker(client)
+
 # Titre et description de l'application
 st.set_page_config(
     page_title="TAFAHOM - Portail Artiste",
@@ -32,13 +56,7 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 
 if "conversation_id" not in st.session_state:
-    st.session_state.conversation_id = datetime.now().strftime("%Y%m%d%H%M%S")
-
-if "context_file" not in st.session_state:
-    st.session_state.context_file = f"tafahom_portail_{st.session_state.conversation_id}.txt"
-    # Créer le fichier de contexte
-    with open(st.session_state.context_file, "w", encoding="utf-8") as f:
-        f.write("Conversation TAFAHOM-Portail - Artiste:\n\n")
+    st.session_state.conversation_id = new_conversation_id()
 
 if "questions_asked" not in st.session_state:
     st.session_state.questions_asked = []
@@ -61,6 +79,12 @@ if "profile_generated" not in st.session_state:
 if "export_format" not in st.session_state:
     st.session_state.export_format = "json"
 
+touch_session(st.session_state)
+
+# Span racine de cette exécution du script (les appels LLM, lectures JSON et accès fichiers y sont rattachés)
+begin_run(get_script_run_ctx().session_id, "portail", st.session_state.conversation_id, **{"tafahom.step": st.session_state.current_step})
+tag_profile(get_script_run_ctx().session_id, st.session_state.current_step)
+
 # Critères d'évaluation pour le profil basés sur la théorie du capital culturel et symbolique
 CRITERIA = [
     "Capital culturel incorporé",
@@ -89,10 +113,29 @@ QUESTIONS = [
     "Si demain une institution vous proposait un financement, que diriez-vous pour la convaincre que votre projet est recevable ?"
 ]
 
-# Fonction pour mettre à jour le fichier de contexte
-def update_context_file(role, content):
-    with open(st.session_state.context_file, "a", encoding="utf-8") as f:
-        f.write(f"{role}: {content}\n\n")
+# Nombre de messages récents affichés en entier dans la conversation
+CHAT_WINDOW = 6
+
+# Nombre de messages par page dans l'historique plus ancien
+HISTORY_PAGE_SIZE = 10
+
+# Fonction pour ajouter un tour au journal de la conversation (créé au premier tour seulement),
+# avec la latence et les tokens de l'appel LLM qui l'a produit
+def update_context_file(role, content, call=None):
+    call = call or {}
+    log_event(
+        st.session_state.conversation_id,
+        "message",
+        turn=message_count(st.session_state) - 1,
+        role=role,
+        content=content,
+        latency_s=call.get("latency_s"),
+        prompt_tokens=call.get("prompt_tokens"),
+        completion_tokens=call.get("completion_tokens")
+    )
+    
+    # Indexer le tour pour la recherche plein texte côté financier
+    index_turn(st.session_state.conversation_id, role, content)
 
 # Fonction pour générer un profil à partir de la conversation
 def generate_profile():
@@ -148,8 +191,8 @@ Attention: Ce score n'est pas uniquement économique, mais représente l'alignem
         # Préparer les messages pour l'API
         messages = [{"role": "system", "content": system_prompt}]
         
-        # Ajouter l'historique des messages
-        for msg in st.session_state.messages:
+        # Ajouter l'historique des messages (y compris les messages déchargés sur disque)
+        for msg in all_messages(st.session_state):
             role = "assistant" if msg["role"] == "assistant" else "user"
             messages.append({"role": role, "content": msg["content"]})
         
@@ -157,38 +200,34 @@ Attention: Ce score n'est pas uniquement économique, mais représente l'alignem
         messages.append({"role": "user", "content": "Maintenant, analyse notre conversation et génère le profil complet avec l'évaluation des 10 critères et le score IAS global comme demandé. Retourne uniquement le JSON structuré."})
         
         # Appeler l'API Together.ai
-        response = client.chat.completions.create(
+        response_text = chat_completion(
+            client,
+            "generate_profile",
+            messages,
+            conversation_id=st.session_state.conversation_id,
+            validate=lambda text: validated(Profile, extract_json(text)),
             model=MODEL,
-            messages=messages,
             temperature=0.3,
             max_tokens=2000,
             top_p=0.9
         )
         
-        response_text = response.choices[0].message.content
-        
-        # Extraire le JSON du texte de la réponse
-        json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            json_str = re.search(r'({.*})', response_text, re.DOTALL).group(1)
-        
-        # Nettoyer et parser le JSON
-        profile_data = json.loads(json_str)
-        
-        # Calculer le score IAS si non fourni
-        if "ias_score" not in profile_data["profile"]:
-            scores = [criterion["score"] for criterion in profile_data["profile"]["criteria"]]
-            profile_data["profile"]["ias_score"] = round(sum(scores) / len(scores) * 10)
+        # Extraire, parser et valider le JSON (le score IAS est calculé s'il n'est pas fourni)
+        profile_data = validated(Profile, extract_json(response_text))
         
         return profile_data
+    except (LLMUnavailableError, LLMQuotaError) as e:
+        # Service en panne ou quota épuisé: la génération est mise en file et le profil sera transmis automatiquement
+        enqueue("profile", st.session_state.conversation_id, messages, model=MODEL, temperature=0.3, max_tokens=2000, top_p=0.9)
+        st.warning(f"{e} Votre profil sera généré et transmis à TAFAHOM-Agent automatiquement dès le rétablissement du service.")
+        return None
     except Exception as e:
         st.error(f"Erreur lors de la génération du profil: {str(e)}")
         return None
 
 # Fonction pour obtenir la réponse du modèle LLM
-def get_llm_response(user_input, next_question=None):
+# (placeholder: emplacement où afficher la réponse au fil de la génération, avec le modèle local)
+def get_llm_response(user_input, next_question=None, placeholder=None):
     try:
         # Système prompt avec les instructions pour le chatbot
         system_message = {
@@ -237,8 +276,8 @@ Tu ne poses pas la même question deux fois et tu adaptes ton questionnement en
         # Préparer les messages pour l'API
         messages = [system_message]
         
-        # Ajouter l'historique des messages
-        for msg in st.session_state.messages:
+        # Ajouter l'historique des messages (y compris les messages déchargés sur disque)
+        for msg in all_messages(st.session_state):
             role = "assistant" if msg["role"] == "assistant" else "user"
             messages.append({"role": role, "content": msg["content"]})
         
@@ -249,17 +288,25 @@ Tu ne poses pas la même question deux fois et tu adaptes ton questionnement en
         if next_question:
             messages.append({"role": "system", "content": f"Après avoir répondu à l'utilisateur, pose-lui la question suivante: {next_question}"})
         
-        # Appeler l'API Together.ai
-        response = client.chat.completions.create(
+        # Affichage progressif avec le modèle local (la couverture ne concerne que le modèle distant)
+        on_token = None
+        if placeholder is not None and chat_client is not client:
+            on_token = lambda text: placeholder.markdown(text + "▌")
+        
+        # Appeler le modèle des échanges
+        response_text = chat_completion(
+            chat_client,
+            "get_llm_response",
+            messages,
+            conversation_id=st.session_state.conversation_id,
+            hedge=True,
+            on_token=on_token,
             model=MODEL,
-            messages=messages,
             temperature=0.7,
             max_tokens=800,
             top_p=0.9
         )
         
-        response_text = response.choices[0].message.content
-        
         # Vérifier si toutes les questions ont été posées
         if len(st.session_state.questions_asked) >= len(QUESTIONS) and "conversation_ended" not in st.session_state:
             st.session_state.conversation_ended = True
@@ -341,8 +388,23 @@ if st.session_state.current_step == "introduction":
 elif st.session_state.current_step == "conversation":
     st.markdown("### Conversation avec TAFAHOM-Portail")
     
-    # Affichage des messages précédents
-    for message in st.session_state.messages:
+    # Affichage des messages précédents: seuls les derniers sont rendus à chaque rerun,
+    # l'historique plus ancien n'est envoyé au navigateur que sur demande, page par page
+    # (les messages déchargés sur disque ne sont relus que pour la page d'historique affichée)
+    older_count = max(0, message_count(st.session_state) - CHAT_WINDOW)
+    recent_messages = st.session_state.messages[-CHAT_WINDOW:]
+    
+    if older_count:
+        if st.checkbox(f"Afficher l'historique ({older_count} messages plus anciens)", key="show_history"):
+            page_count = (older_count + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+            page = st.number_input("Page de l'historique", min_value=1, max_value=page_count, value=page_count, key="history_page")
+            start = (page - 1) * HISTORY_PAGE_SIZE
+            for message in message_slice(st.session_state, start, min(start + HISTORY_PAGE_SIZE, older_count)):
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
+            st.markdown("---")
+    
+    for message in recent_messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
     
@@ -364,17 +426,16 @@ elif st.session_state.current_step == "conversation":
                 next_question = QUESTIONS[next_index]
                 st.session_state.questions_asked.append(next_question)
             
-            # Obtenir la réponse du modèle LLM
-            with st.spinner("Je réfléchis à ma réponse..."):
-                response = get_llm_response(prompt, next_question)
-            
-            # Afficher la réponse
+            # Obtenir et afficher la réponse du modèle LLM (au fil de la génération avec le modèle local)
             with st.chat_message("assistant"):
-                st.markdown(response)
+                placeholder = st.empty()
+                with st.spinner("Je réfléchis à ma réponse..."):
+                    response = get_llm_response(prompt, next_question, placeholder)
+                placeholder.markdown(response)
             
             # Ajouter la réponse à l'historique
             st.session_state.messages.append({"role": "assistant", "content": response})
-            update_context_file("assistant", response)
+            update_context_file("assistant", response, call=take_last_call())
             
             # Vérifier si toutes les questions ont été posées
             if len(st.session_state.questions_asked) >= len(QUESTIONS):
@@ -382,19 +443,41 @@ elif st.session_state.current_step == "conversation":
                 st.rerun()
     else:
         # Si la conversation est terminée, afficher un bouton pour générer le profil
-        if not st.session_state.profile_generated:
+        queued_status = job_status("profile", st.session_state.conversation_id)
+        if not st.session_state.profile_generated and queued_status == "livre":
+            # Profil généré par la file d'attente après une panne: repris depuis le stockage
+            profile_data = read_json(profile_path(st.session_state.conversation_id))
+            st.session_state.profile_data = profile_data
+            st.session_state.ias_score = profile_data["profile"]["ias_score"]
+            st.session_state.profile_generated = True
+            st.session_state.current_step = "profile"
+            st.rerun()
+        elif not st.session_state.profile_generated and queued_status in ("en_attente", "en_cours"):
+            st.info("⏳ Votre profil est en file d'attente: il sera généré et transmis à TAFAHOM-Agent dès le rétablissement du service.")
+            if st.button("Vérifier l'avancement"):
+                st.rerun()
+        elif not st.session_state.profile_generated:
             st.success("✅ Nous avons couvert tous les aspects nécessaires pour comprendre votre projet. Merci pour vos réponses.")
             if st.button("Générer mon profil TAFAHOM"):
                 with st.spinner("Génération de votre profil symbolique en cours..."):
                     profile_data = generate_profile()
+                    call = take_last_call() or {}
                     
                     if profile_data:
+                        log_event(
+                            st.session_state.conversation_id,
+                            "profile_generated",
+                            ias_score=profile_data["profile"]["ias_score"],
+                            latency_s=call.get("latency_s"),
+                            prompt_tokens=call.get("prompt_tokens"),
+                            completion_tokens=call.get("completion_tokens")
+                        )
                         st.session_state.profile_data = profile_data
                         st.session_state.ias_score = profile_data["profile"]["ias_score"]
                         st.session_state.profile_generated = True
                         st.session_state.current_step = "profile"
                         st.rerun()
-                    else:
+                    elif job_status("profile", st.session_state.conversation_id) is None:
                         st.error("Impossible de générer le profil. Veuillez réessayer.")
         else:
             # Rediriger vers l'étape du profil
@@ -404,6 +487,8 @@ elif st.session_state.current_step == "conversation":
 elif st.session_state.current_step == "profile":
     st.markdown("### Votre Profil TAFAHOM")
     
+    ensure_loaded(st.session_state, "profile_data")
+    
     if st.session_state.profile_data:
         profile = st.session_state.profile_data["profile"]
         
@@ -507,30 +592,35 @@ elif st.session_state.current_step == "profile":
         
         if st.button("Transférer au TAFAHOM-Agent"):
             # Enregistrer le profil dans un fichier pour le TAFAHOM-Agent
-            export_file = f"tafahom_profil_{st.session_state.conversation_id}.json"
-            with open(export_file, "w", encoding="utf-8") as f:
-                json.dump(st.session_state.profile_data, f, ensure_ascii=False, indent=2)
+            # (écriture atomique: une réplique financière ne lit jamais un fichier à moitié écrit)
+            with span("file write profil"):
+                atomic_write_json(profile_path(st.session_state.conversation_id), st.session_state.profile_data)
+            index_comments(st.session_state.conversation_id, st.session_state.profile_data, kind="profil")
+            announce_profile(st.session_state.conversation_id, st.session_state.profile_data)
+            log_event(st.session_state.conversation_id, "profile_exported")
+            
+            # Préparer dès maintenant, en arrière-plan, les questions contextualisées du financier
+            precompute_questions(client, st.session_state.conversation_id, st.session_state.profile_data, MODEL)
             
-            st.success(f"✅ Profil enregistré et prêt à être transféré vers TAFAHOM-Agent.")
+            st.success(f"✅ Profil transféré: il apparaît dans la boîte de réception de TAFAHOM-Agent.")
             st.markdown(f"""
-            Pour transférer votre profil, veuillez copier votre identifiant de conversation:
+            Référence de votre dossier:
             ```
             {st.session_state.conversation_id}
             ```
-            Et le coller dans l'interface TAFAHOM-Agent.
             """)
         
         # Option pour recommencer
         if st.button("Commencer une nouvelle conversation"):
             # Réinitialiser l'état de la session
+            discard_spilled(st.session_state)
             for key in list(st.session_state.keys()):
                 if key != "export_format":
                     del st.session_state[key]
             
             # Réinitialiser les variables de session
             st.session_state.messages = []
-            st.session_state.conversation_id = datetime.now().strftime("%Y%m%d%H%M%S")
-            st.session_state.context_file = f"tafahom_portail_{st.session_state.conversation_id}.txt"
+            st.session_state.conversation_id = new_conversation_id()
             st.session_state.questions_asked = []
             st.session_state.current_step = "introduction"
             st.session_state.conversation_ended = False
@@ -538,10 +628,6 @@ elif st.session_state.current_step == "profile":
             st.session_state.profile_data = {}
             st.session_state.profile_generated = False
             
-            # Créer un nouveau fichier de contexte
-            with open(st.session_state.context_file, "w", encoding="utf-8") as f:
-                f.write("Conversation TAFAHOM-Portail - Artiste:\n\n")
-            
             st.rerun()
     else:
         st.error("Données de profil manquantes. Veuillez générer un profil.")
@@ -557,23 +643,73 @@ with st.sidebar:
     st.markdown(f"**ID de conversation**: `{st.session_state.conversation_id}`")
     st.markdown(f"**Étape actuelle**: `{st.session_state.current_step}`")
     st.markdown(f"**Questions posées**: `{len(st.session_state.questions_asked)}/{len(QUESTIONS)}`")
+    st.markdown(f"**Modèle des échanges**: `{chat_backend}`")
+    st.markdown(f"**Service de génération**: `{service_status(client)}`")
     
-    # Afficher le fichier de contexte
+    # Mémoire occupée par la session (les données froides sont déchargées sur disque au-delà du budget)
+    session_memory = memory_report(st.session_state)
+    st.markdown(f"**Mémoire de session**: `{format_size(sum(session_memory.values()))}` (budget `{format_size(per_session_budget())}`)")
+    if st.checkbox("Détail de la mémoire de session"):
+        st.dataframe(
+            pd.DataFrame(
+                [{"Clé": key, "Taille": format_size(size)} for key, size in sorted(session_memory.items(), key=lambda item: -item[1])]
+            ),
+            hide_index=True,
+        )
+    
+    # Afficher la transcription (reconstituée depuis le journal de la conversation)
     if st.checkbox("Afficher le fichier de contexte"):
-        if os.path.exists(st.session_state.context_file):
-            with open(st.session_state.context_file, "r", encoding="utf-8") as f:
-                st.text_area("Contenu du fichier", f.read(), height=300)
+        if list_segments(st.session_state.conversation_id):
+            st.text_area("Contenu du fichier", render_transcript(st.session_state.conversation_id), height=300)
     
-    # Télécharger le fichier de contexte
+    # Télécharger le journal de la conversation (un événement JSON par ligne)
     if st.button("Télécharger le fichier de contexte"):
-        if os.path.exists(st.session_state.context_file):
-            with open(st.session_state.context_file, "r", encoding="utf-8") as f:
-                st.download_button(
-                    label="Télécharger",
-                    data=f.read(),
-                    file_name=st.session_state.context_file,
-                    mime="text/plain"
-                )
+        if list_segments(st.session_state.conversation_id):
+            st.download_button(
+                label="Télécharger",
+                data=export_events(st.session_state.conversation_id),
+                file_name=f"tafahom_journal_{st.session_state.conversation_id}.jsonl",
+                mime="application/x-ndjson"
+            )
+    
+    # Profilage des exécutions du script (développeur): points chauds et flame graph par étape, cumulés sur les exécutions profilées
+    # (réglage conservé hors widget: une exécution interrompue par st.rerun avant la barre latérale ne le perd pas)
+    st.session_state.profiler_enabled = st.checkbox("Profiler les exécutions (développeur)", value=st.session_state.get("profiler_enabled", False))
+    if st.session_state.profiler_enabled:
+        summary = profile_summary("portail")
+        if summary:
+            st.dataframe(
+                pd.DataFrame([
+                    {"Étape": row["step"], "Exécutions": row["runs"], "Durée moyenne (ms)": round(row["mean_ms"]), "Échantillons": row["samples"]}
+                    for row in summary
+                ]),
+                hide_index=True,
+            )
+            profiled_step = st.selectbox("Étape profilée", ["toutes"] + [row["step"] for row in summary], key="profiled_step")
+            profiled_step = None if profiled_step == "toutes" else profiled_step
+            st.dataframe(
+                pd.DataFrame([
+                    {"Fonction / ligne": row["frame"], "Propre": f"{row['self']:.0%}", "Inclusive": f"{row['inclusive']:.0%}"}
+                    for row in hotspots("portail", profiled_step)
+                ]),
+                hide_index=True,
+            )
+            st.download_button(
+                label="Télécharger le flame graph (SVG)",
+                data=flame_graph_svg("portail", profiled_step),
+                file_name=f"tafahom_portail_{profiled_step or 'toutes'}.svg",
+                mime="image/svg+xml"
+            )
+            st.download_button(
+                label="Télécharger les piles (format replié)",
+                data=folded("portail", profiled_step),
+                file_name=f"tafahom_portail_{profiled_step or 'toutes'}.folded",
+                mime="text/plain"
+            )
+            if st.button("Réinitialiser le profilage"):
+                reset_profiles("portail")
+        else:
+            st.caption("Les prochaines exécutions du script seront profilées.")
     
     # À propos de TAFAHOM
     if st.checkbox("À propos de TAFAHOM"):
@@ -597,4 +733,16 @@ with st.sidebar:
         10. Continuité d'engagement
         
         L'Indice d'Alignement Symbolique (IAS) mesure la capacité du récit à être reçu par les institutions, tout en préservant l'authenticité du porteur.
-        """)
\ No newline at end of file
+        """)
+
+# Mesure de la mémoire de session et déchargement des données froides (anciens messages, profil hors de l'étape profil)
+enforce_budget(
+    st.session_state,
+    get_script_run_ctx().session_state,
+    cold_keys=[] if st.session_state.current_step == "profile" else ["profile_data"],
+    keep_messages=CHAT_WINDOW,
+    app_name="portail"
+)
+export_metrics("portail")
+end_run(get_script_run_ctx().session_id)
+end_profile(get_script_run_ctx().session_id)
@@ -1,13 +1,38 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from tafahom_profilage import begin_profile
+
+# Profilage de cette exécution (outil de développement activé dans la barre latérale), démarré avant les autres imports
+begin_profile(get_script_run_ctx().session_id, st.session_state.get("profiler_enabled", False), "agent", __file__)
+
 import pandas as pd
 import plotly.express as px
-import json
 import os
-import re
-from datetime import datetime
-import glob
+import time
+import uuid
+from datetime import datetime, timedelta
 from together import Together
 from dotenv import load_dotenv
+from streamlit.runtime import Runtime
+from tafahom_llm import LLMQuotaError, LLMUnavailableError, chat_completion
+from tafahom_memoire import discard_spilled, enforce_budget, ensure_loaded, format_size, memory_report, per_session_budget, touch_session
+from tafahom_cache import cache_report, cached_profile, get_backend
+from tafahom_export import FORMATS, export_to_file
+from tafahom_gabarits import cache_stats
+from tafahom_metriques import export as export_metrics
+from tafahom_profilage import end_profile, flame_graph_svg, folded, hotspots, profile_summary, reset_profiles, tag_profile
+from tafahom_modeles import EnrichedProfile, Evaluation, extract_json, validated
+from tafahom_outbox import enqueue, job_status, service_status, start_worker
+from tafahom_prompts import PromptPacker, pack_responses, prune_evaluation, prune_profile, savings_report, unpacked_responses
+from tafahom_questions import EVALUATION_CRITERIA, contextualize, default_questions, load_precomputed_questions, profile_questions, save_questions
+from tafahom_reception import POLL_INTERVAL, STATUS_LABELS, announce_profile, claim, complete, last_sequence, list_inbox, release, start_watcher, subscribe, unread_count, unsubscribe
+from tafahom_recherche import index_comments, search
+from tafahom_reevaluation import changed_criteria, reevaluate
+from tafahom_quotas import quota_status, quotas_enabled, status_line
+from tafahom_regles import record_screening, rules_evaluation, screen, screening_report
+from tafahom_similarite import similar_profiles
+from tafahom_stockage import atomic_write_json, enriched_profile_path, evaluation_path, read_json
+from tafahom_traces import begin_run, critical_path, end_run, span
 
 # Charger les variables d'environnement depuis le fichier .env
 load_dotenv()
@@ -16,6 +41,9 @@ load_dotenv()
 client = Together(api_key=os.getenv("TOGETHER_API_KEY"))
 MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
 
+# Taille maximale (octets) d'un export groupé proposé au téléchargement dans le navigateur
+EXPORT_DOWNLOAD_MAX_BYTES = int(os.getenv("TAFAHOM_EXPORT_DOWNLOAD_MAX_MB", "100")) * 1024 * 1024
+
 # Configuration de l'application
 st.set_page_config(
     page_title="TAFAHOM - Agent Financier",
@@ -39,141 +67,130 @@ if "financier_responses" not in st.session_state:
 if "evaluation_summary" not in st.session_state:
     st.session_state.evaluation_summary = None
 
+# Réponses du financier sur lesquelles porte l'évaluation affichée (base de la réévaluation incrémentale)
+if "evaluated_responses" not in st.session_state:
+    st.session_state.evaluated_responses = None
+
 if "contextualized_questions" not in st.session_state:
     st.session_state.contextualized_questions = None
 
-# Critères d'évaluation pour le financier
-EVALUATION_CRITERIA = [
-    "Capital culturel incorporé",
-    "Capital objectivé",
-    "Capital institutionnalisé", 
-    "Capital symbolique reconnu",
-    "Alignement narratif interprétatif",
-    "Ancrage territorial / communautaire",
-    "Capacité de projection identitaire",
-    "Soutien socio-culturel mobilisable",
-    "Usage social du projet artistique",
-    "Continuité d'engagement culturel"
-]
-
-# Questions de base (qui seront contextualisées)
-BASE_QUESTIONS = [
-    "En analysant le savoir-faire transmis, pensez-vous que ce capital culturel incorporé représente un atout économique viable?",
-    "Ces productions tangibles (œuvres, spectacles, enregistrements) vous semblent-elles suffisamment valorisables sur le marché?",
-    "Les reconnaissances formelles ou distinctions mentionnées constituent-elles des garanties crédibles pour une institution financière?",
-    "La notoriété et la réputation locale du porteur représentent-elles une forme de garantie morale pour un financement?",
-    "La cohérence du récit et la capacité du porteur à formuler son projet sont-elles suffisantes pour assurer sa viabilité?",
-    "L'ancrage territorial du porteur peut-il constituer un atout commercial et une garantie de stabilité pour ce projet?",
-    "La vision de développement présentée vous paraît-elle réaliste et compatible avec nos contraintes de financement?",
-    "Les réseaux et soutiens mentionnés pourraient-ils jouer le rôle de garants implicites en cas de difficulté?",
-    "L'impact social et culturel de ce projet peut-il être converti en valeur ajoutée économique ou en notoriété positive?",
-    "L'engagement et la persévérance du porteur compensent-ils d'éventuelles faiblesses dans son modèle économique?"
-]
+if "financier_id" not in st.session_state:
+    st.session_state.financier_id = uuid.uuid4().hex
+
+# Travaux mis en file pendant une panne du service (évaluation, profil enrichi)
+if "evaluation_queued" not in st.session_state:
+    st.session_state.evaluation_queued = False
+
+# Réponses du financier sur lesquelles porte l'évaluation mise en file
+if "queued_responses" not in st.session_state:
+    st.session_state.queued_responses = None
+
+if "enriched_queued" not in st.session_state:
+    st.session_state.enriched_queued = False
+
+touch_session(st.session_state)
+
+# Span racine de cette exécution du script (rattaché au dossier dès qu'un profil est ouvert)
+begin_run(get_script_run_ctx().session_id, "agent", st.session_state.conversation_id, **{"tafahom.step": st.session_state.current_step})
+tag_profile(get_script_run_ctx().session_id, st.session_state.current_step)
 
 # Fonction pour charger le profil de l'artiste
 def load_artist_profile(conversation_id):
     try:
-        # Chercher le fichier correspondant à l'ID de conversation
-        profile_file = f"tafahom_profil_{conversation_id}.json"
+        # Chercher le fichier correspondant à l'ID de conversation (profil validé partagé entre répliques)
+        with span("file read profil", conversation_id):
+            profile_data = cached_profile(conversation_id)
         
-        if os.path.exists(profile_file):
-            with open(profile_file, "r", encoding="utf-8") as f:
-                profile_data = json.load(f)
+        if profile_data is not None:
             return profile_data
         else:
-            available_profiles = glob.glob("tafahom_profil_*.json")
-            if available_profiles:
-                return None, [os.path.basename(f).replace("tafahom_profil_", "").replace(".json", "") for f in available_profiles]
-            else:
-                return None, []
+            return None, [entry["conversation_id"] for entry in list_inbox()]
     except Exception as e:
         st.error(f"Erreur lors du chargement du profil: {e}")
         return None, []
 
-# Fonction pour contextualiser les questions en fonction du profil
-def contextualize_questions(profile_data):
-    try:
-        # Système prompt pour la contextualisation
-        system_prompt = """Tu es TAFAHOM-AGENT, un système qui contextualise des questions d'évaluation financière à partir d'un profil artistique.
+# Fonction pour ouvrir un profil en le prenant en charge (un seul financier évalue chaque profil)
+def open_profile(conversation_id, profile_data):
+    announce_profile(conversation_id, profile_data)
+    if not claim(conversation_id, st.session_state.financier_id):
+        st.warning("Ce profil est déjà pris en charge par un autre financier.")
+        return
+    # Changement de dossier: le précédent, non évalué, retourne dans la boîte de réception
+    previous = st.session_state.conversation_id
+    if previous and previous != conversation_id:
+        release(previous, st.session_state.financier_id)
+    st.session_state.profile_data = profile_data
+    st.session_state.conversation_id = conversation_id
+    st.session_state.current_step = "review"
+    st.rerun()
 
-🎯 Objectif principal :
-Pour chaque critère et sa question associée, tu dois:
-1. Extraire les informations pertinentes du profil artiste liées à ce critère
-2. Présenter ces informations de manière concise et factuelle
-3. Reformuler la question de base pour qu'elle soit directement liée au contenu du profil
+# Fonction pour revenir à l'accueil avec une session vierge (l'identifiant du financier est conservé)
+def reset_session():
+    financier_id = st.session_state.financier_id
+    discard_spilled(st.session_state)
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    
+    # Réinitialiser les variables de session
+    st.session_state.conversation_id = None
+    st.session_state.profile_data = None
+    st.session_state.current_step = "introduction"
+    st.session_state.financier_responses = {}
+    st.session_state.evaluation_summary = None
+    st.session_state.contextualized_questions = None
+    st.session_state.financier_id = financier_id
+    
+    st.rerun()
 
-Format de sortie pour chaque question:
-```
-{
-  "questions": [
-    {
-      "criterion": "Nom du critère",
-      "context": "Présentation factuelle des éléments du profil liés à ce critère (3-4 phrases)",
-      "question": "Question reformulée et contextualisée"
-    },
-    ...
-  ]
-}
-```
+# Relance poussée par le serveur: elle repose sur des attributs internes de Streamlit (Runtime._session_mgr,
+# AppSession._event_loop, présents depuis 1.12); sans eux, la boîte de réception est scrutée par un fragment
+# (Streamlit 1.33 et plus) et reste rafraîchissable avec le bouton « Rafraîchir »
+def push_rerun_supported():
+    return Runtime.exists() and hasattr(Runtime.instance(), "_session_mgr")
 
-Note: La présentation des éléments du profil doit être objective et factuelle, tandis que la question doit inviter à l'analyse financière.
-"""
-        
-        # Préparer le contexte du profil
-        profile_context = json.dumps(profile_data, ensure_ascii=False, indent=2)
-        
-        # Préparer les critères et questions
-        criteria_questions = []
-        for i, (criterion, question) in enumerate(zip(EVALUATION_CRITERIA, BASE_QUESTIONS)):
-            criteria_questions.append({"criterion": criterion, "base_question": question})
-        
-        criteria_context = json.dumps(criteria_questions, ensure_ascii=False, indent=2)
-        
-        # Construire le message pour le modèle
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Voici le profil d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici les critères et questions de base pour l'évaluation financière:\n\n{criteria_context}\n\nContextualise chaque question en présentant d'abord les éléments pertinents du profil puis en posant la question adaptée. Retourne uniquement le JSON structuré."}
-        ]
-        
-        # Appeler l'API
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.5,
-            max_tokens=2500,
-            top_p=0.9
-        )
-        
-        response_text = response.choices[0].message.content
-        
-        # Extraire le JSON
-        json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            json_str = re.search(r'({.*})', response_text, re.DOTALL).group(1)
-        
-        # Parser le JSON
-        contextualized_questions = json.loads(json_str)
-        
+# Fonction pour relancer l'affichage d'une session quand un profil arrive (False si la session n'existe plus)
+def rerun_session(session_id):
+    if not push_rerun_supported():
+        raise RuntimeError(f"relance des sessions non prise en charge par Streamlit {st.__version__}")
+    session_info = Runtime.instance()._session_mgr.get_active_session_info(session_id)
+    if session_info is None:
+        return False
+    event_loop = getattr(session_info.session, "_event_loop", None)
+    if event_loop is None:
+        raise RuntimeError(f"relance des sessions non prise en charge par Streamlit {st.__version__}")
+    event_loop.call_soon_threadsafe(session_info.session.request_rerun, None)
+
+# Scrutation du fil des arrivées quand la relance poussée n'est pas disponible: la page est relancée dès qu'un
+# nouveau profil est déposé
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+if fragment is not None:
+    @fragment(run_every=POLL_INTERVAL)
+    def watch_inbox():
+        sequence = last_sequence()
+        if sequence != st.session_state.get("inbox_sequence", sequence):
+            st.rerun()
+
+# Fonction pour obtenir les questions contextualisées: précalculées à l'export par le portail si elles sont
+# à jour (même profil, même banque de questions), sinon contextualisées maintenant et enregistrées
+def contextualize_questions(profile_data):
+    conversation_id = st.session_state.conversation_id
+    precomputed = load_precomputed_questions(conversation_id, profile_data, MODEL)
+    if precomputed is not None:
+        return precomputed
+    
+    try:
+        contextualized_questions = contextualize(client, profile_data, conversation_id, MODEL)
+        save_questions(conversation_id, profile_data, MODEL, contextualized_questions)
         return contextualized_questions
     
     except Exception as e:
         st.error(f"Erreur lors de la contextualisation des questions: {e}")
         
         # En cas d'échec, créer une version par défaut
-        default_questions = {"questions": []}
-        for i, (criterion, question) in enumerate(zip(EVALUATION_CRITERIA, BASE_QUESTIONS)):
-            default_questions["questions"].append({
-                "criterion": criterion,
-                "context": f"Évaluez le porteur sur son {criterion}.",
-                "question": question
-            })
-        
-        return default_questions
+        return default_questions()
 
 # Fonction pour générer l'évaluation finale
-def generate_final_evaluation(profile_data, financier_responses):
+def generate_final_evaluation(profile_data, contextualized_questions, financier_responses):
     try:
         # Système prompt pour l'évaluation finale
         system_prompt = """Tu es TAFAHOM-AGENT, un agent conversationnel chargé de générer une évaluation finale basée sur les réponses d'un agent financier humain.
@@ -210,41 +227,50 @@ Format de l'évaluation à générer:
 Ton évaluation doit être équilibrée, reconnaissant à la fois les forces symboliques et les garanties financières, tout en respectant fidèlement l'avis exprimé par l'agent financier.
 """
         
+        packer = PromptPacker("generate_final_evaluation")
+        
         # Préparer le contexte du profil
-        profile_context = json.dumps(profile_data, ensure_ascii=False, indent=2)
+        profile_context = packer.add(prune_profile(profile_data), profile_data)
         
-        # Préparer les réponses du financier
-        responses_context = json.dumps(financier_responses, ensure_ascii=False, indent=2)
+        # Préparer les réponses du financier (sans répéter le contexte de chaque question, déjà dans le profil)
+        responses_context = packer.add(
+            pack_responses(EVALUATION_CRITERIA, contextualized_questions, financier_responses),
+            unpacked_responses(EVALUATION_CRITERIA, contextualized_questions, financier_responses)
+        )
         
         # Construire le message pour le modèle
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"Voici le profil d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici les réponses de l'agent financier à des questions spécifiques sur ce profil:\n\n{responses_context}\n\nGénère maintenant une évaluation finale complète avec les 10 critères d'évaluation, un score global, une décision et des recommandations. Retourne uniquement le JSON structuré."}
         ]
+        packer.check(messages, max_tokens=2000)
         
         # Appeler l'API
-        response = client.chat.completions.create(
+        response_text = chat_completion(
+            client,
+            "generate_final_evaluation",
+            messages,
+            conversation_id=st.session_state.conversation_id,
+            validate=lambda text: validated(Evaluation, extract_json(text)),
             model=MODEL,
-            messages=messages,
             temperature=0.5,
             max_tokens=2000,
             top_p=0.9
         )
         
-        response_text = response.choices[0].message.content
-        
-        # Extraire le JSON
-        json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            json_str = re.search(r'({.*})', response_text, re.DOTALL).group(1)
-        
-        # Parser le JSON
-        evaluation_data = json.loads(json_str)
+        # Extraire, parser et valider le JSON
+        evaluation_data = validated(Evaluation, extract_json(response_text))
         
         return evaluation_data
     
+    except (LLMUnavailableError, LLMQuotaError) as e:
+        # Service en panne ou quota épuisé: l'évaluation est mise en file et sera enregistrée dès le rétablissement du service
+        enqueue("evaluation", st.session_state.conversation_id, messages, model=MODEL, temperature=0.5, max_tokens=2000, top_p=0.9)
+        st.session_state.evaluation_queued = True
+        st.session_state.queued_responses = dict(financier_responses)
+        st.warning(f"{e} L'évaluation sera générée automatiquement dès le rétablissement du service.")
+        return None
+    
     except Exception as e:
         st.error(f"Erreur lors de la génération de l'évaluation finale: {e}")
         return None
@@ -285,38 +311,42 @@ Format du profil à générer:
 """
         
         # Préparer le contexte
-        profile_context = json.dumps(profile_data, ensure_ascii=False, indent=2)
-        evaluation_context = json.dumps(evaluation_data, ensure_ascii=False, indent=2)
+        packer = PromptPacker("generate_updated_artist_profile")
+        profile_context = packer.add(prune_profile(profile_data), profile_data)
+        evaluation_context = packer.add(prune_evaluation(evaluation_data), evaluation_data)
         
         # Construire le message
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"Voici le profil original d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici l'évaluation financière de ce profil:\n\n{evaluation_context}\n\nGénère maintenant un profil enrichi qui intègre ces deux perspectives. Retourne uniquement le JSON structuré."}
         ]
+        packer.check(messages, max_tokens=2000)
         
         # Appeler l'API
-        response = client.chat.completions.create(
+        response_text = chat_completion(
+            client,
+            "generate_updated_artist_profile",
+            messages,
+            conversation_id=st.session_state.conversation_id,
+            validate=lambda text: validated(EnrichedProfile, extract_json(text)),
             model=MODEL,
-            messages=messages,
             temperature=0.5,
             max_tokens=2000,
             top_p=0.9
         )
         
-        response_text = response.choices[0].message.content
-        
-        # Extraire le JSON
-        json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            json_str = re.search(r'({.*})', response_text, re.DOTALL).group(1)
-        
-        # Parser le JSON
-        updated_profile = json.loads(json_str)
+        # Extraire, parser et valider le JSON
+        updated_profile = validated(EnrichedProfile, extract_json(response_text))
         
         return updated_profile
     
+    except (LLMUnavailableError, LLMQuotaError) as e:
+        # Service en panne ou quota épuisé: le profil enrichi est mis en file et sera enregistré dès le rétablissement du service
+        enqueue("enriched_profile", st.session_state.conversation_id, messages, model=MODEL, temperature=0.5, max_tokens=2000, top_p=0.9)
+        st.session_state.enriched_queued = True
+        st.warning(f"{e} Le profil enrichi sera généré automatiquement dès le rétablissement du service.")
+        return None
+    
     except Exception as e:
         st.error(f"Erreur lors de la génération du profil mis à jour: {e}")
         return None
@@ -324,6 +354,19 @@ Format du profil à générer:
 # Interface principale
 st.title("💼 TAFAHOM - Agent Financier")
 
+# Surveillance des profils déposés (une fois par processus): la session est relancée à chaque arrivée
+# tant qu'elle affiche la boîte de réception
+start_watcher()
+
+# Traitement en arrière-plan des travaux mis en file pendant une panne du service (une fois par processus)
+start_worker(client)
+
+session_id = get_script_run_ctx().session_id
+if st.session_state.current_step == "introduction" and push_rerun_supported():
+    subscribe(session_id, lambda conversation_id: rerun_session(session_id))
+else:
+    unsubscribe(session_id)
+
 # Étape d'introduction
 if st.session_state.current_step == "introduction":
     st.markdown("""
@@ -358,37 +401,98 @@ if st.session_state.current_step == "introduction":
                 else:
                     profile_data = result
                     if profile_data:
-                        st.session_state.profile_data = profile_data
-                        st.session_state.conversation_id = conversation_id
-                        st.session_state.current_step = "review"
-                        st.rerun()
+                        open_profile(conversation_id, profile_data)
                     else:
                         st.error(f"Profil non trouvé pour l'ID {conversation_id}")
     
-    # Option 2: Fichiers disponibles
+    # Option 2: Boîte de réception (profils déposés par le portail, mise à jour à chaque arrivée)
     st.markdown("---")
-    st.subheader("Ou sélectionnez un profil existant")
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        st.subheader(f"Ou choisissez un profil dans la boîte de réception ({unread_count()} nouveaux)")
+    with col2:
+        if st.button("Rafraîchir", key="refresh_inbox"):
+            st.rerun()
+    if not push_rerun_supported() and fragment is not None:
+        st.session_state.inbox_sequence = last_sequence()
+        watch_inbox()
     
-    # Recherche des fichiers de profil disponibles
-    available_profiles = glob.glob("tafahom_profil_*.json")
-    if available_profiles:
-        profile_ids = [os.path.basename(f).replace("tafahom_profil_", "").replace(".json", "") for f in available_profiles]
-        selected_id = st.selectbox("Profils disponibles", profile_ids)
-        
-        if st.button("Charger ce profil", key="load_selected"):
-            result = load_artist_profile(selected_id)
-            
-            if isinstance(result, tuple):
-                st.error("Erreur lors du chargement du profil.")
-            else:
-                profile_data = result
-                if profile_data:
-                    st.session_state.profile_data = profile_data
-                    st.session_state.conversation_id = selected_id
-                    st.session_state.current_step = "review"
-                    st.rerun()
+    inbox = list_inbox()
+    if inbox:
+        for entry in inbox:
+            col1, col2 = st.columns([4, 1])
+            claimed_by_other = entry["status"] == "pris" and entry["claimed_by"] != st.session_state.financier_id
+            with col1:
+                received_at = datetime.fromtimestamp(entry["received_at"]).strftime("%d/%m/%Y %H:%M")
+                st.markdown(f"**{entry['conversation_id']}** · {received_at} · Score IAS: {entry['ias_score']}/100 · _{STATUS_LABELS[entry['status']]}_")
+                if entry["summary"]:
+                    st.caption(entry["summary"])
+            with col2:
+                if not claimed_by_other and st.button("Prendre en charge", key=f"load_inbox_{entry['conversation_id']}"):
+                    result = load_artist_profile(entry["conversation_id"])
+                    if isinstance(result, tuple):
+                        st.error("Erreur lors du chargement du profil.")
+                    else:
+                        open_profile(entry["conversation_id"], result)
     else:
         st.info("Aucun profil disponible. Veuillez d'abord créer un profil avec TAFAHOM-Portail.")
+    
+    # Option 3: Recherche plein texte dans les transcriptions et les commentaires
+    st.markdown("---")
+    st.subheader("Ou recherchez dans les conversations")
+    
+    search_query = st.text_input("Mots-clés (transcriptions, commentaires institutionnels)", key="search_query")
+    if search_query:
+        search_results = search(search_query)
+        if search_results:
+            for result in search_results:
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.markdown(f"**{result['conversation_id']}** · _{result['kind']}_")
+                    st.markdown(result["snippet"])
+                with col2:
+                    if st.button("Charger", key=f"load_search_{result['conversation_id']}"):
+                        result_profile = load_artist_profile(result["conversation_id"])
+                        if result_profile and not isinstance(result_profile, tuple):
+                            open_profile(result["conversation_id"], result_profile)
+                        else:
+                            st.error("Aucun profil exporté pour cette conversation.")
+        else:
+            st.info("Aucune conversation ne correspond à cette recherche.")
+    
+    # Option 4: Export groupé des profils et évaluations d'une période (écrit au fil de l'eau sur le serveur)
+    st.markdown("---")
+    st.subheader("Ou exportez les profils d'une période")
+    
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        export_period = st.date_input("Période (date de création des conversations)", value=(datetime.now().date() - timedelta(days=30), datetime.now().date()), key="export_period")
+    with col2:
+        export_format = st.selectbox("Format", list(FORMATS), key="export_format")
+    
+    if st.button("Exporter la période"):
+        since, until = export_period if len(export_period) == 2 else (export_period[0], export_period[0])
+        progress_bar = st.progress(0.0, text="Export en cours...")
+        export_file, exported = export_to_file(
+            export_format,
+            since,
+            until,
+            progress=lambda done, total, conversation_id: progress_bar.progress(done / total, text=f"{done}/{total} conversations exportées")
+        )
+        progress_bar.empty()
+        st.success(f"✅ {exported} conversations exportées dans {export_file}")
+        
+        # Le téléchargement passe par la mémoire du serveur: proposé seulement en dessous de la limite
+        if os.path.getsize(export_file) <= EXPORT_DOWNLOAD_MAX_BYTES:
+            with open(export_file, "rb") as f:
+                st.download_button(
+                    "Télécharger l'export",
+                    f,
+                    file_name=os.path.basename(export_file),
+                    mime=FORMATS[export_format][0]
+                )
+        else:
+            st.info("Export trop volumineux pour le navigateur: récupérez le fichier sur le serveur (ou utilisez python tafahom_export.py).")
 
 # Étape de revue du profil
 elif st.session_state.current_step == "review":
@@ -467,23 +571,76 @@ elif st.session_state.current_step == "review":
     )
     st.plotly_chart(fig, use_container_width=True)
     
+    # Profils comparables déjà évalués
+    st.markdown("### Profils comparables")
+    
+    comparable_profiles = similar_profiles(profile, k=5, exclude_id=st.session_state.conversation_id)
+    if comparable_profiles:
+        comparable_df = pd.DataFrame([
+            {
+                "Identifiant": comparable["conversation_id"],
+                "Similarité": round(comparable["similarity"] * 100),
+                "Score IAS": comparable["ias_score"],
+                "Décision": comparable["decision"] or "Non évalué",
+                "Score de recevabilité": comparable["global_score"]
+            }
+            for comparable in comparable_profiles
+        ])
+        
+        st.dataframe(
+            comparable_df,
+            column_config={
+                "Similarité": st.column_config.ProgressColumn(
+                    "Similarité",
+                    min_value=-100,
+                    max_value=100,
+                    format="%d%%",
+                ),
+            },
+            hide_index=True,
+        )
+    else:
+        st.info("Aucun profil comparable disponible pour le moment.")
+    
+    # Pré-examen par règles sur le profil seul: décision provisoire immédiate
+    st.markdown("### Pré-examen")
+    prescreening = screen(st.session_state.profile_data)
+    if prescreening["settled"]:
+        st.success(f"Décision provisoire: **{prescreening['decision']}** (score {prescreening['global_score']}/100). "
+                   "Dossier tranché par les règles: les questions reprennent l'évaluation du portail, sans contextualisation par le modèle.")
+    else:
+        st.info(f"Décision provisoire: **{prescreening['decision']}** (score {prescreening['global_score']}/100). "
+                f"Cas limite ({'; '.join(prescreening['reasons']) or 'pré-examen désactivé'}): les questions seront contextualisées par le modèle.")
+    
     # Bouton pour commencer l'évaluation
     if st.button("Commencer l'évaluation financière"):
-        # Contextualiser les questions
+        # Contextualiser les questions (dossier tranché: questions précalculées si elles existent, sinon sans appel au modèle)
         with st.spinner("Préparation des questions contextualisées..."):
-            contextualized_questions = contextualize_questions(st.session_state.profile_data)
+            if prescreening["settled"]:
+                precomputed = load_precomputed_questions(st.session_state.conversation_id, st.session_state.profile_data, MODEL)
+                contextualized_questions = precomputed or profile_questions(st.session_state.profile_data)
+                record_screening(st.session_state.conversation_id, "review", prescreening, skipped=[] if precomputed else ["contextualize_questions"])
+            else:
+                contextualized_questions = contextualize_questions(st.session_state.profile_data)
+                record_screening(st.session_state.conversation_id, "review", prescreening)
             if contextualized_questions:
                 st.session_state.contextualized_questions = contextualized_questions
                 st.session_state.current_step = "questions"
                 st.rerun()
             else:
                 st.error("Impossible de contextualiser les questions. Veuillez réessayer.")
+    
+    # Bouton pour rendre le dossier sans l'évaluer: il retourne dans la boîte de réception pour les autres financiers
+    if st.button("Rendre le dossier"):
+        release(st.session_state.conversation_id, st.session_state.financier_id)
+        reset_session()
 
 # Étape des questions
 elif st.session_state.current_step == "questions":
     st.markdown("### Évaluation financière")
     st.markdown("Veuillez répondre aux questions suivantes pour évaluer la recevabilité du projet:")
     
+    ensure_loaded(st.session_state, "contextualized_questions")
     if not st.session_state.contextualized_questions:
         st.error("Questions contextualisées non disponibles. Retournez à l'étape précédente.")
         if st.button("Retour"):
@@ -537,28 +694,97 @@ elif st.session_state.current_step == "questions":
 
 # Étape de résumé final
 elif st.session_state.current_step == "summary":
-    # Générer l'évaluation finale si elle n'existe pas
-    if not st.session_state.evaluation_summary:
-        with st.spinner("Génération de l'évaluation financière..."):
-            # Restructurer les réponses du financier pour l'IA
-            formatted_responses = {}
-            for i, criterion in enumerate(EVALUATION_CRITERIA):
-                formatted_responses[criterion] = {
-                    "text": st.session_state.financier_responses.get(f"question_{i}", ""),
-                    "score": st.session_state.financier_responses.get(f"score_{i}", 5),
-                    "question_context": st.session_state.contextualized_questions["questions"][i]["context"],
-                    "question": st.session_state.contextualized_questions["questions"][i]["question"]
-                }
-            
-            # Générer l'évaluation
-            evaluation_data = generate_final_evaluation(st.session_state.profile_data, formatted_responses)
+    ensure_loaded(st.session_state, "evaluation_summary")
+    ensure_loaded(st.session_state, "contextualized_questions")
+    
+    # Évaluation mise en file pendant une panne: reprise depuis le stockage une fois livrée
+    if not st.session_state.evaluation_summary and st.session_state.evaluation_queued:
+        queued_status = job_status("evaluation", st.session_state.conversation_id)
+        if queued_status == "livre":
+            st.session_state.evaluation_summary = read_json(evaluation_path(st.session_state.conversation_id))
+            st.session_state.evaluated_responses = st.session_state.queued_responses
+        if queued_status in ("en_attente", "en_cours"):
+            st.info("⏳ L'évaluation est en file d'attente: elle sera générée dès le rétablissement du service.")
+            if st.button("Vérifier l'avancement"):
+                st.rerun()
+        else:
+            st.session_state.evaluation_queued = False
+    
+    # Évaluation dont les réponses d'origine sont inconnues: elle ne peut pas être comparée aux réponses actuelles,
+    # évaluation complète ci-dessous
+    if st.session_state.evaluation_summary and st.session_state.evaluated_responses is None:
+        st.session_state.evaluation_summary = None
+    
+    # Réponses modifiées depuis l'évaluation affichée: seuls les critères modifiés sont réévalués
+    if st.session_state.evaluation_summary and st.session_state.evaluated_responses is not None:
+        changed = changed_criteria(st.session_state.evaluated_responses, st.session_state.financier_responses, len(EVALUATION_CRITERIA))
+        if changed and st.session_state.evaluation_summary.get("screening"):
+            # Évaluation provisoire des règles: nouveau pré-examen ci-dessous (sans appel au modèle si le dossier reste tranché)
+            st.session_state.evaluation_summary = None
+        elif changed:
+            started = time.perf_counter()
+            with st.spinner(f"Réévaluation de {len(changed)} critère(s)..."):
+                try:
+                    evaluation_data = reevaluate(
+                        client,
+                        st.session_state.profile_data,
+                        EVALUATION_CRITERIA,
+                        st.session_state.contextualized_questions,
+                        st.session_state.financier_responses,
+                        st.session_state.evaluation_summary,
+                        changed,
+                        st.session_state.conversation_id,
+                        MODEL
+                    )
+                except Exception:
+                    evaluation_data = None  # réévaluation impossible: évaluation complète ci-dessous
             if evaluation_data:
                 st.session_state.evaluation_summary = evaluation_data
+                st.session_state.evaluated_responses = dict(st.session_state.financier_responses)
+                with span("file write evaluation"):
+                    atomic_write_json(evaluation_path(st.session_state.conversation_id), evaluation_data)
+                index_comments(st.session_state.conversation_id, evaluation_data, kind="evaluation")
+                st.caption(f"Évaluation mise à jour en {time.perf_counter() - started:.1f} s ({len(changed)} critère(s) réévalué(s) sur {len(EVALUATION_CRITERIA)}).")
             else:
-                st.error("Impossible de générer l'évaluation. Veuillez réessayer.")
-                if st.button("Retour aux questions"):
-                    st.session_state.current_step = "questions"
-                    st.rerun()
+                st.session_state.evaluation_summary = None
+    
+    # Générer l'évaluation finale si elle n'existe pas
+    if not st.session_state.evaluation_summary and not st.session_state.evaluation_queued:
+        # Pré-examen avec les notes du financier: un dossier tranché reçoit une évaluation provisoire sans appel au modèle
+        financier_scores = [st.session_state.financier_responses.get(f"score_{i}", 5) for i in range(len(EVALUATION_CRITERIA))]
+        screening = screen(st.session_state.profile_data, financier_scores, EVALUATION_CRITERIA)
+        if screening["settled"]:
+            evaluation_data = rules_evaluation(
+                screening,
+                EVALUATION_CRITERIA,
+                financier_scores,
+                [st.session_state.financier_responses.get(f"question_{i}", "") for i in range(len(EVALUATION_CRITERIA))]
+            )
+            record_screening(st.session_state.conversation_id, "summary", screening, skipped=["generate_final_evaluation"])
+        else:
+            with st.spinner("Génération de l'évaluation financière..."):
+                # Générer l'évaluation
+                evaluation_data = generate_final_evaluation(
+                    st.session_state.profile_data,
+                    st.session_state.contextualized_questions,
+                    st.session_state.financier_responses
+                )
+            if evaluation_data:
+                record_screening(st.session_state.conversation_id, "summary", screening)
+        
+        if evaluation_data:
+            st.session_state.evaluation_summary = evaluation_data
+            st.session_state.evaluated_responses = dict(st.session_state.financier_responses)
+            
+            # Sauvegarder l'évaluation pour la recherche de profils comparables
+            with span("file write evaluation"):
+                atomic_write_json(evaluation_path(st.session_state.conversation_id), evaluation_data)
+            index_comments(st.session_state.conversation_id, evaluation_data, kind="evaluation")
+        elif not st.session_state.evaluation_queued:
+            st.error("Impossible de générer l'évaluation. Veuillez réessayer.")
+            if st.button("Retour aux questions"):
+                st.session_state.current_step = "questions"
+                st.rerun()
     
     # Afficher l'évaluation
     if st.session_state.evaluation_summary:
@@ -566,6 +792,25 @@ elif st.session_state.current_step == "summary":
         
         st.markdown("### Évaluation Financière - Synthèse")
         
+        # Évaluation provisoire des règles: l'évaluation rédigée par le modèle n'est générée que sur demande
+        if st.session_state.evaluation_summary.get("screening"):
+            st.info("Évaluation provisoire établie par les règles de pré-examen (dossier tranché), sans appel au modèle.")
+            if st.button("Rédiger l'évaluation détaillée"):
+                with st.spinner("Génération de l'évaluation financière..."):
+                    evaluation_data = generate_final_evaluation(
+                        st.session_state.profile_data,
+                        st.session_state.contextualized_questions,
+                        st.session_state.financier_responses
+                    )
+                if evaluation_data:
+                    st.session_state.evaluation_summary = evaluation_data
+                    st.session_state.evaluated_responses = dict(st.session_state.financier_responses)
+                    with span("file write evaluation"):
+                        atomic_write_json(evaluation_path(st.session_state.conversation_id), evaluation_data)
+                    index_comments(st.session_state.conversation_id, evaluation_data, kind="evaluation")
+                    record_screening(st.session_state.conversation_id, "narrative", None, performed=["generate_final_evaluation"])
+                    st.rerun()
+        
         # Afficher le score global et la décision
         col1, col2 = st.columns([1, 2])
         
@@ -677,6 +922,14 @@ elif st.session_state.current_step == "summary":
         )
         st.plotly_chart(fig, use_container_width=True)
         
+        # Profil enrichi mis en file pendant une panne
+        if st.session_state.enriched_queued:
+            queued_status = job_status("enriched_profile", st.session_state.conversation_id)
+            if queued_status == "livre":
+                st.success(f"✅ Profil enrichi généré après le rétablissement du service et sauvegardé sous: {os.path.basename(enriched_profile_path(st.session_state.conversation_id))}")
+            elif queued_status in ("en_attente", "en_cours"):
+                st.info("⏳ Le profil enrichi est en file d'attente: il sera généré dès le rétablissement du service.")
+        
         # Bouton pour générer un profil artiste mis à jour
         if st.button("Générer un profil artiste enrichi"):
             with st.spinner("Génération du profil enrichi..."):
@@ -687,18 +940,18 @@ elif st.session_state.current_step == "summary":
                 
                 if updated_profile:
                     # Sauvegarder le profil mis à jour
-                    updated_file = f"tafahom_profil_enrichi_{st.session_state.conversation_id}.json"
-                    with open(updated_file, "w", encoding="utf-8") as f:
-                        json.dump(updated_profile, f, ensure_ascii=False, indent=2)
+                    updated_file = enriched_profile_path(st.session_state.conversation_id)
+                    with span("file write profil enrichi"):
+                        atomic_write_json(updated_file, updated_profile)
                     
-                    st.success(f"✅ Profil enrichi généré et sauvegardé sous: {updated_file}")
+                    st.success(f"✅ Profil enrichi généré et sauvegardé sous: {os.path.basename(updated_file)}")
                     
                     # Proposer le téléchargement
                     with open(updated_file, "r", encoding="utf-8") as f:
                         st.download_button(
                             "Télécharger le profil enrichi",
                             f.read(),
-                            file_name=updated_file,
+                            file_name=os.path.basename(updated_file),
                             mime="application/json"
                         )
                     
@@ -754,24 +1007,19 @@ elif st.session_state.current_step == "summary":
                         },
                         hide_index=True,
                     )
-                else:
+                elif not st.session_state.enriched_queued:
                     st.error("Impossible de générer le profil enrichi. Veuillez réessayer.")
         
+        # Bouton pour revenir aux questions: à la nouvelle soumission, seuls les critères modifiés sont réévalués
+        if st.button("Modifier l'évaluation"):
+            st.session_state.current_step = "questions"
+            st.rerun()
+        
         # Bouton pour évaluer un nouveau profil
         if st.button("Évaluer un nouveau profil"):
-            # Réinitialiser l'état de la session
-            for key in list(st.session_state.keys()):
-                del st.session_state[key]
-            
-            # Réinitialiser les variables de session
-            st.session_state.conversation_id = None
-            st.session_state.profile_data = None
-            st.session_state.current_step = "introduction"
-            st.session_state.financier_responses = {}
-            st.session_state.evaluation_summary = None
-            st.session_state.contextualized_questions = None
-            
-            st.rerun()
+            # Le profil évalué sort de la boîte de réception
+            complete(st.session_state.conversation_id, st.session_state.financier_id)
+            reset_session()
 
 # Sidebar avec informations et options
 with st.sidebar:
@@ -800,7 +1048,101 @@ with st.sidebar:
     - **Capital symbolique**: Notoriété, réputation, reconnaissance
     """)
     
+    # Mémoire occupée par la session (les données froides sont déchargées sur disque au-delà du budget)
+    st.markdown("---")
+    session_memory = memory_report(st.session_state)
+    st.caption(f"Mémoire de session: {format_size(sum(session_memory.values()))} (budget {format_size(per_session_budget())})")
+    st.caption(f"Service de génération: {service_status(client)}")
+    if quotas_enabled():
+        st.caption(f"Quota consommé: {status_line(quota_status())}")
+    screening_stats = screening_report()
+    if screening_stats["dossiers"]:
+        st.caption(f"Pré-examen: {screening_stats['share']:.0%} des dossiers évalués sans appel au modèle ({screening_stats['settled']}/{screening_stats['dossiers']}), "
+                   f"{screening_stats['saved_seconds'] / 60:.1f} min de génération économisées")
+    scaffold_stats = cache_stats()
+    if scaffold_stats["hit_rate"] is not None:
+        st.caption(f"Questions reprises de profils proches: {scaffold_stats['hit_rate']:.0%} ({int(scaffold_stats['hits'])}/{int(scaffold_stats['hits'] + scaffold_stats['misses'])}), {scaffold_stats['entries']} gabarits")
+    shared_stats = {namespace: stats for namespace, stats in cache_report().items() if stats["hit_rate"] is not None}
+    if shared_stats:
+        st.caption(f"Cache partagé ({get_backend().name}): " + ", ".join(f"{namespace} {stats['hit_rate']:.0%}" for namespace, stats in shared_stats.items()))
+    
+    # Chemin critique du dossier ouvert (portail et agent): où le temps de traitement a été passé
+    if st.session_state.conversation_id and st.checkbox("Chemin critique du dossier"):
+        st.dataframe(
+            pd.DataFrame([
+                {"Étape": "  " * entry["depth"] + entry["name"], "Application": entry["service"], "Durée (s)": round(entry["duration"], 3), "Temps propre (s)": round(entry["self"], 3)}
+                for entry in critical_path(st.session_state.conversation_id)
+            ]),
+            hide_index=True,
+        )
+    
+    # Profilage des exécutions du script (développeur): points chauds et flame graph par étape, cumulés sur les exécutions profilées
+    # (réglage conservé hors widget: une exécution interrompue par st.rerun avant la barre latérale ne le perd pas)
+    st.session_state.profiler_enabled = st.checkbox("Profiler les exécutions (développeur)", value=st.session_state.get("profiler_enabled", False))
+    if st.session_state.profiler_enabled:
+        summary = profile_summary("agent")
+        if summary:
+            st.dataframe(
+                pd.DataFrame([
+                    {"Étape": row["step"], "Exécutions": row["runs"], "Durée moyenne (ms)": round(row["mean_ms"]), "Échantillons": row["samples"]}
+                    for row in summary
+                ]),
+                hide_index=True,
+            )
+            profiled_step = st.selectbox("Étape profilée", ["toutes"] + [row["step"] for row in summary], key="profiled_step")
+            profiled_step = None if profiled_step == "toutes" else profiled_step
+            st.dataframe(
+                pd.DataFrame([
+                    {"Fonction / ligne": row["frame"], "Propre": f"{row['self']:.0%}", "Inclusive": f"{row['inclusive']:.0%}"}
+                    for row in hotspots("agent", profiled_step)
+                ]),
+                hide_index=True,
+            )
+            st.download_button(
+                label="Télécharger le flame graph (SVG)",
+                data=flame_graph_svg("agent", profiled_step),
+                file_name=f"tafahom_agent_{profiled_step or 'toutes'}.svg",
+                mime="image/svg+xml"
+            )
+            st.download_button(
+                label="Télécharger les piles (format replié)",
+                data=folded("agent", profiled_step),
+                file_name=f"tafahom_agent_{profiled_step or 'toutes'}.folded",
+                mime="text/plain"
+            )
+            if st.button("Réinitialiser le profilage"):
+                reset_profiles("agent")
+        else:
+            st.caption("Les prochaines exécutions du script seront profilées.")
+    
+    # Tokens de prompt envoyés et économisés par l'empaquetage, par site d'appel (depuis le démarrage du serveur)
+    if st.checkbox("Économie de tokens par appel"):
+        st.dataframe(
+            pd.DataFrame([
+                {"Appel": call_site, "Appels": row["calls"], "Tokens envoyés": row["sent"], "Tokens économisés": row["saved"], "Économie": f"{row['ratio']:.0%}"}
+                for call_site, row in savings_report().items()
+            ]),
+            hide_index=True,
+        )
+    
     # Version de l'application
     st.markdown("---")
     st.caption("TAFAHOM - Version 1.0")
-    st.caption("Développé dans le cadre du projet de recherche sur le capital culturel et symbolique")
\ No newline at end of file
+    st.caption("Développé dans le cadre du projet de recherche sur le capital culturel et symbolique")
+
+# Mesure de la mémoire de session et déchargement des données froides (questions et évaluation hors de leur étape)
+cold_keys = []
+if st.session_state.current_step != "summary":
+    cold_keys.append("evaluation_summary")
+if st.session_state.current_step != "questions" and (st.session_state.current_step != "summary" or st.session_state.evaluation_summary):
+    cold_keys.append("contextualized_questions")
+enforce_budget(
+    st.session_state,
+    get_script_run_ctx().session_state,
+    cold_keys=cold_keys,
+    keep_messages=0,
+    app_name="agent"
+)
+export_metrics("agent")
+end_run(get_script_run_ctx().session_id)
+end_profile(get_script_run_ctx().session_id)
@@ -0,0 +1,317 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import redis
+except ImportError:  # redis optionnel: cache partagé sur le disque commun
+    redis = None
+
+from tafahom_metriques import counter_value, increment
+from tafahom_modeles import Profile, validated
+from tafahom_stockage import DATA_DIR, atomic_write_text, create_text, profile_path, read_json
+from tafahom_traces import span
+
+# Cache partagé entre les répliques Streamlit: réponses du modèle, profils validés et questions contextualisées.
+# Serveur compatible Redis si TAFAHOM_CACHE_URL est défini (et le module redis installé), sinon fichiers dans le
+# répertoire de données commun. Les clés portent la version du format de chaque espace; une entrée absente n'est
+# calculée que par une réplique à la fois (verrou posé avec NX), les autres attendent son résultat
+CACHE_URL = os.getenv("TAFAHOM_CACHE_URL")
+
+# Répertoire du cache sur disque (à défaut de serveur)
+CACHE_DIR = os.getenv("TAFAHOM_CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+
+# Préfixe commun des clés (plusieurs déploiements sur un même serveur)
+KEY_PREFIX = os.getenv("TAFAHOM_CACHE_PREFIX", "tafahom")
+
+# Version du format des entrées (enveloppe commune): la changer invalide tout le cache
+CACHE_VERSION = 1
+
+# Espaces du cache: version du format de leurs valeurs (la changer n'invalide que cet espace) et durée de vie (s)
+NAMESPACES = {
+    "llm": {"version": 1, "ttl": float(os.getenv("TAFAHOM_CACHE_LLM_TTL", "86400"))},
+    "profile": {"version": 1, "ttl": 3600.0},
+    "questions": {"version": 1, "ttl": 7 * 86400.0}
+}
+
+# Durée de vie (s) du verrou de calcul: au-delà, une réplique bloquée ou arrêtée est relayée par une autre
+LOCK_SECONDS = float(os.getenv("TAFAHOM_CACHE_LOCK_SECONDS", "120"))
+
+# Attente maximale (s) du résultat calculé par une autre réplique, avant de le calculer soi-même
+WAIT_TIMEOUT = float(os.getenv("TAFAHOM_CACHE_WAIT_TIMEOUT", "90"))
+
+# Intervalle (s) entre deux lectures pendant l'attente
+POLL_INTERVAL = 0.05
+
+# Fonction pour construire la clé versionnée d'une entrée: préfixe, version du cache, espace, version de l'espace,
+# empreinte des éléments qui identifient la valeur
+def cache_key(namespace, parts):
+    digest = hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    return f"{KEY_PREFIX}:v{CACHE_VERSION}:{namespace}:v{NAMESPACES[namespace]['version']}:{digest}"
+
+# Serveur compatible Redis (SET avec PX et NX, GET, DEL, SCAN)
+class RedisBackend:
+    name = "redis"
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=2)
+        self.client.ping()
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    # Fonction pour créer une clé seulement si elle n'existe pas (verrou); True si elle a été créée
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, value, px=int(ttl * 1000), nx=True))
+
+    # Le verrou n'est supprimé que s'il appartient encore à cette réplique (au pire, entre la lecture et la
+    # suppression, le verrou d'une autre réplique expiré puis repris est libéré: un calcul en double, sans erreur)
+    def release(self, key, token):
+        if self.get(key) == token:
+            self.client.delete(key)
+
+    def clear(self, prefix):
+        removed = 0
+        for key in self.client.scan_iter(match=f"{prefix}*", count=500):
+            removed += self.client.delete(key)
+        return removed
+
+# Fichiers du répertoire commun: une entrée par fichier (valeur et échéance), verrou créé en exclusif
+class DiskBackend:
+    name = "disque"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json")
+
+    def _read(self, key):
+        try:
+            entry = read_json(self._path(key))
+        except ValueError:
+            return None  # fichier en cours de remplacement sur un montage sans renommage atomique
+        if entry is None or entry["key"] != key or entry["expires_at"] < time.time():
+            return None
+        return entry["value"]
+
+    def get(self, key):
+        return self._read(key)
+
+    def set(self, key, value, ttl):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write_text(path, json.dumps({"key": key, "expires_at": time.time() + ttl, "value": value}, ensure_ascii=False))
+
+    def add(self, key, value, ttl):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = json.dumps({"key": key, "expires_at": time.time() + ttl, "value": value}, ensure_ascii=False)
+        try:
+            create_text(path, entry)
+            return True
+        except FileExistsError:
+            if self._read(key) is not None:
+                return False
+        # Verrou expiré (réplique arrêtée pendant le calcul): supprimé puis recréé (deux répliques peuvent rarement
+        # s'y croiser: un calcul en double, sans erreur)
+        try:
+            os.remove(path)
+            create_text(path, entry)
+            return True
+        except (FileNotFoundError, FileExistsError):
+            return False
+
+    def release(self, key, token):
+        if self._read(key) == token:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self, prefix):
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if (read_json(path) or {}).get("key", "").startswith(prefix):
+                        os.remove(path)
+                        removed += 1
+                except (ValueError, OSError):
+                    pass
+        return removed
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# Fonction pour obtenir le stockage du cache (serveur si configuré et joignable, sinon disque), une fois par processus
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if CACHE_URL and redis is not None:
+                try:
+                    _backend = RedisBackend(CACHE_URL)
+                except redis.RedisError:
+                    increment("tafahom_cache_backend_errors_total", backend="redis")
+            _backend = _backend or DiskBackend(CACHE_DIR)
+        return _backend
+
+# Une panne du serveur ne doit pas empêcher le calcul: l'entrée est traitée comme absente
+def _safe(operation, *args, default=None):
+    try:
+        return operation(*args)
+    except Exception:
+        increment("tafahom_cache_backend_errors_total", backend=get_backend().name)
+        return default
+
+def cache_set(namespace, parts, value):
+    if value is not None:
+        _safe(get_backend().set, cache_key(namespace, parts), json.dumps(value, ensure_ascii=False), NAMESPACES[namespace]["ttl"])
+
+# Fonction pour lire une entrée ou la calculer: une seule réplique calcule une entrée absente (verrou NX), les autres
+# attendent son résultat; si elle échoue ou dépasse WAIT_TIMEOUT, une réplique en attente reprend le calcul.
+# Renvoie (valeur, True si elle vient du cache); les valeurs None ne sont pas conservées
+def get_or_compute(namespace, parts, compute):
+    backend = get_backend()
+    key = cache_key(namespace, parts)
+    lock_key, token = f"{key}:verrou", uuid.uuid4().hex
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    waited = False
+
+    with span(f"cache {namespace}", **{"tafahom.cache_backend": backend.name}) as current:
+        while True:
+            value = _safe(backend.get, key)
+            if value is not None:
+                increment("tafahom_cache_lookups_total", namespace=namespace, result="attente" if waited else "hit")
+                current.set(**{"tafahom.cache_hit": True})
+                return json.loads(value), True
+            if time.monotonic() >= deadline or _safe(backend.add, lock_key, token, LOCK_SECONDS, default=True):
+                break
+            # Une autre réplique calcule cette entrée
+            waited = True
+            time.sleep(POLL_INTERVAL)
+
+        increment("tafahom_cache_lookups_total", namespace=namespace, result="miss")
+        current.set(**{"tafahom.cache_hit": False})
+        try:
+            value = compute()
+            cache_set(namespace, parts, value)
+        finally:
+            _safe(backend.release, lock_key, token)
+        increment("tafahom_cache_computes_total", namespace=namespace)
+        return value, False
+
+# Fonction pour charger un profil validé, partagé entre répliques (clé: conversation, taille et date du fichier);
+# None si le profil n'existe pas
+def cached_profile(conversation_id):
+    path = profile_path(conversation_id)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    def load():
+        data = read_json(path)
+        return validated(Profile, data) if data is not None else None
+
+    return get_or_compute("profile", [conversation_id, stat.st_size, stat.st_mtime_ns], load)[0]
+
+# Fonction pour résumer l'efficacité du cache dans ce processus (par espace: lectures trouvées, attentes, calculs)
+def cache_report():
+    report = {}
+    for namespace in NAMESPACES:
+        hits = counter_value("tafahom_cache_lookups_total", namespace=namespace, result="hit")
+        waits = counter_value("tafahom_cache_lookups_total", namespace=namespace, result="attente")
+        misses = counter_value("tafahom_cache_lookups_total", namespace=namespace, result="miss")
+        total = hits + waits + misses
+        report[namespace] = {
+            "hits": hits, "waits": waits, "misses": misses,
+            "computes": counter_value("tafahom_cache_computes_total", namespace=namespace),
+            "hit_rate": (hits + waits) / total if total else None
+        }
+    return report
+
+
+# Démonstration de la protection contre les calculs simultanés: plusieurs répliques (processus) demandent les mêmes
+# entrées absentes en même temps, chaque calcul dure une seconde et laisse une trace; une seule trace par entrée attendue
+def _replica(args):
+    marks = os.path.join(args.marks, f"{os.getpid()}")
+    results = []
+
+    def compute(entry):
+        time.sleep(1.0)
+        with open(f"{marks}-{entry}", "w", encoding="utf-8") as f:
+            f.write(str(entry))
+        return {"entrée": entry, "calculée par": os.getpid()}
+
+    for entry in range(args.entries):
+        value, cached = get_or_compute("llm", ["démonstration", args.run, entry], lambda: compute(entry))
+        results.append(value["calculée par"])
+    print(json.dumps({"backend": get_backend().name, "computed_by": results}))
+
+def stampede_demo(args):
+    import subprocess
+    import tempfile
+
+    server = None
+    env = dict(os.environ)
+    if args.standin:
+        from tafahom_mock_redis import start_mock_redis
+        server = start_mock_redis()
+        env["TAFAHOM_CACHE_URL"] = f"redis://127.0.0.1:{server.server_port}/0"
+
+    with tempfile.TemporaryDirectory(prefix="tafahom_cache_") as marks:
+        command = [sys.executable, os.path.abspath(__file__), "--replica", "--marks", marks, "--entries", str(args.entries), "--run", uuid.uuid4().hex]
+        start = time.perf_counter()
+        replicas = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True) for _ in range(args.replicas)]
+        outputs = [json.loads(replica.communicate()[0]) for replica in replicas]
+        elapsed = time.perf_counter() - start
+        computes = len(os.listdir(marks))
+
+    backends = sorted({output["backend"] for output in outputs})
+    print(f"{args.replicas} répliques, {args.entries} entrées absentes demandées en même temps (cache: {', '.join(backends)})")
+    print(f"  calculs: {computes} (attendu: {args.entries}), durée totale {elapsed:.1f} s")
+    for entry in range(args.entries):
+        producers = {output["computed_by"][entry] for output in outputs}
+        print(f"  entrée {entry}: même valeur dans toutes les répliques: {'oui' if len(producers) == 1 else 'non'}")
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache partagé entre répliques (réponses du modèle, profils, questions)")
+    parser.add_argument("--clear", nargs="?", const="", metavar="ESPACE", help="Supprimer les entrées (d'un espace, ou toutes)")
+    parser.add_argument("--stampede", action="store_true", help="Démontrer qu'une entrée absente n'est calculée qu'une fois")
+    parser.add_argument("--standin", action="store_true", help="Avec --stampede: serveur compatible Redis local (tafahom_mock_redis)")
+    parser.add_argument("--replicas", type=int, default=4)
+    parser.add_argument("--entries", type=int, default=3)
+    parser.add_argument("--replica", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--marks", help=argparse.SUPPRESS)
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.replica:
+        _replica(args)
+    elif args.stampede:
+        stampede_demo(args)
+    elif args.clear is not None:
+        prefix = f"{KEY_PREFIX}:v{CACHE_VERSION}:{args.clear}:" if args.clear else f"{KEY_PREFIX}:"
+        print(f"{get_backend().clear(prefix)} entrées supprimées ({get_backend().name})")
+    else:
+        backend = get_backend()
+        print(f"Cache partagé: {backend.name}" + (f" ({CACHE_URL})" if backend.name == "redis" else f" ({CACHE_DIR})"))
+        for namespace, settings in NAMESPACES.items():
+            print(f"  {namespace:<10} version {settings['version']}, durée de vie {settings['ttl'] / 3600:g} h")
@@ -0,0 +1,160 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Générateur de charge: N sessions simultanées du portail (introduction -> conversation -> profil)
+# exécutées dans un même processus, comme un worker Streamlit, contre le LLM simulé local.
+
+# Réponses scriptées de l'artiste aux 10 questions du portail
+SCRIPTED_ANSWERS = [
+    "Je joue du oud depuis l'enfance, mon oncle m'a appris à l'oreille pendant les fêtes de famille.",
+    "J'ai des enregistrements sur mon téléphone et quelques vidéos de concerts publiées par des amis.",
+    "Pas de diplôme, mais j'ai été invité deux fois au festival de la médina.",
+    "Dans mon quartier, on m'appelle pour les mariages et les fêtes religieuses.",
+    "J'aimerais ouvrir un petit atelier pour enseigner le oud aux jeunes du quartier.",
+    "Une troupe de musiciens m'accompagne et l'association culturelle me prête une salle.",
+    "Les jeunes viennent m'écouter et certains ont commencé à apprendre grâce à moi.",
+    "Oui, je continue même quand je ne gagne rien, la musique c'est ma vie.",
+    "Je gagne un peu d'argent avec les mariages, surtout l'été.",
+    "Je dirais que mon projet transmet un patrimoine et qu'il a déjà un public fidèle."
+]
+
+# Fonction pour lire la mémoire résidente du processus (Mo)
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Fonction pour calculer un percentile (méthode du rang le plus proche)
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+# AppTest installe un runtime global, un cache des pages et un cache de bytecode propres à chaque exécution,
+# ce qui empêche plusieurs sessions de tourner en parallèle: on les partage, comme dans un worker Streamlit unique
+def install_shared_runtime(app_file):
+    from unittest.mock import MagicMock
+
+    from streamlit import source_util
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    shared_runtime = MagicMock(spec=Runtime)
+    shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: shared_runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    pages = source_util.get_pages(app_file)
+    source_util.get_pages = lambda main_script_path: pages
+
+    shared_script_cache = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared_script_cache, script_path)
+
+# Fonction pour simuler une session complète d'artiste et mesurer chaque tour
+def run_session(app_file, latencies, errors, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    try:
+        app = AppTest.from_file(app_file, default_timeout=timeout).run()
+        [button for button in app.button if button.label == "Commencer la conversation"][0].click().run()
+
+        answer_index = 0
+        while len(app.chat_input):
+            start = time.perf_counter()
+            app.chat_input[0].set_value(SCRIPTED_ANSWERS[answer_index % len(SCRIPTED_ANSWERS)]).run()
+            latencies.append(time.perf_counter() - start)
+            answer_index += 1
+
+        start = time.perf_counter()
+        [button for button in app.button if button.label == "Générer mon profil TAFAHOM"][0].click().run()
+        latencies.append(time.perf_counter() - start)
+
+        if app.exception or app.session_state.current_step != "profile":
+            errors.append(app.exception[0].value if app.exception else "profil non généré")
+    except Exception as e:
+        errors.append(str(e))
+
+# Fonction pour exécuter un palier de charge avec un nombre donné de sessions simultanées
+def run_level(app_file, concurrency, timeout):
+    latencies, errors = [], []
+    rss_before = current_rss_mb()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+
+    threads = [threading.Thread(target=run_session, args=(app_file, latencies, errors, timeout)) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "turns": len(latencies),
+        "errors": len(errors),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.mean(latencies) if latencies else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "cpu_per_session": (time.process_time() - cpu_before) / concurrency,
+        "rss_per_session": max(0.0, current_rss_mb() - rss_before) / concurrency,
+        "rss_total": current_rss_mb(),
+        "first_error": errors[0] if errors else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge du portail TAFAHOM contre un LLM simulé")
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "Interface_client.py"))
+    parser.add_argument("--levels", default="1,2,4,8,16,32", help="Paliers de sessions simultanées")
+    parser.add_argument("--slo-p95", type=float, default=2.0, help="Objectif de latence p95 par tour (s)")
+    parser.add_argument("--mock-latency", type=float, default=0.3, help="Latence fixe du LLM simulé (s)")
+    parser.add_argument("--mock-jitter", type=float, default=0.2, help="Latence aléatoire supplémentaire (s)")
+    parser.add_argument("--timeout", type=float, default=120, help="Délai maximal d'un rerun (s)")
+    args = parser.parse_args()
+
+    # Les sessions partagent ce processus: configurer l'environnement avant le premier import des modules TAFAHOM
+    from tafahom_mock_llm import start_mock_server
+    server = start_mock_server(latency=args.mock_latency, jitter=args.mock_jitter)
+    os.environ["TOGETHER_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.setdefault("TOGETHER_API_KEY", "mock")
+    os.environ.setdefault("TAFAHOM_DATA_DIR", tempfile.mkdtemp(prefix="tafahom_charge_"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.app)))
+    install_shared_runtime(os.path.abspath(args.app))
+
+    print(f"LLM simulé: {os.environ['TOGETHER_BASE_URL']} (latence {args.mock_latency}+{args.mock_jitter} s), données: {os.environ['TAFAHOM_DATA_DIR']}")
+    print(f"{'sessions':>8} {'tours':>6} {'erreurs':>7} {'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'tours/s':>8} {'CPU/session (s)':>16} {'RSS/session (Mo)':>17}")
+
+    breaking_level = None
+    for concurrency in [int(level) for level in args.levels.split(",")]:
+        result = run_level(args.app, concurrency, args.timeout)
+        print(f"{result['concurrency']:>8} {result['turns']:>6} {result['errors']:>7} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['p99']:>8.2f} {result['throughput']:>8.1f} {result['cpu_per_session']:>16.2f} {result['rss_per_session']:>17.1f}")
+        if result["first_error"]:
+            print(f"         première erreur: {result['first_error']}")
+        if result["p95"] > args.slo_p95 or result["errors"]:
+            breaking_level = concurrency
+            break
+
+    server.shutdown()
+    if breaking_level:
+        print(f"SLO p95 <= {args.slo_p95} s dépassé (ou erreurs) à partir de {breaking_level} sessions simultanées.")
+    else:
+        print(f"SLO p95 <= {args.slo_p95} s respecté sur tous les paliers.")
+
+
+if __name__ == "__main__":
+    main()
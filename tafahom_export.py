@@ -0,0 +1,144 @@
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from datetime import date, datetime
+
+from tafahom_stockage import data_path, enriched_profile_path, evaluation_path, list_profile_ids, profile_path, read_json
+
+# Export groupé des profils et évaluations d'une période (CSV, NDJSON ou ZIP): les profils sont lus un à un
+# depuis le stockage et écrits au fil de l'eau, la mémoire occupée ne dépend pas du nombre de profils
+
+# Formats disponibles: type MIME et extension
+FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "ndjson": ("application/x-ndjson", ".ndjson"),
+    "zip": ("application/zip", ".zip")
+}
+
+# Colonnes du CSV: une ligne par critère, comme l'export CSV d'un profil, précédée du document d'origine
+CSV_COLUMNS = ["Conversation", "Document", "Critère", "Score", "Commentaire"]
+
+# Fonction pour lire la date de création d'une conversation depuis son identifiant (None si ancien format)
+def conversation_date(conversation_id):
+    try:
+        return datetime.strptime(conversation_id[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+# Fonction pour sélectionner les conversations d'une période (bornes incluses, None: pas de borne)
+def select_ids(since=None, until=None):
+    if since is None and until is None:
+        return list_profile_ids()
+    selected = []
+    for conversation_id in list_profile_ids():
+        created = conversation_date(conversation_id)
+        if created is None:
+            continue
+        if (since is None or created >= since) and (until is None or created <= until):
+            selected.append(conversation_id)
+    return selected
+
+# Générateur des profils et évaluations (une conversation en mémoire à la fois), avec suivi de progression
+def iter_records(conversation_ids, progress=None):
+    for done, conversation_id in enumerate(conversation_ids, start=1):
+        profile_data = read_json(profile_path(conversation_id))
+        if profile_data is not None:
+            yield conversation_id, profile_data, read_json(evaluation_path(conversation_id))
+        if progress:
+            progress(done, len(conversation_ids), conversation_id)
+
+# Générateur du CSV: l'en-tête puis les lignes des critères de chaque profil et de son évaluation
+def csv_chunks(records):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for conversation_id, profile_data, evaluation_data in records:
+        documents = [("profil", profile_data.get("profile", {}))]
+        if evaluation_data:
+            documents.append(("évaluation", evaluation_data.get("evaluation", {})))
+        for document, section in documents:
+            for criterion in section.get("criteria", []):
+                writer.writerow([conversation_id, document, criterion.get("name"), criterion.get("score"), criterion.get("comment", "")])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+# Générateur NDJSON: une ligne par conversation (profil et évaluation)
+def ndjson_chunks(records):
+    for conversation_id, profile_data, evaluation_data in records:
+        record = {"conversation_id": conversation_id, "profile": profile_data.get("profile"), "evaluation": (evaluation_data or {}).get("evaluation")}
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+# Fonction pour écrire une archive ZIP des fichiers de chaque conversation (copiés tels quels, sans les charger)
+def write_zip(conversation_ids, fileobj, progress=None):
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for done, conversation_id in enumerate(conversation_ids, start=1):
+            for path in (profile_path(conversation_id), evaluation_path(conversation_id), enriched_profile_path(conversation_id)):
+                if os.path.exists(path):
+                    with open(path, "rb") as source, archive.open(f"{conversation_id}/{os.path.basename(path)}", "w") as target:
+                        shutil.copyfileobj(source, target)
+            if progress:
+                progress(done, len(conversation_ids), conversation_id)
+
+# Fonction pour exporter une période dans un fichier binaire ouvert; renvoie le nombre de conversations exportées
+def export_bulk(fileobj, format="csv", since=None, until=None, progress=None):
+    if format not in FORMATS:
+        raise ValueError(f"Format d'export inconnu: {format}")
+    conversation_ids = select_ids(since, until)
+    if format == "zip":
+        write_zip(conversation_ids, fileobj, progress)
+    else:
+        chunks = csv_chunks if format == "csv" else ndjson_chunks
+        for chunk in chunks(iter_records(conversation_ids, progress)):
+            fileobj.write(chunk.encode("utf-8"))
+    return len(conversation_ids)
+
+# Fonction pour exporter une période dans le répertoire des exports (écriture atomique); renvoie (chemin, nombre)
+def export_to_file(format="csv", since=None, until=None, progress=None):
+    period = f"{since or 'debut'}_{until or 'fin'}".replace("-", "")
+    path = data_path("exports", f"tafahom_export_{period}{FORMATS[format][1]}")
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            count = export_bulk(f, format, since, until, progress)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export groupé des profils et évaluations TAFAHOM")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--from", dest="since", type=date.fromisoformat, help="Première date incluse (AAAA-MM-JJ)")
+    parser.add_argument("--to", dest="until", type=date.fromisoformat, help="Dernière date incluse (AAAA-MM-JJ)")
+    parser.add_argument("-o", "--output", help="Fichier de sortie (- pour la sortie standard), répertoire des exports par défaut")
+    args = parser.parse_args()
+
+    def progress(done, total, conversation_id):
+        if done == total or done % 100 == 0:
+            print(f"\r{done}/{total} conversations exportées", end="\n" if done == total else "", file=sys.stderr, flush=True)
+
+    if args.output == "-":
+        count = export_bulk(sys.stdout.buffer, args.format, args.since, args.until, progress)
+        path = "sortie standard"
+    elif args.output:
+        with open(args.output, "wb") as f:
+            count = export_bulk(f, args.format, args.since, args.until, progress)
+        path = args.output
+    else:
+        path, count = export_to_file(args.format, args.since, args.until, progress)
+    print(f"{count} conversations exportées ({args.format}) vers {path}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import time
+from contextlib import closing
+
+import numpy as np
+
+from tafahom_metriques import counter_value, increment, set_gauge
+from tafahom_similarite import CRITERIA, SCORE_CENTER, hashed_ngram_counts, profile_text, score_vector
+from tafahom_stockage import connect_database, data_path
+
+# Cache des questions contextualisées entre profils quasi identiques (même programme, même discipline, scores
+# et commentaires proches): les questions reformulées d'un profil déjà contextualisé servent de gabarit,
+# seuls les contextes propres au nouveau profil sont régénérés. Vecteurs locaux (scores et n-grammes hachés),
+# sans appel réseau.
+CACHE_FILE = data_path("tafahom_gabarits.sqlite")
+
+# Similarité minimale (0-1) pour réutiliser le gabarit d'un profil déjà contextualisé
+THRESHOLD = float(os.getenv("TAFAHOM_SCAFFOLD_THRESHOLD", "0.92"))
+
+# Poids du texte (commentaires et synthèse) face aux scores dans la similarité
+TEXT_WEIGHT = float(os.getenv("TAFAHOM_SCAFFOLD_TEXT_WEIGHT", "0.5"))
+
+# Nombre maximal de gabarits conservés (les moins récemment utilisés sont évincés au-delà)
+MAX_ENTRIES = int(os.getenv("TAFAHOM_SCAFFOLD_MAX_ENTRIES", "500"))
+
+# Dimension des vecteurs de n-grammes hachés (plus grande que celle de l'index: moins de collisions entre bigrammes)
+TEXT_DIM = 1024
+
+# Fonction pour ouvrir la base et créer la table au besoin
+def _connect(cache_file=CACHE_FILE):
+    return connect_database(cache_file, schema=(
+        """
+            CREATE TABLE IF NOT EXISTS scaffolds (
+                conversation_id TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                questions TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS scaffolds_version ON scaffolds (version)",
+    ))
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Fonction pour calculer le vecteur d'un profil: scores centrés puis n-grammes du texte, chaque partie normée
+def profile_vector(profile_data):
+    profile = profile_data.get("profile", {})
+    scores = np.array(score_vector(profile), dtype=np.float32) - SCORE_CENTER
+    text = np.log1p(hashed_ngram_counts(profile_text(profile), TEXT_DIM, n=2))
+    return np.concatenate([_unit(scores), _unit(text)]).astype(np.float32)
+
+# Fonction pour calculer la similarité d'un vecteur avec une matrice de vecteurs (moyenne pondérée des deux cosinus)
+def _similarities(matrix, vector, text_weight=TEXT_WEIGHT):
+    split = len(CRITERIA)
+    return (1 - text_weight) * (matrix[:, :split] @ vector[:split]) + text_weight * (matrix[:, split:] @ vector[split:])
+
+def _publish(connection):
+    set_gauge("tafahom_scaffold_entries", connection.execute("SELECT COUNT(*) FROM scaffolds").fetchone()[0])
+
+# Fonction pour trouver le gabarit du profil le plus proche (même version des questions), au-dessus du seuil;
+# renvoie {"conversation_id", "similarity", "questions"} ou None
+def find_scaffold(profile_data, version, threshold=THRESHOLD, cache_file=CACHE_FILE):
+    vector = profile_vector(profile_data)
+    with closing(_connect(cache_file)) as connection, connection:
+        rows = connection.execute("SELECT conversation_id, vector FROM scaffolds WHERE version = ?", (version,)).fetchall()
+        best = None
+        if rows:
+            matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            if matrix.shape[1] == len(vector):
+                similarity = _similarities(matrix, vector)
+                position = int(np.argmax(similarity))
+                if similarity[position] >= threshold:
+                    best = (rows[position][0], float(similarity[position]))
+        if best is None:
+            increment("tafahom_scaffold_lookups_total", result="miss")
+            return None
+        connection.execute("UPDATE scaffolds SET last_used_at = ?, hits = hits + 1 WHERE conversation_id = ?", (time.time(), best[0]))
+        questions = connection.execute("SELECT questions FROM scaffolds WHERE conversation_id = ?", (best[0],)).fetchone()[0]
+    increment("tafahom_scaffold_lookups_total", result="hit")
+    return {"conversation_id": best[0], "similarity": best[1], "questions": json.loads(questions)}
+
+# Fonction pour enregistrer le gabarit (critères et questions reformulées, sans les contextes) d'un profil
+# contextualisé, puis évincer les gabarits les moins récemment utilisés au-delà de MAX_ENTRIES
+def store_scaffold(conversation_id, profile_data, version, questions, max_entries=MAX_ENTRIES, cache_file=CACHE_FILE):
+    scaffold = [{"criterion": item.get("criterion"), "question": item.get("question")} for item in questions.get("questions", [])]
+    now = time.time()
+    with closing(_connect(cache_file)) as connection, connection:
+        connection.execute(
+            """
+            INSERT INTO scaffolds (conversation_id, version, vector, questions, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                version = excluded.version, vector = excluded.vector, questions = excluded.questions, last_used_at = excluded.last_used_at
+            """,
+            (conversation_id, version, profile_vector(profile_data).tobytes(), json.dumps(scaffold, ensure_ascii=False), now, now)
+        )
+        evicted = connection.execute(
+            "DELETE FROM scaffolds WHERE conversation_id IN (SELECT conversation_id FROM scaffolds ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+            (max_entries,)
+        ).rowcount
+        if evicted:
+            increment("tafahom_scaffold_evictions_total", evicted)
+        _publish(connection)
+
+# Fonction pour résumer l'efficacité du cache: taux de réussite du processus, gabarits et réutilisations en base
+def cache_stats(cache_file=CACHE_FILE):
+    hits = counter_value("tafahom_scaffold_lookups_total", result="hit")
+    misses = counter_value("tafahom_scaffold_lookups_total", result="miss")
+    with closing(_connect(cache_file)) as connection:
+        entries, reuses = connection.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM scaffolds").fetchone()
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else None,
+        "entries": entries,
+        "reuses": reuses
+    }
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--clear"]:
+        with closing(_connect()) as connection, connection:
+            print(f"{connection.execute('DELETE FROM scaffolds').rowcount} gabarits supprimés")
+    else:
+        stats = cache_stats()
+        print(f"{stats['entries']} gabarits (maximum {MAX_ENTRIES}, seuil {THRESHOLD}, poids du texte {TEXT_WEIGHT}), "
+              f"{stats['reuses']} réutilisations")
+        with closing(_connect()) as connection:
+            for conversation_id, hits, last_used_at in connection.execute(
+                "SELECT conversation_id, hits, last_used_at FROM scaffolds ORDER BY hits DESC, last_used_at DESC LIMIT 20"
+            ):
+                print(f"{conversation_id}  {hits:>4} réutilisations  {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used_at))}")
@@ -0,0 +1,177 @@
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from datetime import datetime
+
+from tafahom_stockage import DATA_DIR, append_text, data_path, file_lock
+
+try:
+    import zstandard
+except ImportError:  # zstd optionnel: gzip par défaut
+    zstandard = None
+
+# Journal d'événements des conversations du portail: un répertoire par conversation, des segments JSONL
+# en ajout seul (un événement par ligne), tournés par jour ou par taille puis compressés
+
+# Taille maximale d'un segment actif avant rotation (octets)
+MAX_SEGMENT_BYTES = int(os.getenv("TAFAHOM_JOURNAL_SEGMENT_KB", "1024")) * 1024
+
+# Compression des segments fermés: "gzip" ou "zstd" (si le module zstandard est installé)
+COMPRESSION = os.getenv("TAFAHOM_JOURNAL_COMPRESSION", "gzip")
+
+# Extension des segments fermés selon la compression
+EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+# Fonction pour obtenir le répertoire du journal d'une conversation (sans le créer)
+def journal_dir(conversation_id):
+    return os.path.join(DATA_DIR, "journal", str(conversation_id))
+
+# Segment: events-<jour>-<numéro>.jsonl (actif) ou .jsonl.gz / .jsonl.zst (fermé)
+SEGMENT_PATTERN = re.compile(r"events-(\d{8})-(\d+)\.jsonl(\.gz|\.zst)?$")
+
+# Fonction pour lister les segments d'une conversation dans l'ordre
+def list_segments(conversation_id):
+    directory = journal_dir(conversation_id)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if SEGMENT_PATTERN.match(name))
+
+# Fonction pour compresser un segment fermé (fichier compressé écrit à côté puis renommé, original supprimé)
+def _compress_segment(path):
+    method = "zstd" if COMPRESSION == "zstd" and zstandard else "gzip"
+    target = path[:-len(".jsonl")] + EXTENSIONS[method]
+    temp_path = f"{target}.tmp"
+    with open(path, "rb") as source, open(temp_path, "wb") as raw:
+        if method == "zstd":
+            with zstandard.ZstdCompressor().stream_writer(raw) as compressed:
+                shutil.copyfileobj(source, compressed)
+        else:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as compressed:
+                shutil.copyfileobj(source, compressed)
+    os.replace(temp_path, target)
+    os.remove(path)
+    return target
+
+# Fonction pour obtenir le segment actif, en fermant (et compressant) le précédent s'il a changé de jour ou est plein
+def _active_segment(conversation_id, incoming_bytes):
+    today = datetime.now().strftime("%Y%m%d")
+    active = [path for path in list_segments(conversation_id) if path.endswith(".jsonl")]
+    if active:
+        path = active[-1]
+        day, number, _ = SEGMENT_PATTERN.match(os.path.basename(path)).groups()
+        if day == today and os.path.getsize(path) + incoming_bytes <= MAX_SEGMENT_BYTES:
+            return path
+        _compress_segment(path)
+        number = int(number) + 1 if day == today else 1
+    else:
+        closed = list_segments(conversation_id)
+        last = SEGMENT_PATTERN.match(os.path.basename(closed[-1])).groups() if closed else None
+        number = int(last[1]) + 1 if last and last[0] == today else 1
+    return data_path("journal", str(conversation_id), f"events-{today}-{number:04d}.jsonl")
+
+# Fonction pour ajouter un événement au journal (le répertoire n'est créé qu'au premier événement)
+def log_event(conversation_id, event, **fields):
+    record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "event": event}
+    record.update({key: value for key, value in fields.items() if value is not None})
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+
+    os.makedirs(journal_dir(conversation_id), exist_ok=True)
+    # La rotation est faite sous verrou: un seul écrivain ferme et compresse un segment
+    with file_lock(os.path.join(journal_dir(conversation_id), "journal")):
+        append_text(_active_segment(conversation_id, len(line.encode("utf-8"))), line)
+    return record
+
+# Fonction pour ouvrir un segment, compressé ou non, en lecture texte
+def _open_segment(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"Le module zstandard est nécessaire pour lire {path}")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+# Fonction pour lire tous les événements d'une conversation, segments compressés compris
+def read_events(conversation_id, event=None):
+    for path in list_segments(conversation_id):
+        with _open_segment(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if event is None or record["event"] == event:
+                    yield record
+
+# Fonction pour reconstituer la transcription lisible (rôle: contenu) d'une conversation
+def render_transcript(conversation_id):
+    lines = ["Conversation TAFAHOM-Portail - Artiste:", ""]
+    for record in read_events(conversation_id, event="message"):
+        lines.append(f"{record['role']}: {record['content']}")
+        lines.append("")
+    return "\n".join(lines)
+
+# Fonction pour exporter le journal complet d'une conversation (JSONL décompressé)
+def export_events(conversation_id):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in read_events(conversation_id))
+
+
+# Fonction de rétention: supprime les transcriptions orphelines vides (anciens fichiers texte sans aucun tour,
+# répertoires de journal sans segment) et compresse les segments actifs inactifs depuis plus d'un jour
+def retention(directory=DATA_DIR, idle_seconds=86400, dry_run=False):
+    report = {"empty_transcripts": 0, "empty_journals": 0, "compressed_segments": 0}
+    now = time.time()
+
+    for path in glob.glob(os.path.join(directory, "tafahom_portail_*.txt")):
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read().partition("\n\n")[2]
+        if not content.strip() and now - os.path.getmtime(path) > idle_seconds:
+            report["empty_transcripts"] += 1
+            if not dry_run:
+                os.remove(path)
+
+    for conversation_dir in glob.glob(os.path.join(directory, "journal", "*")):
+        segments = [os.path.join(conversation_dir, name) for name in os.listdir(conversation_dir) if SEGMENT_PATTERN.match(name)]
+        if not segments:
+            report["empty_journals"] += 1
+            if not dry_run:
+                shutil.rmtree(conversation_dir, ignore_errors=True)
+            continue
+        for path in segments:
+            if path.endswith(".jsonl") and now - os.path.getmtime(path) > idle_seconds:
+                report["compressed_segments"] += 1
+                if not dry_run:
+                    with file_lock(os.path.join(conversation_dir, "journal")):
+                        _compress_segment(path)
+    return report
+
+# Fonction pour convertir une ancienne transcription texte en journal (au mieux: le format texte est ambigu)
+def migrate_transcript(path):
+    conversation_id = os.path.basename(path)[len("tafahom_portail_"):-len(".txt")]
+    if list_segments(conversation_id):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read().partition("\n\n")[2]
+    turns = re.split(r"(?:^|\n\n)(user|assistant): ", content)[1:]
+    for turn, (role, text) in enumerate(zip(turns[::2], turns[1::2])):
+        log_event(conversation_id, "message", turn=turn, role=role, content=text.rstrip("\n"), migrated=True)
+    return conversation_id
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--retention"]:
+        report = retention(dry_run="--dry-run" in sys.argv[2:])
+        print(f"Transcriptions vides supprimées: {report['empty_transcripts']}, journaux vides: {report['empty_journals']}, "
+              f"segments compressés: {report['compressed_segments']}")
+    elif sys.argv[1:2] == ["--migrate"]:
+        migrated = [migrate_transcript(path) for path in glob.glob(os.path.join(DATA_DIR, "tafahom_portail_*.txt"))]
+        print(f"{len([conversation_id for conversation_id in migrated if conversation_id])} transcriptions converties en journaux")
+    elif len(sys.argv) == 2:
+        print(render_transcript(sys.argv[1]))
+    else:
+        print("Usage: python tafahom_journal.py <conversation_id> | --retention [--dry-run] | --migrate")
@@ -0,0 +1,746 @@
+import builtins
+import gzip
+import hashlib
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+from tafahom_cache import get_or_compute
+from tafahom_metriques import counter_value, increment, observe, percentile, set_gauge
+from tafahom_prompts import count_tokens
+from tafahom_quotas import current_priority, estimate_call, quotas_enabled, release, reserve, settle
+from tafahom_stockage import append_bytes, data_path
+from tafahom_traces import span
+
+# Mode des cassettes LLM: "off" (appels réels), "record" (appels réels enregistrés), "replay" (réponses rejouées)
+CASSETTE_MODE = os.getenv("TAFAHOM_LLM_CASSETTE", "off")
+
+# Vitesse de relecture: "instant" ou "recorded" (durées d'origine respectées)
+REPLAY_SPEED = os.getenv("TAFAHOM_LLM_REPLAY_SPEED", "instant")
+
+# Cassette imposée pour la relecture (sinon celle de la conversation courante)
+CASSETTE_FILE = os.getenv("TAFAHOM_LLM_CASSETTE_FILE")
+
+# Nombre maximal de requêtes LLM simultanées pour tout le processus, et pour une même conversation
+MAX_INFLIGHT = int(os.getenv("TAFAHOM_LLM_MAX_INFLIGHT", "8"))
+MAX_INFLIGHT_PER_SESSION = int(os.getenv("TAFAHOM_LLM_MAX_INFLIGHT_SESSION", "1"))
+
+# Longueur maximale de la file d'attente: au-delà, la demande est refusée immédiatement
+MAX_QUEUE = int(os.getenv("TAFAHOM_LLM_MAX_QUEUE", "16"))
+
+# Attente maximale d'une place libre (s) avant de refuser la demande
+ADMISSION_TIMEOUT = float(os.getenv("TAFAHOM_LLM_ADMISSION_TIMEOUT", "30"))
+
+# Requêtes de couverture (hedging) pour les sites d'appel qui le demandent: "on" ou "off"
+HEDGING = os.getenv("TAFAHOM_LLM_HEDGE", "off")
+
+# Percentile de la latence du premier token au-delà duquel une seconde requête identique est envoyée
+HEDGE_PERCENTILE = float(os.getenv("TAFAHOM_LLM_HEDGE_PERCENTILE", "95"))
+
+# Délai de couverture avant d'avoir assez d'observations, et délai minimal (s)
+HEDGE_DEFAULT_DELAY = float(os.getenv("TAFAHOM_LLM_HEDGE_DELAY", "3"))
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_OBSERVATIONS = 20
+
+# Budget: part maximale de requêtes supplémentaires par rapport aux requêtes d'un site d'appel
+HEDGE_BUDGET = float(os.getenv("TAFAHOM_LLM_HEDGE_BUDGET", "0.1"))
+
+# Part des requêtes principales battues qui vont quand même à leur terme (réponse ignorée), pour mesurer
+# leur latence réelle et donc le gain de p99 (les autres sont annulées dès que la couverture l'emporte)
+HEDGE_SHADOW_SAMPLE = 0.1
+
+# Sites d'appel dont les réponses sont partagées entre répliques (générations structurées: une requête identique,
+# relancée sur une autre réplique, reçoit la même réponse); les tours de l'entretien ne sont pas partagés
+SHARED_CALL_SITES = os.getenv(
+    "TAFAHOM_CACHE_LLM_CALL_SITES",
+    "generate_profile,contextualize_questions,contextualize_contexts,generate_final_evaluation,"
+    "reevaluate_criteria,refresh_synthesis,generate_updated_artist_profile"
+).split(",")
+
+# Disjoncteur: nombre d'échecs consécutifs du service avant ouverture, et durée d'ouverture (s) avant un appel d'essai
+BREAKER_FAILURES = int(os.getenv("TAFAHOM_LLM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("TAFAHOM_LLM_BREAKER_COOLDOWN", "30"))
+
+# Erreur levée quand une cassette ne contient pas la réponse demandée
+class CassetteMissError(Exception):
+    pass
+
+# Erreur levée quand le service est saturé (file d'attente pleine ou attente trop longue), ou sans position
+# quand une autre demande de la même conversation est déjà en cours
+class LLMBusyError(Exception):
+    def __init__(self, position=None):
+        self.position = position
+        if position is None:
+            message = "Une demande est déjà en cours pour cette conversation. Veuillez réessayer quand elle sera terminée."
+        else:
+            message = (f"Le service est très sollicité (votre demande est en position {position} dans la file d'attente). "
+                       "Veuillez réessayer dans quelques instants.")
+        super().__init__(message)
+
+# Erreur levée sans attendre quand le disjoncteur est ouvert (service en panne)
+class LLMUnavailableError(Exception):
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super().__init__(
+            f"Le service de génération est momentanément indisponible (nouvel essai dans {math.ceil(retry_in)} s)."
+        )
+
+# Erreur levée quand le quota du service ne permet pas l'appel: sans attendre pour les travaux d'arrière-plan,
+# après ADMISSION_TIMEOUT au plus pour les échanges interactifs
+class LLMQuotaError(Exception):
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super().__init__(
+            f"Le quota du service de génération est atteint (nouvel essai dans {math.ceil(retry_in)} s)."
+        )
+
+# Erreur rejouée depuis une cassette quand son type d'origine (erreur du client du service) ne peut pas être recréé:
+# même message et même statut, donc même verdict du disjoncteur et de la file d'envoi
+class ReplayedLLMError(Exception):
+    def __init__(self, error_type, message, status_code=None):
+        self.error_type = error_type
+        self.status_code = status_code
+        super().__init__(message)
+
+# Fonction pour calculer la clé d'une requête (site d'appel + modèle + messages + paramètres)
+def request_key(call_site, messages, params):
+    payload = json.dumps([call_site, messages, params], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Fonction pour obtenir le chemin de la cassette d'une conversation
+def cassette_path(conversation_id):
+    if CASSETTE_FILE:
+        return CASSETTE_FILE
+    return data_path("cassettes", f"{conversation_id or 'sans_conversation'}.jsonl.gz")
+
+# Cassette chargée en mémoire pour la relecture (par clé exacte, puis dans l'ordre par site d'appel pour une requête
+# absente de la cassette: une requête enregistrée ne reçoit jamais la réponse d'un autre tour)
+class Cassette:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.by_key = defaultdict(deque)
+        self.by_site = defaultdict(deque)
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.by_key[entry["key"]].append(entry)
+                self.by_site[entry["call_site"]].append(entry)
+
+    # Une entrée est partagée entre les deux files: une fois rejouée, elle est ignorée dans l'autre
+    @staticmethod
+    def _next_unused(entries):
+        while entries:
+            entry = entries.popleft()
+            if not entry.get("used"):
+                entry["used"] = True
+                return entry
+        return None
+
+    def take(self, call_site, key):
+        with self.lock:
+            if key in self.by_key:
+                entry = self._next_unused(self.by_key[key])
+            else:
+                entry = self._next_unused(self.by_site.get(call_site))
+            if entry is None:
+                raise CassetteMissError(f"Aucune réponse enregistrée pour {call_site}")
+            return entry
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+def _load_cassette(path):
+    with _cassettes_lock:
+        if path not in _cassettes:
+            if not os.path.exists(path):
+                raise CassetteMissError(f"Cassette introuvable: {path}")
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path]
+
+# Sémaphore global avec file d'attente ordonnée: la position de chaque demande en attente est connue
+class Admission:
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.inflight = 0
+        self.waiting = deque()
+        self.condition = threading.Condition()
+
+    def _publish(self):
+        set_gauge("tafahom_llm_inflight", self.inflight)
+        set_gauge("tafahom_llm_queue_length", len(self.waiting))
+
+    def acquire(self, timeout):
+        with self.condition:
+            if self.inflight < self.limit and not self.waiting:
+                self.inflight += 1
+                self._publish()
+                return
+            if len(self.waiting) >= self.max_queue:
+                raise LLMBusyError(len(self.waiting) + 1)
+
+            ticket = object()
+            self.waiting.append(ticket)
+            self._publish()
+            deadline = time.monotonic() + timeout
+            try:
+                while self.waiting[0] is not ticket or self.inflight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LLMBusyError(self.waiting.index(ticket) + 1)
+                    self.condition.wait(remaining)
+                self.waiting.popleft()
+                self.inflight += 1
+            finally:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                self._publish()
+                self.condition.notify_all()
+
+    # Place prise seulement si elle est libre tout de suite (requêtes de couverture)
+    def try_acquire(self):
+        with self.condition:
+            if self.inflight >= self.limit or self.waiting:
+                return False
+            self.inflight += 1
+            self._publish()
+            return True
+
+    def release(self):
+        with self.condition:
+            self.inflight -= 1
+            self._publish()
+            self.condition.notify_all()
+
+_admission = Admission(MAX_INFLIGHT, MAX_QUEUE)
+
+# Sémaphores par conversation (supprimés quand plus aucune requête ne les utilise)
+_session_semaphores = {}
+_session_semaphores_lock = threading.Lock()
+
+# Une demande au-delà de la limite de la conversation est refusée sans attendre (les demandes identiques ont déjà
+# été regroupées en amont): l'attente ne ferait que retarder la réponse à une demande que l'utilisateur a doublée
+def _acquire_session(session_key):
+    with _session_semaphores_lock:
+        if session_key not in _session_semaphores:
+            _session_semaphores[session_key] = [threading.BoundedSemaphore(MAX_INFLIGHT_PER_SESSION), 0]
+        entry = _session_semaphores[session_key]
+        entry[1] += 1
+    if not entry[0].acquire(blocking=False):
+        _release_session(session_key, acquired=False)
+        raise LLMBusyError()
+
+def _release_session(session_key, acquired=True):
+    with _session_semaphores_lock:
+        entry = _session_semaphores[session_key]
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del _session_semaphores[session_key]
+
+# Fonction pour savoir si une erreur traduit une panne du service (pas de réponse, erreur serveur, limite de débit);
+# une réponse reçue mais inexploitable (JSON, validation, champ manquant) n'en est pas une
+def is_outage(error):
+    if isinstance(error, (LLMBusyError, LLMUnavailableError, LLMQuotaError, CassetteMissError)) or not isinstance(error, Exception):
+        return False
+    if isinstance(error, (ValueError, LookupError, TypeError, AttributeError)):
+        return False
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    return status is None or status >= 500 or status == 429
+
+# Disjoncteur d'un service: fermé (appels normaux), ouvert après BREAKER_FAILURES pannes consécutives (échec
+# immédiat), semi-ouvert après BREAKER_COOLDOWN (un seul appel d'essai: succès, fermeture; échec, réouverture)
+BREAKER_STATES = {"ferme": 0, "semi_ouvert": 1, "ouvert": 2}
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = "ferme"
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        self.state = state
+        set_gauge("tafahom_llm_breaker_state", BREAKER_STATES[state], service=self.name)
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + BREAKER_COOLDOWN - time.monotonic()) if self.state == "ouvert" else 0.0
+
+    # Fonction pour autoriser un appel (ou lever LLMUnavailableError tant que le service est considéré en panne)
+    def before_call(self):
+        with self._lock:
+            if self.state == "ferme":
+                return
+            if self.state == "ouvert" and self.retry_in() == 0:
+                self._set_state("semi_ouvert")
+                increment("tafahom_llm_breaker_probes_total", service=self.name)
+                return
+            increment("tafahom_llm_short_circuited_total", service=self.name)
+            raise LLMUnavailableError(self.retry_in() or BREAKER_COOLDOWN)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != "ferme":
+                self._set_state("ferme")
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "semi_ouvert" or (self.state == "ferme" and self.failures >= BREAKER_FAILURES):
+                self.opened_at = time.monotonic()
+                self._set_state("ouvert")
+                increment("tafahom_llm_breaker_trips_total", service=self.name)
+
+    # Appel sans verdict sur le service (saturation locale, interruption): l'essai éventuel est rendu
+    def record_neutral(self):
+        with self._lock:
+            if self.state == "semi_ouvert":
+                self._set_state("ouvert")
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# Fonction pour obtenir le disjoncteur d'un client (un par service: URL de l'API ou type de client local)
+def breaker_for(client):
+    name = str(getattr(client, "base_url", None) or type(client).__name__)
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+# Fonction pour réserver le quota d'un appel selon la priorité du contexte (None si aucun quota n'est configuré);
+# renvoie la réservation et les tokens de prompt estimés
+def _reserve_quota(call_site, messages, params):
+    if not quotas_enabled():
+        return None
+    priority = current_priority()
+    prompt_tokens, completion_tokens = estimate_call(call_site, messages, params)
+    deadline = time.monotonic() + ADMISSION_TIMEOUT
+    while True:
+        reservation, wait = reserve(call_site, priority, prompt_tokens, completion_tokens)
+        if reservation is not None:
+            return reservation, prompt_tokens
+        if priority != "interactive" or time.monotonic() + wait > deadline:
+            increment("tafahom_llm_quota_rejected_total", call_site=call_site, priority=priority)
+            raise LLMQuotaError(wait)
+        time.sleep(wait)
+
+# Fonction pour remplacer l'estimation réservée par l'usage renvoyé par le service (estimé pour les réponses en flux)
+def _settle_quota(quota, call):
+    reservation, prompt_tokens = quota
+    settle(reservation, call.get("prompt_tokens") or prompt_tokens, call.get("completion_tokens") or count_tokens(call["response"] or ""))
+
+# Fonction pour rendre le quota réservé par un appel qui a échoué (l'erreur de l'appel reste celle signalée)
+def _release_quota(quota):
+    try:
+        release(quota[0])
+    except Exception:
+        pass  # base momentanément verrouillée: la réservation compte jusqu'à la fin de sa fenêtre
+
+# Requêtes identiques en cours (single-flight): les doublons attendent le résultat de la première
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+# Tentative d'appel en flux (une requête principale, éventuellement une requête de couverture)
+class _Attempt:
+    def __init__(self, client, messages, params, finished):
+        self.first_token = threading.Event()
+        self.cancelled = threading.Event()
+        self.finished = finished
+        self.started_at = time.perf_counter()
+        self.first_token_delay = None
+        self.finished_at = None
+        self.response = None
+        self.error = None
+        self.stream = None
+        self.thread = threading.Thread(target=self._run, args=(client, messages, params), daemon=True)
+        self.thread.start()
+
+    def _run(self, client, messages, params):
+        try:
+            stream = self.stream = client.chat.completions.create(messages=messages, stream=True, **params)
+            parts = []
+            try:
+                if self.cancelled.is_set():
+                    return
+                for chunk in stream:
+                    if self.cancelled.is_set():
+                        return
+                    content = chunk.choices[0].delta.content if chunk.choices else None
+                    if content:
+                        if not self.first_token.is_set():
+                            self.first_token_delay = time.perf_counter() - self.started_at
+                            self.first_token.set()
+                        parts.append(content)
+            finally:
+                if hasattr(stream, "close"):
+                    stream.close()
+            self.response = "".join(parts)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.perf_counter()
+            self.first_token.set()
+            if not self.cancelled.is_set():
+                self.finished.put(self)
+
+    def latency(self):
+        return self.finished_at - self.started_at
+
+    # Annulation: le flux est fermé pour que la requête s'arrête sans attendre le morceau suivant
+    def cancel(self):
+        self.cancelled.set()
+        stream = self.stream
+        if stream is not None and hasattr(stream, "close"):
+            try:
+                stream.close()
+            except Exception:
+                pass  # flux déjà terminé
+
+# Fonction pour attendre la fin des tentatives perdantes avant de rendre la place de la requête de couverture
+# (le nombre de flux ouverts ne dépasse jamais les places prises), puis mesurer la requête principale observée
+# (une observation pondérée par l'inverse du taux d'échantillonnage)
+def _finish_losers(call_site, losers, shadow):
+    try:
+        for attempt in losers:
+            attempt.thread.join()
+    finally:
+        _admission.release()
+    if shadow is not None and shadow.error is None:
+        observe("tafahom_llm_primary_latency_seconds", shadow.latency(), weight=1 / HEDGE_SHADOW_SAMPLE, call_site=call_site)
+
+# Fonction pour calculer le délai de couverture d'un site d'appel (percentile récent du premier token)
+def hedge_delay(call_site):
+    if counter_value("tafahom_llm_first_token_observations_total", call_site=call_site) < HEDGE_MIN_OBSERVATIONS:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, percentile("tafahom_llm_first_token_seconds", HEDGE_PERCENTILE, call_site=call_site))
+
+# Fonction pour vérifier que le budget de requêtes supplémentaires n'est pas épuisé
+def _hedge_budget_left(call_site):
+    requests = counter_value("tafahom_llm_requests_total", call_site=call_site)
+    return counter_value("tafahom_llm_hedges_total", call_site=call_site) < HEDGE_BUDGET * max(1, requests)
+
+# Fonction pour publier le gain de latence (p99 de la requête principale vs p99 obtenu) et le surcoût
+def hedging_report(call_site):
+    report = {
+        "p99_primary": percentile("tafahom_llm_primary_latency_seconds", 99, call_site=call_site),
+        "p99_effective": percentile("tafahom_llm_latency_seconds", 99, call_site=call_site),
+        "extra_requests": counter_value("tafahom_llm_hedges_total", call_site=call_site)
+                          / max(1, counter_value("tafahom_llm_requests_total", call_site=call_site))
+    }
+    if report["p99_primary"] is not None and report["p99_effective"] is not None:
+        set_gauge("tafahom_llm_hedge_p99_gain_seconds", report["p99_primary"] - report["p99_effective"], call_site=call_site)
+    set_gauge("tafahom_llm_hedge_extra_request_ratio", report["extra_requests"], call_site=call_site)
+    return report
+
+# Fonction pour appeler le modèle en flux avec couverture: si aucun premier token n'arrive avant le délai,
+# une seconde requête identique est envoyée; la première terminée l'emporte et l'autre est annulée
+def _hedged_completion(client, call_site, messages, params):
+    finished = queue.Queue()
+    primary = _Attempt(client, messages, params, finished)
+    attempts = [primary]
+
+    if not primary.first_token.wait(hedge_delay(call_site)) and _hedge_budget_left(call_site) and _admission.try_acquire():
+        increment("tafahom_llm_hedges_total", call_site=call_site)
+        attempts.append(_Attempt(client, messages, params, finished))
+
+    try:
+        winner = None
+        for _ in attempts:
+            attempt = finished.get()
+            if attempt.error is None:
+                winner = attempt
+                break
+        if winner is None:
+            raise primary.error
+    finally:
+        shadow = len(attempts) > 1 and primary.error is None and primary.finished_at is None and random.random() < HEDGE_SHADOW_SAMPLE
+        losers = [attempt for attempt in attempts if attempt is not winner]
+        for attempt in losers:
+            if not (attempt is primary and shadow):
+                attempt.cancel()
+        if len(attempts) > 1:
+            if shadow or any(attempt.finished_at is None for attempt in losers):
+                threading.Thread(target=_finish_losers, args=(call_site, losers, primary if shadow else None), daemon=True).start()
+            else:
+                _admission.release()
+
+    for attempt in attempts:
+        if attempt.first_token_delay is not None:
+            increment("tafahom_llm_first_token_observations_total", call_site=call_site)
+            observe("tafahom_llm_first_token_seconds", attempt.first_token_delay, call_site=call_site)
+    # Latence qu'aurait eue la requête principale seule (connue si elle a gagné, sinon mesurée par échantillon)
+    if winner is primary:
+        observe("tafahom_llm_primary_latency_seconds", primary.latency(), call_site=call_site)
+    else:
+        increment("tafahom_llm_hedge_wins_total", call_site=call_site)
+    return winner.response
+
+# Fonction pour appeler le modèle en flux en transmettant le texte partiel à chaque morceau (affichage progressif);
+# renvoie le texte complet et le nombre de morceaux reçus (environ un token chacun)
+def _streamed_completion(client, messages, params, on_token):
+    stream = client.chat.completions.create(messages=messages, stream=True, **params)
+    text, chunks = "", 0
+    try:
+        for chunk in stream:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                text += content
+                chunks += 1
+                on_token(text)
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+    return text, chunks
+
+# Fonction pour ajouter une interaction à la cassette (un membre gzip par entrée, ajout sans réécriture)
+def _record(path, entry):
+    line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+    append_bytes(path, gzip.compress(line.encode("utf-8")))
+
+# Fonction pour enregistrer un appel dans la cassette de sa conversation (error: erreur de l'appel échoué)
+def _record_call(conversation_id, key, params, messages, call, error=None):
+    entry = {
+        "call_site": call["call_site"],
+        "key": key,
+        "ts": time.time(),
+        "duration": call["latency_s"],
+        "params": params,
+        "last_message": messages[-1]["content"],
+        "response": call["response"],
+        "prompt_tokens": call["prompt_tokens"],
+        "completion_tokens": call["completion_tokens"]
+    }
+    if error is not None:
+        entry["error"] = {
+            "type": type(error).__name__,
+            "message": str(error),
+            "status_code": getattr(error, "status_code", None) or getattr(error, "http_status", None),
+            "detail": getattr(error, "position", getattr(error, "retry_in", None))
+        }
+    _record(cassette_path(conversation_id), entry)
+
+def _record_failure(conversation_id, call_site, key, params, messages, error, duration):
+    call = {"call_site": call_site, "response": None, "latency_s": round(duration, 4), "prompt_tokens": None, "completion_tokens": None}
+    _record_call(conversation_id, key, params, messages, call, error)
+
+# Fonction pour recréer l'erreur d'un appel enregistré: erreurs du module et exceptions standard à l'identique,
+# erreurs du client du service sous la forme de ReplayedLLMError
+def _replayed_error(error):
+    if error["type"] == "LLMBusyError":
+        return LLMBusyError(error.get("detail"))
+    if error["type"] == "LLMUnavailableError":
+        return LLMUnavailableError(error.get("detail") or 0.0)
+    if error["type"] == "LLMQuotaError":
+        return LLMQuotaError(error.get("detail") or 0.0)
+    if error["type"] == "CassetteMissError":
+        return CassetteMissError(error["message"])
+    error_class = getattr(builtins, error["type"], None)
+    if isinstance(error_class, type) and issubclass(error_class, Exception):
+        return error_class(error["message"])
+    return ReplayedLLMError(error["type"], error["message"], error.get("status_code"))
+
+# Dernier appel du thread courant (latence, tokens), pour le journal de la conversation
+_last_call = threading.local()
+
+# Fonction pour récupérer (une seule fois) les mesures du dernier appel fait par ce thread
+def take_last_call():
+    call = getattr(_last_call, "call", None)
+    _last_call.call = None
+    return call
+
+# Fonction pour appeler le modèle depuis un site d'appel nommé, avec enregistrement/relecture éventuels
+# (on_token: fonction appelée avec le texte partiel pendant la génération, sans couverture dans ce cas; validate:
+# fonction qui lève une exception si la réponse est inexploitable, appelée pour chaque demande, même regroupée
+# avec une demande identique, et avant la mise en cache partagé pour qu'une réponse mal formée ne soit pas rejouée
+# aux autres répliques)
+def chat_completion(client, call_site, messages, conversation_id=None, hedge=False, on_token=None, validate=None, **params):
+    with span(f"llm {call_site}", conversation_id, **{"tafahom.call_site": call_site, "gen_ai.request.model": params.get("model")}) as current:
+        call = _chat_completion(client, call_site, messages, conversation_id, hedge, params, on_token, validate)
+        current.set(**{"gen_ai.usage.input_tokens": call.get("prompt_tokens"), "gen_ai.usage.output_tokens": call.get("completion_tokens")})
+    _last_call.call = {key: value for key, value in call.items() if key != "response"}
+    return call["response"]
+
+def _chat_completion(client, call_site, messages, conversation_id, hedge, params, on_token=None, validate=None):
+    key = request_key(call_site, messages, params)
+    # Regroupement des demandes identiques d'une même conversation seulement: chaque conversation garde son propre
+    # enregistrement, son quota et sa validation (le cache partagé entre répliques reste indexé par la seule requête)
+    flight_key = (conversation_id, key)
+
+    if CASSETTE_MODE == "replay":
+        entry = _load_cassette(cassette_path(conversation_id)).take(call_site, key)
+        if REPLAY_SPEED == "recorded":
+            time.sleep(entry["duration"])
+        if entry.get("error"):
+            raise _replayed_error(entry["error"])
+        return {"call_site": call_site, "response": entry["response"], "latency_s": entry["duration"],
+                "prompt_tokens": entry.get("prompt_tokens"), "completion_tokens": entry.get("completion_tokens")}
+
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+
+    if not leader:
+        increment("tafahom_llm_deduplicated_total", call_site=call_site)
+        flight.done.wait()
+        if CASSETTE_MODE == "record":
+            if flight.response is not None:
+                _record_call(conversation_id, key, params, messages, {**flight.response, "latency_s": 0.0})
+            else:
+                _record_failure(conversation_id, call_site, key, params, messages, flight.error, 0.0)
+        if flight.error:
+            raise flight.error
+        if validate is not None:
+            validate(flight.response["response"])
+        return flight.response
+
+    try:
+        if CASSETTE_MODE == "off" and call_site in SHARED_CALL_SITES:
+            # Cache partagé entre répliques: une seule réplique appelle le modèle pour une requête donnée
+            def compute():
+                call = _guarded_completion(client, call_site, messages, conversation_id, key, params, hedge, on_token)
+                if validate is not None:
+                    validate(call["response"])
+                return call
+
+            call, cached = get_or_compute("llm", [key], compute)
+            if cached:
+                increment("tafahom_llm_shared_hits_total", call_site=call_site)
+                call = {**call, "latency_s": 0.0, "cached": True}
+                if on_token:
+                    on_token(call["response"])
+            flight.response = call
+        else:
+            started = time.perf_counter()
+            try:
+                flight.response = _guarded_completion(client, call_site, messages, conversation_id, key, params, hedge, on_token)
+            except Exception as e:
+                # Échec enregistré lui aussi: la relecture lève la même erreur au même tour
+                if CASSETTE_MODE == "record":
+                    _record_failure(conversation_id, call_site, key, params, messages, e, time.perf_counter() - started)
+                raise
+            if validate is not None:
+                validate(flight.response["response"])
+        return flight.response
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[flight_key]
+        flight.done.set()
+
+# Fonction pour appeler le modèle sous la garde du disjoncteur (échec immédiat si le service est en panne, verdict
+# après l'appel) et du quota du service (attente ou report selon la priorité, consommation réelle enregistrée);
+# un client non décompté (metered = False, ex: modèle local) n'est pas soumis au quota du service distant
+def _guarded_completion(client, call_site, messages, conversation_id, key, params, hedge, on_token=None):
+    breaker = breaker_for(client)
+    breaker.before_call()
+    quota = None
+    try:
+        if getattr(client, "metered", True):
+            quota = _reserve_quota(call_site, messages, params)
+        call = _admitted_completion(client, call_site, messages, conversation_id, key, params, hedge and HEDGING == "on" and on_token is None, on_token)
+    except BaseException as e:
+        if quota:
+            _release_quota(quota)
+        if is_outage(e):
+            breaker.record_failure()
+        elif isinstance(e, Exception) and not isinstance(e, (LLMBusyError, LLMQuotaError, CassetteMissError)):
+            breaker.record_success()  # le service a répondu (erreur de la requête elle-même)
+        else:
+            breaker.record_neutral()
+        raise
+    breaker.record_success()
+    if quota:
+        _settle_quota(quota, call)
+    return call
+
+# Fonction pour exécuter un appel réel dans les limites de concurrence (conversation puis processus)
+# (renvoie la réponse avec sa latence et l'usage en tokens)
+def _admitted_completion(client, call_site, messages, conversation_id, key, params, hedge, on_token=None):
+    session_key = conversation_id or "sans_conversation"
+    queued_at = time.perf_counter()
+    try:
+        _acquire_session(session_key)
+        try:
+            _admission.acquire(ADMISSION_TIMEOUT)
+        except LLMBusyError:
+            _release_session(session_key)
+            raise
+    except LLMBusyError:
+        increment("tafahom_llm_rejected_total", call_site=call_site)
+        raise
+    observe("tafahom_llm_queue_wait_seconds", time.perf_counter() - queued_at, call_site=call_site)
+
+    try:
+        start = time.perf_counter()
+        # Les réponses en flux (couverture, affichage progressif) ne renvoient pas l'usage en tokens
+        usage = None
+        if hedge:
+            response_text = _hedged_completion(client, call_site, messages, params)
+        elif on_token:
+            response_text, chunks = _streamed_completion(client, messages, params, on_token)
+            usage = SimpleNamespace(completion_tokens=chunks)
+        else:
+            response = client.chat.completions.create(messages=messages, **params)
+            response_text = response.choices[0].message.content
+            usage = getattr(response, "usage", None)
+        duration = time.perf_counter() - start
+    finally:
+        _admission.release()
+        _release_session(session_key)
+    increment("tafahom_llm_requests_total", call_site=call_site)
+    observe("tafahom_llm_latency_seconds", duration, call_site=call_site)
+    if hedge:
+        hedging_report(call_site)
+
+    call = {
+        "call_site": call_site,
+        "response": response_text,
+        "latency_s": round(duration, 4),
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None)
+    }
+
+    if CASSETTE_MODE == "record":
+        _record_call(conversation_id, key, params, messages, call)
+
+    return call
+
+
+if __name__ == "__main__":
+    # Résumé d'une cassette: nombre d'appels, d'échecs et durées par site d'appel
+    if len(sys.argv) != 2:
+        print("Usage: python tafahom_llm.py <cassette.jsonl.gz>")
+        sys.exit(1)
+
+    durations = defaultdict(list)
+    failures = defaultdict(int)
+    with gzip.open(sys.argv[1], "rt", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            durations[entry["call_site"]].append(entry["duration"])
+            if entry.get("error"):
+                failures[entry["call_site"]] += 1
+
+    for call_site, values in durations.items():
+        print(f"{call_site}: {len(values)} appels ({failures[call_site]} échecs), total {sum(values):.2f} s, max {max(values):.2f} s")
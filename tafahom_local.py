@@ -0,0 +1,206 @@
+import argparse
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from tafahom_charge import SCRIPTED_ANSWERS, percentile
+from tafahom_llm import ADMISSION_TIMEOUT, LLMBusyError
+from tafahom_metriques import observe, set_gauge
+
+try:
+    from llama_cpp import Llama
+except ImportError:  # llama-cpp-python optionnel: échanges avec le modèle distant
+    Llama = None
+
+# Inférence locale sur CPU pour les échanges du portail: petit modèle d'instruction quantifié (GGUF, llama.cpp),
+# chargé une fois par processus; la génération du profil reste confiée au modèle distant
+
+# Modèle des échanges du portail: "remote" (Together) ou "local" (llama.cpp)
+CHAT_BACKEND = os.getenv("TAFAHOM_CHAT_BACKEND", "remote")
+
+# Fichier GGUF du modèle local (ex: qwen2.5-3b-instruct-q4_k_m.gguf)
+LOCAL_MODEL_PATH = os.getenv("TAFAHOM_LOCAL_MODEL", "")
+
+# Nombre d'instances du modèle (inférences simultanées) et threads CPU de chaque instance
+LOCAL_WORKERS = int(os.getenv("TAFAHOM_LOCAL_WORKERS", "1"))
+LOCAL_THREADS = int(os.getenv("TAFAHOM_LOCAL_THREADS", str(max(1, (os.cpu_count() or 1) // LOCAL_WORKERS))))
+
+# Fenêtre de contexte du modèle local (tokens)
+LOCAL_CONTEXT_TOKENS = int(os.getenv("TAFAHOM_LOCAL_CONTEXT_TOKENS", "4096"))
+
+# Paramètres de génération transmis à llama.cpp (le nom du modèle distant est ignoré)
+GENERATION_PARAMS = ("temperature", "max_tokens", "top_p", "stop")
+
+# Réserve bornée d'instances du modèle: une inférence par instance (llama.cpp n'est pas réentrant),
+# les demandes en surplus attendent une instance libre puis sont refusées
+class ModelPool:
+    def __init__(self, model_path, workers, threads, context_tokens):
+        self.model_path = model_path
+        self.workers = workers
+        self._idle = queue.Queue()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            self._idle.put(Llama(model_path=model_path, n_threads=threads, n_ctx=context_tokens, verbose=False))
+
+    def acquire(self, timeout):
+        with self._lock:
+            self._waiting += 1
+            position = self._waiting
+            set_gauge("tafahom_local_waiting", self._waiting)
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise LLMBusyError(position)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                set_gauge("tafahom_local_waiting", self._waiting)
+
+    def release(self, model):
+        self._idle.put(model)
+
+# Interface de client compatible avec Together (client.chat.completions.create), pour passer par chat_completion
+# (admission, cassettes, métriques) sans changer les sites d'appel
+class _Completions:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def create(self, messages, stream=False, **params):
+        arguments = {key: value for key, value in params.items() if key in GENERATION_PARAMS}
+        if stream:
+            return self._stream(messages, arguments)
+        model = self.pool.acquire(ADMISSION_TIMEOUT)
+        try:
+            result = model.create_chat_completion(messages=messages, **arguments)
+        finally:
+            self.pool.release(model)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=result["choices"][0]["message"]["content"]))],
+            usage=SimpleNamespace(**result.get("usage", {}))
+        )
+
+    def _stream(self, messages, arguments):
+        model = self.pool.acquire(ADMISSION_TIMEOUT)
+        try:
+            chunks = model.create_chat_completion(messages=messages, stream=True, **arguments)
+            try:
+                for chunk in chunks:
+                    content = chunk["choices"][0]["delta"].get("content") if chunk["choices"] else None
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+            finally:
+                chunks.close()
+        finally:
+            self.pool.release(model)
+
+# Client local: ses appels ne passent pas par le service distant et ne consomment donc pas son quota
+class LocalClient:
+    metered = False
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.chat = SimpleNamespace(completions=_Completions(pool))
+
+_client = None
+_client_lock = threading.Lock()
+
+# Fonction pour obtenir le client local (modèle chargé une seule fois par processus)
+def local_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            if Llama is None:
+                raise RuntimeError("Le module llama_cpp n'est pas installé (pip install llama-cpp-python)")
+            if not os.path.isfile(LOCAL_MODEL_PATH):
+                raise RuntimeError(f"Modèle local introuvable: {LOCAL_MODEL_PATH or 'TAFAHOM_LOCAL_MODEL non défini'}")
+            start = time.perf_counter()
+            _client = LocalClient(ModelPool(LOCAL_MODEL_PATH, LOCAL_WORKERS, LOCAL_THREADS, LOCAL_CONTEXT_TOKENS))
+            observe("tafahom_local_load_seconds", time.perf_counter() - start)
+        return _client
+
+# Fonction pour choisir le client des échanges: local si configuré et disponible, sinon le client distant;
+# renvoie le client et une description du modèle utilisé
+def select_chat_client(remote_client):
+    if CHAT_BACKEND != "local":
+        return remote_client, "distant"
+    try:
+        return local_client(), f"local ({os.path.basename(LOCAL_MODEL_PATH)}, {LOCAL_WORKERS}×{LOCAL_THREADS} threads)"
+    except Exception as e:
+        return remote_client, f"distant (modèle local indisponible: {e})"
+
+
+# Consigne système du banc d'essai (version courte de celle du portail)
+BENCH_SYSTEM_PROMPT = """Tu es TAFAHOM-PORTAIL, un agent conversationnel qui recueille le récit de porteurs de projet culturel.
+Reformule chaque réponse dans un langage institutionnel en préservant l'essence culturelle du récit, puis pose UNE question ouverte."""
+
+# Fonction pour jouer une conversation scriptée et mesurer chaque tour (premier token, durée, tokens générés)
+def _bench_conversation(client, answers, max_tokens, results):
+    messages = [{"role": "system", "content": BENCH_SYSTEM_PROMPT}]
+    for answer in SCRIPTED_ANSWERS[:answers]:
+        messages.append({"role": "user", "content": answer})
+        start = time.perf_counter()
+        first_token, parts = None, []
+        for chunk in client.chat.completions.create(messages=messages, stream=True, temperature=0.7, max_tokens=max_tokens, top_p=0.9):
+            content = chunk.choices[0].delta.content
+            if content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                parts.append(content)
+        duration = time.perf_counter() - start
+        messages.append({"role": "assistant", "content": "".join(parts)})
+        results.append({"first_token": first_token or duration, "duration": duration, "tokens": len(parts)})
+
+def benchmark(turns=10, concurrency=1, max_tokens=200):
+    client = local_client()
+    results = []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=_bench_conversation, args=(client, turns, max_tokens, results)) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    durations = [result["duration"] for result in results]
+    first_tokens = [result["first_token"] for result in results]
+    tokens = sum(result["tokens"] for result in results)
+    return {
+        "turns": len(results),
+        "p50": statistics.median(durations),
+        "p95": percentile(durations, 95),
+        "first_token_p50": statistics.median(first_tokens),
+        "first_token_p95": percentile(first_tokens, 95),
+        "tokens_per_turn": tokens / len(results),
+        "tokens_per_second": tokens / elapsed,
+        "tokens_per_second_per_turn": statistics.median(result["tokens"] / result["duration"] for result in results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc d'essai du modèle local des échanges (llama.cpp sur CPU)")
+    parser.add_argument("--turns", type=int, default=10, help="Tours par conversation scriptée")
+    parser.add_argument("--concurrency", default="1", help="Conversations simultanées (paliers séparés par des virgules)")
+    parser.add_argument("--max-tokens", type=int, default=200, help="Tokens maximum par réponse")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        local_client()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    print(f"Modèle: {LOCAL_MODEL_PATH} chargé en {time.perf_counter() - start:.1f} s "
+          f"({os.cpu_count()} cœurs, {LOCAL_WORKERS} instance(s) × {LOCAL_THREADS} threads, contexte {LOCAL_CONTEXT_TOKENS})")
+    print(f"{'simultanées':>11} {'tours':>6} {'p50 (s)':>8} {'p95 (s)':>8} {'1er token p50':>14} {'1er token p95':>14} {'tokens/tour':>12} {'tokens/s tour':>14} {'tokens/s total':>15}")
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        result = benchmark(args.turns, concurrency, args.max_tokens)
+        print(f"{concurrency:>11} {result['turns']:>6} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['first_token_p50']:>14.2f} "
+              f"{result['first_token_p95']:>14.2f} {result['tokens_per_turn']:>12.0f} {result['tokens_per_second_per_turn']:>14.1f} {result['tokens_per_second']:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+import weakref
+
+from tafahom_metriques import remove_gauge, set_gauge
+from tafahom_stockage import DATA_DIR, append_text, atomic_write_json, data_path, read_json
+
+# Budget mémoire total des sessions d'un worker (Mo), réparti entre les sessions actives
+WORKER_MEMORY_BUDGET = int(os.getenv("TAFAHOM_WORKER_MEMORY_MB", "256")) * 1024 * 1024
+
+# En dessous de cette taille, une session n'est jamais déchargée sur disque
+MIN_SESSION_BUDGET = 64 * 1024
+
+# Une session sans rerun depuis ce délai (s) est froide: ses données peuvent être déchargées par une autre session
+IDLE_AFTER = 120
+
+# Une session sans rerun depuis ce délai (s) n'est plus comptée (expirée côté Streamlit)
+SESSION_TTL = 3600
+
+# Répertoires de déchargement sans session connue de ce processus (arrêt du worker, autre réplique disparue),
+# supprimés après ce délai (s) sans modification; vérifiés au plus une fois par SESSION_TTL
+ORPHAN_SPILL_TTL = float(os.getenv("TAFAHOM_ORPHAN_SPILL_TTL", str(24 * 3600)))
+
+# Marqueur laissé dans l'état de session à la place d'une valeur déchargée sur disque
+SPILLED_MARKER = "__spilled__"
+
+# Fonction pour estimer la taille mémoire profonde d'un objet (octets)
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if hasattr(obj, "memory_usage") and hasattr(obj, "columns"):  # DataFrame pandas
+        return int(obj.memory_usage(deep=True).sum())
+    if hasattr(obj, "to_plotly_json"):  # Figure plotly
+        return sys.getsizeof(obj) + deep_size(obj.to_plotly_json(), seen)
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+# Fonction pour lister les clés utilisateur d'un état de session (proxy st.session_state ou état brut)
+def _keys(state):
+    return list(state.filtered_state.keys()) if hasattr(type(state), "filtered_state") else list(state.keys())
+
+# Fonction pour obtenir l'identifiant mémoire d'une session (répertoire de déchargement)
+def session_key(state):
+    if "memory_session_id" not in state:
+        state["memory_session_id"] = uuid.uuid4().hex
+    return state["memory_session_id"]
+
+def _spill_path(state, name):
+    return data_path("sessions", session_key(state), name)
+
+def _spill_directory(key):
+    return os.path.join(DATA_DIR, "sessions", key)
+
+# Fonction pour mesurer la mémoire de chaque clé de l'état de session
+def memory_report(state):
+    return {key: deep_size(state[key]) for key in _keys(state)}
+
+# Fonction pour décharger les anciens messages sur disque (seuls les keep_last derniers restent en mémoire)
+def spill_old_messages(state, keep_last):
+    messages = state["messages"] if "messages" in state else []
+    if len(messages) <= keep_last:
+        return 0
+
+    old_messages = messages[:-keep_last] if keep_last else messages
+    append_text(_spill_path(state, "messages.jsonl"), "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in old_messages))
+    state["messages"] = messages[-keep_last:] if keep_last else []
+    state["spilled_messages"] = spilled_message_count(state) + len(old_messages)
+    return len(old_messages)
+
+def spilled_message_count(state):
+    return state["spilled_messages"] if "spilled_messages" in state else 0
+
+# Fonction pour relire (à la demande) une tranche des messages déchargés
+def load_spilled_messages(state, start=0, stop=None):
+    if not spilled_message_count(state):
+        return []
+    with open(_spill_path(state, "messages.jsonl"), "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    return [json.loads(line) for line in lines[start:stop]]
+
+# Fonction pour obtenir l'historique complet (déchargé + en mémoire), par exemple pour un appel LLM
+def all_messages(state):
+    return load_spilled_messages(state) + list(state["messages"])
+
+def message_count(state):
+    return spilled_message_count(state) + len(state["messages"])
+
+# Fonction pour lire une tranche de l'historique complet sans recharger ce qui n'est pas demandé
+def message_slice(state, start, stop):
+    spilled = spilled_message_count(state)
+    messages = load_spilled_messages(state, start, min(stop, spilled)) if start < spilled else []
+    return messages + list(state["messages"][max(0, start - spilled):max(0, stop - spilled)])
+
+# Fonction pour noter le début d'un rerun (une session en cours d'exécution n'est jamais déchargée par une autre;
+# un déchargement déjà commencé par une autre session est attendu)
+def touch_session(state):
+    entry = _entry(session_key(state))
+    with entry["lock"]:
+        entry["running"] = True
+        entry["last_seen"] = time.time()
+
+def is_spilled(value):
+    return isinstance(value, dict) and SPILLED_MARKER in value
+
+# Fonction pour décharger une valeur de l'état de session sur disque
+def spill_value(state, key):
+    if key not in state or state[key] is None or is_spilled(state[key]):
+        return False
+    path = _spill_path(state, f"{key}.json")
+    atomic_write_json(path, state[key])
+    state[key] = {SPILLED_MARKER: path}
+    return True
+
+# Fonction pour recharger une valeur déchargée au moment où elle est utilisée
+def ensure_loaded(state, key):
+    if key in state and is_spilled(state[key]):
+        state[key] = read_json(state[key][SPILLED_MARKER])
+    return state[key] if key in state else None
+
+# Fonction pour supprimer les données déchargées d'une session (nouvelle conversation, réinitialisation);
+# l'ancienne entrée du registre est retirée, la session suivante en reçoit une nouvelle
+def discard_spilled(state):
+    if "memory_session_id" in state:
+        _forget(state["memory_session_id"])
+
+
+# Registre des sessions du worker: état de session (référence faible, libéré quand Streamlit abandonne la session),
+# verrou de déchargement, exécution en cours, taille en mémoire, dernier rerun, clés froides déclarées
+_sessions = {}
+_sessions_lock = threading.Lock()
+_orphans_checked_at = 0.0
+
+def _entry(key):
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = {"state": None, "lock": threading.Lock(), "running": False, "size": 0, "last_seen": time.time(),
+                              "cold_keys": [], "keep_messages": 0, "app": None}
+        return _sessions[key]
+
+# Une session est terminée quand Streamlit a libéré son état (ou, jamais mesurée, sans rerun depuis SESSION_TTL)
+def _ended(entry, now):
+    if entry["state"] is not None:
+        return entry["state"]() is None
+    return now - entry["last_seen"] >= SESSION_TTL
+
+# Fonction pour retirer une session du registre et supprimer ses données déchargées
+def _forget(key):
+    with _sessions_lock:
+        entry = _sessions.pop(key, None)
+    if entry and entry["app"]:
+        remove_gauge("tafahom_session_memory_bytes", app=entry["app"], session=key)
+    shutil.rmtree(_spill_directory(key), ignore_errors=True)
+
+# Fonction pour supprimer les répertoires de déchargement orphelins (aucune session de ce processus, non modifiés
+# depuis ORPHAN_SPILL_TTL)
+def _purge_orphan_spills(now):
+    global _orphans_checked_at
+    if now - _orphans_checked_at < SESSION_TTL:
+        return
+    _orphans_checked_at = now
+    try:
+        names = os.listdir(os.path.join(DATA_DIR, "sessions"))
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = _spill_directory(name)
+        with _sessions_lock:
+            known = name in _sessions
+        try:
+            if not known and now - os.path.getmtime(path) >= ORPHAN_SPILL_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass  # supprimé entre-temps
+
+def _active_sessions(now):
+    return {key: entry for key, entry in _sessions.items() if now - entry["last_seen"] < SESSION_TTL}
+
+# Fonction pour calculer la part du budget du worker revenant à chaque session active
+def per_session_budget():
+    with _sessions_lock:
+        active = len(_active_sessions(time.time()))
+    return max(MIN_SESSION_BUDGET, WORKER_MEMORY_BUDGET // max(1, active))
+
+def worker_memory():
+    with _sessions_lock:
+        return sum(entry["size"] for entry in _active_sessions(time.time()).values())
+
+# Fonction pour décharger les données froides d'une session jusqu'à passer sous le budget
+def _spill_session(state, cold_keys, keep_messages, budget):
+    total = sum(memory_report(state).values())
+    if total > budget:
+        spill_old_messages(state, keep_messages)
+        for key in cold_keys:
+            total = sum(memory_report(state).values())
+            if total <= budget:
+                break
+            spill_value(state, key)
+        total = sum(memory_report(state).values())
+    return total
+
+# Fonction à appeler en fin de rerun: mesure, déchargement, plafond du worker et métriques
+def enforce_budget(state, raw_state, cold_keys, keep_messages, app_name):
+    now = time.time()
+    budget = per_session_budget()
+    key = session_key(state)
+    entry = _entry(key)
+    with entry["lock"]:
+        total = _spill_session(state, cold_keys, keep_messages, budget)
+        entry.update(state=weakref.ref(raw_state), running=False, size=total, last_seen=now,
+                     cold_keys=list(cold_keys), keep_messages=keep_messages, app=app_name)
+
+    # Sessions terminées: retirées du registre, leurs données déchargées supprimées
+    with _sessions_lock:
+        ended = [k for k, other in _sessions.items() if k != key and _ended(other, now)]
+    for expired in ended:
+        _forget(expired)
+    _purge_orphan_spills(now)
+
+    with _sessions_lock:
+        # Sessions inactives, de la plus froide à la plus récente
+        idle_sessions = sorted(
+            (other for k, other in _sessions.items() if k != key and now - other["last_seen"] >= IDLE_AFTER),
+            key=lambda other: other["last_seen"]
+        )
+        worker_total = sum(other["size"] for other in _sessions.values())
+
+    # Plafond du worker: décharger les sessions inactives tant que le total dépasse le budget; une session
+    # en cours d'exécution (ou déjà déchargée par une autre) est laissée de côté
+    for other in idle_sessions:
+        if worker_total <= WORKER_MEMORY_BUDGET:
+            break
+        other_state = other["state"]() if other["state"] is not None else None
+        if other_state is None or not other["lock"].acquire(blocking=False):
+            continue
+        try:
+            if other["running"]:
+                continue
+            new_size = _spill_session(other_state, other["cold_keys"], other["keep_messages"], MIN_SESSION_BUDGET)
+        finally:
+            other["lock"].release()
+        worker_total -= other["size"] - new_size
+        other["size"] = new_size
+
+    set_gauge("tafahom_session_memory_bytes", total, app=app_name, session=key)
+    set_gauge("tafahom_worker_session_memory_bytes", worker_total, app=app_name)
+    set_gauge("tafahom_worker_sessions", len(_sessions), app=app_name)
+    return total, budget
+
+# Fonction pour formater une taille en octets
+def format_size(size):
+    for unit in ("o", "Ko", "Mo"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} Go"
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+from tafahom_stockage import atomic_write_text, data_path
+
+# Métriques du processus (compteurs, jauges, distributions), partagées par toutes les sessions du worker
+# et exportées au format texte Prometheus dans <données>/metrics/
+
+# Nombre d'observations récentes conservées par distribution (pour les percentiles)
+RECENT_OBSERVATIONS = 1000
+
+# Intervalle minimal entre deux exports du fichier de métriques (s)
+EXPORT_INTERVAL = 10
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_observations = defaultdict(lambda: {"count": 0, "sum": 0.0, "recent": deque(maxlen=RECENT_OBSERVATIONS)})
+_last_export = 0.0
+
+# Fonction pour construire la clé d'une série (nom + étiquettes triées)
+def _series(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+def increment(name, value=1, **labels):
+    with _lock:
+        _counters[_series(name, labels)] += value
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_series(name, labels)] = value
+
+def remove_gauge(name, **labels):
+    with _lock:
+        _gauges.pop(_series(name, labels), None)
+
+# Fonction pour enregistrer une observation (weight: nombre d'observations qu'elle représente, pour une mesure
+# échantillonnée)
+def observe(name, value, weight=1, **labels):
+    with _lock:
+        observation = _observations[_series(name, labels)]
+        observation["count"] += weight
+        observation["sum"] += value * weight
+        observation["recent"].append((value, weight))
+
+def counter_value(name, **labels):
+    with _lock:
+        return _counters.get(_series(name, labels), 0.0)
+
+# Fonction pour calculer un percentile pondéré sur les observations récentes (None si aucune): première valeur
+# dont le poids cumulé dépasse p % du poids total
+def percentile(name, p, **labels):
+    with _lock:
+        observation = _observations.get(_series(name, labels))
+        values = sorted(observation["recent"]) if observation else []
+    if not values:
+        return None
+    target, cumulated = p / 100 * sum(weight for _, weight in values), 0
+    for value, weight in values:
+        cumulated += weight
+        if cumulated > target:
+            return value
+    return values[-1][0]
+
+# Fonction pour formater une série au format Prometheus
+def _format(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+# Fonction pour produire le texte Prometheus de toutes les métriques
+def render_prometheus():
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(_format(name, labels, value))
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(_format(name, labels, value))
+        for (name, labels), observation in sorted(_observations.items()):
+            lines.append(_format(f"{name}_count", labels, observation["count"]))
+            lines.append(_format(f"{name}_sum", labels, observation["sum"]))
+    return "\n".join(lines) + "\n"
+
+# Fonction pour exporter les métriques du processus (fichier par processus, lu par le collecteur textfile)
+def export(app_name, force=False):
+    global _last_export
+    now = time.time()
+    if not force and now - _last_export < EXPORT_INTERVAL:
+        return
+    _last_export = now
+    atomic_write_text(data_path("metrics", f"{app_name}_{os.getpid()}.prom"), render_prometheus())
@@ -0,0 +1,201 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tafahom_prompts import count_message_tokens, count_tokens
+from tafahom_similarite import CRITERIA
+
+# Serveur LLM local compatible avec l'API chat/completions de Together (tests de charge et de performance)
+# Utilisation: python tafahom_mock_llm.py [port] [--rpm N --tpm N] puis TOGETHER_BASE_URL=http://127.0.0.1:<port>/v1
+
+# Fonction pour produire une réponse scriptée selon le site d'appel reconnu dans le prompt système
+def scripted_response(messages):
+    system_prompt = messages[0]["content"] if messages else ""
+    last_message = messages[-1]["content"] if messages else ""
+
+    if "fiche de profil" in system_prompt:
+        profile = {
+            "profile": {
+                "criteria": [{"name": name, "score": random.randint(3, 9), "comment": f"Évaluation simulée: {name}."} for name in CRITERIA],
+                "summary": "Porteur de projet simulé pour les tests de charge."
+            }
+        }
+        profile["profile"]["ias_score"] = round(sum(c["score"] for c in profile["profile"]["criteria"]) / len(CRITERIA) * 10)
+        return "```json\n" + json.dumps(profile, ensure_ascii=False) + "\n```"
+
+    if "contextualise" in system_prompt and "uniquement les contextes" in last_message:
+        return json.dumps({"contexts": [f"Éléments du profil relatifs à: {name}." for name in CRITERIA]}, ensure_ascii=False)
+
+    if "contextualise" in system_prompt:
+        questions = [
+            {"criterion": name, "context": f"Éléments du profil relatifs à: {name}.", "question": f"Ce critère ({name}) est-il un atout financier ?"}
+            for name in CRITERIA
+        ]
+        return json.dumps({"questions": questions}, ensure_ascii=False)
+
+    if "réévalues certains critères" in system_prompt:
+        changed = json.loads(last_message.split("évaluation précédente:\n\n", 1)[1].split("\n\n", 1)[0])
+        return json.dumps({"criteria": [{"name": item["criterion"], "score": item["score"], "comment": "Avis simulé réévalué."} for item in changed]}, ensure_ascii=False)
+
+    if "actualises la décision" in system_prompt:
+        return json.dumps({"decision": "Acceptation conditionnelle", "recommendations": ["Recommandation simulée."], "summary": "Évaluation simulée actualisée."}, ensure_ascii=False)
+
+    if "évaluation finale" in system_prompt:
+        criteria = [{"name": name, "score": random.randint(3, 9), "comment": "Avis simulé."} for name in CRITERIA]
+        global_score = round(sum(c["score"] for c in criteria) / len(criteria) * 10)
+        evaluation = {
+            "evaluation": {
+                "criteria": criteria,
+                "global_score": global_score,
+                "decision": "Acceptation" if global_score >= 70 else ("Acceptation conditionnelle" if global_score >= 50 else "Rejet"),
+                "recommendations": ["Recommandation simulée."],
+                "summary": "Évaluation simulée."
+            }
+        }
+        return json.dumps(evaluation, ensure_ascii=False)
+
+    if "profil mis à jour" in system_prompt:
+        enriched = {
+            "profile": {
+                "criteria": [{"name": name, "score": 6, "comment": "Simulé.", "financial_perspective": "Simulée."} for name in CRITERIA],
+                "ias_score": 60,
+                "financial_score": 60,
+                "combined_score": 60,
+                "improvement_areas": ["Axe simulé."],
+                "summary": "Profil enrichi simulé."
+            }
+        }
+        return json.dumps(enriched, ensure_ascii=False)
+
+    return f"Merci pour ce partage ({len(last_message)} caractères). Le porteur décrit une pratique ancrée dans son parcours. Pouvez-vous préciser ?"
+
+# Gestionnaire HTTP: latence simulée (fixe + aléatoire) et réponses scriptées, en mode normal ou en flux (SSE),
+# avec un quota simulé éventuel (requêtes et tokens par fenêtre glissante, erreur 429 au-delà)
+class MockLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    jitter = 0.0
+    requests_served = 0
+    lock = threading.Lock()
+    quota_rpm = 0
+    quota_tpm = 0
+    quota_window = 60.0
+    quota_usage = deque()
+    quota_rejections = 0
+
+    @classmethod
+    def reset_quota(cls):
+        with cls.lock:
+            cls.quota_usage.clear()
+            cls.quota_rejections = 0
+
+    # Fonction pour décompter une requête du quota simulé; renvoie l'attente (s) avant une place libre, 0 si admise
+    @classmethod
+    def _consume_quota(cls, tokens):
+        if not (cls.quota_rpm or cls.quota_tpm):
+            return 0.0
+        now = time.monotonic()
+        with cls.lock:
+            while cls.quota_usage and cls.quota_usage[0][0] <= now - cls.quota_window:
+                cls.quota_usage.popleft()
+            used = sum(item[1] for item in cls.quota_usage)
+            if (cls.quota_rpm and len(cls.quota_usage) + 1 > cls.quota_rpm) or (cls.quota_tpm and cls.quota_usage and used + tokens > cls.quota_tpm):
+                cls.quota_rejections += 1
+                return max(0.1, cls.quota_usage[0][0] + cls.quota_window - now)
+            cls.quota_usage.append((now, tokens))
+            return 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Fonction pour envoyer la réponse par morceaux (Server-Sent Events)
+    def _stream(self, body, text):
+        for i in range(0, len(text), 16):
+            chunk = {
+                "id": "mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": text[i:i + 16]}, "finish_reason": None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with MockLLMHandler.lock:
+            MockLLMHandler.requests_served += 1
+
+        text = scripted_response(body.get("messages", []))
+        prompt_tokens, completion_tokens = count_message_tokens(body.get("messages", [])), count_tokens(text)
+        retry_after = self._consume_quota(prompt_tokens + completion_tokens)
+        if retry_after:
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", str(round(retry_after, 1)))
+            data = json.dumps({"error": {"message": "Quota simulé atteint", "type": "rate_limit_exceeded"}}).encode("utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        time.sleep(self.latency + random.random() * self.jitter)
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            try:
+                self._stream(body, text)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # requête annulée par le client (ex: couverture gagnante)
+            return
+
+        self._send_json(200, {
+            "id": "mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        })
+
+# Fonction pour démarrer le serveur simulé dans un thread (port 0: port libre choisi par le système)
+# (rpm, tpm: quota simulé de requêtes et de tokens par fenêtre de window s, 0: illimité)
+def start_mock_server(port=0, latency=0.0, jitter=0.0, rpm=0, tpm=0, window=60.0):
+    MockLLMHandler.latency = latency
+    MockLLMHandler.jitter = jitter
+    MockLLMHandler.quota_rpm = rpm
+    MockLLMHandler.quota_tpm = tpm
+    MockLLMHandler.quota_window = window
+    MockLLMHandler.reset_quota()
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockLLMHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLM simulé compatible avec l'API de Together")
+    parser.add_argument("port", type=int, nargs="?", default=8765)
+    parser.add_argument("--rpm", type=int, default=0, help="Quota simulé de requêtes par minute (0: illimité)")
+    parser.add_argument("--tpm", type=int, default=0, help="Quota simulé de tokens par minute (0: illimité)")
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, latency=0.5, jitter=0.5, rpm=args.rpm, tpm=args.tpm)
+    print(f"LLM simulé sur http://127.0.0.1:{server.server_port}/v1" + (f" (quota: {args.rpm} requêtes, {args.tpm} tokens par minute)" if args.rpm or args.tpm else ""))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,169 @@
+import argparse
+import fnmatch
+import socketserver
+import threading
+import time
+
+# Serveur local compatible Redis (protocole RESP2, poignée de main HELLO 2 ou 3), limité aux commandes du cache
+# partagé: PING, GET, SET (EX, PX, NX), DEL, EXISTS, SCAN, FLUSHDB. Données en mémoire, pour les essais sans Redis.
+# Les réponses suivent le format RESP2, que les clients RESP3 acceptent aussi (sauf la valeur nulle, propre à chacun).
+# Utilisation: python tafahom_mock_redis.py [port] puis TAFAHOM_CACHE_URL=redis://127.0.0.1:<port>/0
+
+# Données partagées par toutes les connexions: clé -> (valeur, échéance monotone ou None)
+class Store:
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def _alive(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self._alive(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None, nx=False):
+        with self.lock:
+            if nx and self._alive(key) is not None:
+                return False
+            self.data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+            return True
+
+    def delete(self, keys):
+        with self.lock:
+            return sum(1 for key in keys if self._alive(key) is not None and self.data.pop(key, None) is not None)
+
+    def exists(self, keys):
+        with self.lock:
+            return sum(1 for key in keys if self._alive(key) is not None)
+
+    def keys(self, pattern):
+        with self.lock:
+            return [key for key in list(self.data) if self._alive(key) is not None and fnmatch.fnmatchcase(key.decode("utf-8", "replace"), pattern)]
+
+    def flush(self):
+        with self.lock:
+            self.data.clear()
+
+# Gestionnaire d'une connexion: lecture des commandes (tableaux de chaînes), réponses RESP2
+class MockRedisHandler(socketserver.StreamRequestHandler):
+    store = Store()
+    commands_served = 0
+    protocol = 2
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()  # commande en ligne (telnet, redis-cli)
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    def _reply(self, value):
+        null = b"_\r\n" if self.protocol == 3 else b"$-1\r\n"
+        if value is None:
+            data = null
+        elif isinstance(value, bool):
+            data = b"+OK\r\n" if value else null
+        elif isinstance(value, int):
+            data = b":%d\r\n" % value
+        elif isinstance(value, bytes):
+            data = b"$%d\r\n%s\r\n" % (len(value), value)
+        elif isinstance(value, list):
+            data = b"*%d\r\n" % len(value) + b"".join(
+                b"$%d\r\n%s\r\n" % (len(item), item) if isinstance(item, bytes) else b"*%d\r\n" % len(item) + b"".join(b"$%d\r\n%s\r\n" % (len(sub), sub) for sub in item)
+                for item in value
+            )
+        else:
+            data = value.encode("utf-8")
+        self.wfile.write(data)
+
+    def _set(self, arguments):
+        key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+        ttl, nx = None, b"NX" in options
+        for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+            if unit in options:
+                ttl = int(options[options.index(unit) + 1]) * scale
+        return self.store.set(key, value, ttl, nx)
+
+    def _scan(self, arguments):
+        options = [option.upper() for option in arguments[1:]]
+        pattern = arguments[1:][options.index(b"MATCH") + 1].decode("utf-8") if b"MATCH" in options else "*"
+        # Tout en une fois: curseur de fin 0
+        return [b"0", self.store.keys(pattern)]
+
+    def handle(self):
+        while True:
+            try:
+                arguments = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if not arguments:
+                return
+            MockRedisHandler.commands_served += 1
+            command, arguments = arguments[0].upper(), arguments[1:]
+            if command == b"HELLO":
+                # Métadonnées du serveur: tableau clé/valeur en RESP2, dictionnaire en RESP3
+                self.protocol = int(arguments[0]) if arguments else 2
+                fields = b"+server\r\n+redis\r\n+version\r\n+7.0.0\r\n+proto\r\n:%d\r\n" % self.protocol
+                self.wfile.write((b"%3\r\n" if self.protocol == 3 else b"*6\r\n") + fields)
+            elif command == b"PING":
+                self._reply("+PONG\r\n")
+            elif command == b"GET":
+                self._reply(self.store.get(arguments[0]))
+            elif command == b"SET":
+                self._reply(self._set(arguments))
+            elif command == b"DEL":
+                self._reply(self.store.delete(arguments))
+            elif command == b"EXISTS":
+                self._reply(self.store.exists(arguments))
+            elif command == b"SCAN":
+                self._reply(self._scan(arguments))
+            elif command in (b"FLUSHDB", b"SELECT"):
+                if command == b"FLUSHDB":
+                    self.store.flush()
+                self._reply("+OK\r\n")
+            elif command == b"QUIT":
+                self._reply("+OK\r\n")
+                return
+            else:
+                self._reply(f"-ERR unknown command '{command.decode('utf-8', 'replace')}'\r\n")
+            self.wfile.flush()
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    @property
+    def server_port(self):
+        return self.server_address[1]
+
+# Fonction pour démarrer le serveur dans un thread (port 0: port libre choisi par le système)
+def start_mock_redis(port=0):
+    MockRedisHandler.store = Store()
+    server = _Server(("127.0.0.1", port), MockRedisHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serveur local compatible Redis (cache partagé de TAFAHOM)")
+    parser.add_argument("port", type=int, nargs="?", default=6380)
+    args = parser.parse_args()
+
+    server = start_mock_redis(args.port)
+    print(f"Cache compatible Redis sur redis://127.0.0.1:{server.server_port}/0")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
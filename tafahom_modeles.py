@@ -0,0 +1,314 @@
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson optionnel: module json standard
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack optionnel: format binaire indisponible
+    msgpack = None
+
+from tafahom_traces import span
+
+# Modèles typés des profils, évaluations, profils enrichis et questions contextualisées: une seule validation, au moment où la sortie
+# du modèle (ou un fichier) est lue; le reste de l'application manipule ensuite des données sûres
+
+# Décisions possibles d'une évaluation financière
+DECISIONS = ("Acceptation", "Acceptation conditionnelle", "Rejet")
+
+# Erreur levée quand des données ne respectent pas le modèle (avec le chemin du champ fautif)
+class ValidationError(ValueError):
+    pass
+
+def _require(data, key, path):
+    if not isinstance(data, dict) or key not in data:
+        raise ValidationError(f"{path}.{key}: champ manquant")
+    return data[key]
+
+def _string(value, path, default=None):
+    if value is None and default is not None:
+        return default
+    if not isinstance(value, str):
+        raise ValidationError(f"{path}: texte attendu, reçu {type(value).__name__}")
+    return value
+
+def _number(value, path, low, high):
+    if isinstance(value, str):
+        try:
+            value = float(value.replace(",", "."))
+        except ValueError:
+            raise ValidationError(f"{path}: nombre attendu, reçu {value!r}")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValidationError(f"{path}: nombre attendu, reçu {type(value).__name__}")
+    if not low <= value <= high:
+        raise ValidationError(f"{path}: {value} hors de l'intervalle [{low}, {high}]")
+    return int(value) if float(value).is_integer() else value
+
+def _strings(value, path):
+    if not isinstance(value, list):
+        raise ValidationError(f"{path}: liste attendue")
+    return [_string(item, f"{path}[{i}]") for i, item in enumerate(value)]
+
+def _section(data, key, path):
+    # Accepte la forme enveloppée {"profile": {...}} comme la section seule
+    return data[key] if isinstance(data, dict) and key in data else data
+
+
+@dataclass(slots=True)
+class Criterion:
+    name: str
+    score: float
+    comment: str = ""
+    financial_perspective: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data, path="criteria"):
+        # Chemin rapide pour le cas courant (types exacts, score entier dans l'intervalle)
+        if type(data) is dict:
+            name, score, comment = data.get("name"), data.get("score"), data.get("comment", "")
+            if type(name) is str and type(score) is int and 0 <= score <= 10 and type(comment) is str \
+                    and data.get("financial_perspective") is None:
+                return cls(name, score, comment)
+        return cls(
+            name=_string(_require(data, "name", path), f"{path}.name"),
+            score=_number(_require(data, "score", path), f"{path}.score", 0, 10),
+            comment=_string(data.get("comment"), f"{path}.comment", default=""),
+            financial_perspective=_string(data["financial_perspective"], f"{path}.financial_perspective")
+                                  if data.get("financial_perspective") is not None else None
+        )
+
+    def to_dict(self):
+        data = {"name": self.name, "score": self.score, "comment": self.comment}
+        if self.financial_perspective is not None:
+            data["financial_perspective"] = self.financial_perspective
+        return data
+
+def _criteria(value, path):
+    if not isinstance(value, list) or not value:
+        raise ValidationError(f"{path}: liste de critères non vide attendue")
+    return [Criterion.from_dict(item, f"{path}[{i}]") for i, item in enumerate(value)]
+
+
+@dataclass(slots=True)
+class Profile:
+    criteria: List[Criterion]
+    ias_score: int
+    summary: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        section = _section(data, "profile", "profile")
+        criteria = _criteria(_require(section, "criteria", "profile"), "profile.criteria")
+        # Score IAS calculé depuis les critères s'il n'est pas fourni
+        ias_score = section.get("ias_score")
+        if ias_score is None:
+            ias_score = round(sum(criterion.score for criterion in criteria) / len(criteria) * 10)
+        return cls(
+            criteria=criteria,
+            ias_score=_number(ias_score, "profile.ias_score", 0, 100),
+            summary=_string(section.get("summary"), "profile.summary", default="")
+        )
+
+    def to_dict(self):
+        return {"profile": {"criteria": [criterion.to_dict() for criterion in self.criteria], "ias_score": self.ias_score, "summary": self.summary}}
+
+
+@dataclass(slots=True)
+class Evaluation:
+    criteria: List[Criterion]
+    global_score: int
+    decision: str
+    recommendations: List[str] = field(default_factory=list)
+    summary: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        section = _section(data, "evaluation", "evaluation")
+        decision = _string(_require(section, "decision", "evaluation"), "evaluation.decision").strip()
+        # Casse et variantes du modèle ramenées aux décisions connues
+        decision = next((known for known in DECISIONS if known.lower() == decision.lower()), decision)
+        if decision not in DECISIONS:
+            raise ValidationError(f"evaluation.decision: {decision!r} n'est pas une décision connue")
+        return cls(
+            criteria=_criteria(_require(section, "criteria", "evaluation"), "evaluation.criteria"),
+            global_score=_number(_require(section, "global_score", "evaluation"), "evaluation.global_score", 0, 100),
+            decision=decision,
+            recommendations=_strings(section.get("recommendations", []), "evaluation.recommendations"),
+            summary=_string(section.get("summary"), "evaluation.summary", default="")
+        )
+
+    def to_dict(self):
+        return {"evaluation": {
+            "criteria": [criterion.to_dict() for criterion in self.criteria],
+            "global_score": self.global_score,
+            "decision": self.decision,
+            "recommendations": list(self.recommendations),
+            "summary": self.summary
+        }}
+
+
+@dataclass(slots=True)
+class EnrichedProfile:
+    criteria: List[Criterion]
+    ias_score: int
+    financial_score: int
+    combined_score: int
+    improvement_areas: List[str] = field(default_factory=list)
+    summary: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        section = _section(data, "profile", "profile")
+        return cls(
+            criteria=_criteria(_require(section, "criteria", "profile"), "profile.criteria"),
+            ias_score=_number(_require(section, "ias_score", "profile"), "profile.ias_score", 0, 100),
+            financial_score=_number(_require(section, "financial_score", "profile"), "profile.financial_score", 0, 100),
+            combined_score=_number(_require(section, "combined_score", "profile"), "profile.combined_score", 0, 100),
+            improvement_areas=_strings(section.get("improvement_areas", []), "profile.improvement_areas"),
+            summary=_string(section.get("summary"), "profile.summary", default="")
+        )
+
+    def to_dict(self):
+        return {"profile": {
+            "criteria": [criterion.to_dict() for criterion in self.criteria],
+            "ias_score": self.ias_score,
+            "financial_score": self.financial_score,
+            "combined_score": self.combined_score,
+            "improvement_areas": list(self.improvement_areas),
+            "summary": self.summary
+        }}
+
+
+@dataclass(slots=True)
+class Question:
+    criterion: str
+    context: str
+    question: str
+
+    @classmethod
+    def from_dict(cls, data, path="questions"):
+        return cls(
+            criterion=_string(_require(data, "criterion", path), f"{path}.criterion"),
+            context=_string(data.get("context"), f"{path}.context", default=""),
+            question=_string(_require(data, "question", path), f"{path}.question")
+        )
+
+    def to_dict(self):
+        return {"criterion": self.criterion, "context": self.context, "question": self.question}
+
+
+# Questions contextualisées pour l'agent financier (une par critère)
+@dataclass(slots=True)
+class Questions:
+    questions: List[Question]
+
+    @classmethod
+    def from_dict(cls, data):
+        items = _require(data, "questions", "questions")
+        if not isinstance(items, list) or not items:
+            raise ValidationError("questions: liste de questions non vide attendue")
+        return cls(questions=[Question.from_dict(item, f"questions[{i}]") for i, item in enumerate(items)])
+
+    def to_dict(self):
+        return {"questions": [question.to_dict() for question in self.questions]}
+
+
+# Fonction pour extraire le JSON d'une réponse du modèle (bloc de code ```json, sinon premier objet du texte)
+def extract_json(response_text):
+    with span("json extract", **{"tafahom.response_chars": len(response_text)}):
+        json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', response_text, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group(1))
+        object_match = re.search(r'({.*})', response_text, re.DOTALL)
+        if object_match is None:
+            raise ValidationError("réponse: aucun objet JSON trouvé")
+        return json.loads(object_match.group(1))
+
+# Fonction pour valider des données brutes et les renvoyer normalisées (forme enveloppée habituelle)
+def validated(model, data):
+    with span(f"json validate {model.__name__}"):
+        return model.from_dict(data).to_dict()
+
+# Encodage/décodage JSON (orjson si disponible)
+def encode_json(instance):
+    if orjson is not None:
+        return orjson.dumps(instance.to_dict())
+    return json.dumps(instance.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def decode_json(model, data):
+    return model.from_dict(orjson.loads(data) if orjson is not None else json.loads(data))
+
+# Encodage/décodage binaire msgpack (stockage compact, module optionnel)
+def encode_msgpack(instance):
+    if msgpack is None:
+        raise RuntimeError("Le module msgpack n'est pas installé")
+    return msgpack.packb(instance.to_dict(), use_bin_type=True)
+
+def decode_msgpack(model, data):
+    if msgpack is None:
+        raise RuntimeError("Le module msgpack n'est pas installé")
+    return model.from_dict(msgpack.unpackb(data, raw=False))
+
+
+if __name__ == "__main__":
+    # Banc d'essai: chargement/écriture de N profils (10 000 par défaut), json.load actuel contre les modèles
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    criteria_names = [f"Critère {i}" for i in range(10)]
+    payloads = [
+        {"profile": {
+            "criteria": [{"name": name, "score": random.randint(1, 10), "comment": "Commentaire " * random.randint(5, 30)} for name in criteria_names],
+            "ias_score": random.randint(10, 100),
+            "summary": "Synthèse " * 40
+        }}
+        for _ in range(count)
+    ]
+
+    def timed(label, function):
+        start = time.perf_counter()
+        result = function()
+        print(f"{label:<48} {time.perf_counter() - start:8.3f} s")
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i, payload in enumerate(payloads):
+            path = os.path.join(directory, f"tafahom_profil_{i}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, indent=2)
+            paths.append(path)
+
+        print(f"{count} profils (orjson: {'oui' if orjson else 'non'}, msgpack: {'oui' if msgpack else 'non'})")
+
+        def load_json():
+            loaded = []
+            for path in paths:
+                with open(path, "r", encoding="utf-8") as f:
+                    loaded.append(json.load(f))
+            return loaded
+
+        def load_models():
+            loaded = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    loaded.append(decode_json(Profile, f.read()))
+            return loaded
+
+        timed("chargement json.load (actuel, sans validation)", load_json)
+        models = timed("chargement modèles (décodage + validation)", load_models)
+        timed("écriture json.dumps indent=2 (actuel)", lambda: [json.dumps(payload, ensure_ascii=False, indent=2) for payload in payloads])
+        encoded = timed("écriture encode_json", lambda: [encode_json(model) for model in models])
+        print(f"{'taille JSON indenté / compact':<48} {sum(os.path.getsize(path) for path in paths) / 1e6:8.1f} Mo / {sum(map(len, encoded)) / 1e6:.1f} Mo")
+        if msgpack is not None:
+            packed = timed("écriture encode_msgpack", lambda: [encode_msgpack(model) for model in models])
+            timed("chargement decode_msgpack (avec validation)", lambda: [decode_msgpack(Profile, data) for data in packed])
+            print(f"{'taille msgpack':<48} {sum(map(len, packed)) / 1e6:8.1f} Mo")
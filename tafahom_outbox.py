@@ -0,0 +1,266 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from tafahom_journal import log_event
+from tafahom_llm import LLMBusyError, LLMQuotaError, LLMUnavailableError, breaker_for, chat_completion, is_outage
+from tafahom_metriques import increment, set_gauge
+from tafahom_modeles import EnrichedProfile, Evaluation, Profile, extract_json, validated
+from tafahom_questions import precompute_questions
+from tafahom_quotas import batch_priority, estimate_completion, purge, quotas_enabled
+from tafahom_reception import announce_profile
+from tafahom_recherche import index_comments
+from tafahom_stockage import atomic_write_json, connect_database, data_path, enriched_profile_path, evaluation_path, profile_path
+from tafahom_traces import span
+
+# File d'attente durable des travaux non interactifs (profil, évaluation, profil enrichi) demandés pendant une
+# panne du service: la requête est conservée sur disque et rejouée dès que le disjoncteur se referme,
+# le résultat est livré dans le stockage des profils comme s'il avait été produit pendant la session
+OUTBOX_FILE = data_path("tafahom_outbox.sqlite")
+
+# Intervalle (s) entre deux passages du traitement de la file
+POLL_INTERVAL = float(os.getenv("TAFAHOM_OUTBOX_POLL_INTERVAL", "5"))
+
+# Nombre d'échecs (réponse inexploitable, hors panne) avant abandon d'un travail
+MAX_ATTEMPTS = 5
+
+# Un travail en cours depuis ce délai (s) est repris par un autre processus (traitement interrompu)
+LEASE_SECONDS = 600
+
+# Intervalle (s) entre deux purges de la consommation des quotas au-delà de leur durée de conservation
+QUOTA_PURGE_INTERVAL = 3600
+
+# Modèle de validation et site d'appel de chaque type de travail
+JOB_KINDS = {
+    "profile": (Profile, "generate_profile"),
+    "evaluation": (Evaluation, "generate_final_evaluation"),
+    "enriched_profile": (EnrichedProfile, "generate_updated_artist_profile")
+}
+
+# Statuts d'un travail
+STATUS_LABELS = {
+    "en_attente": "⏳ En attente",
+    "en_cours": "En cours",
+    "livre": "✅ Livré",
+    "echec": "❌ Échec"
+}
+
+# Fonction pour ouvrir la base et créer la table au besoin
+def _connect(outbox_file=OUTBOX_FILE):
+    return connect_database(outbox_file, schema=(
+        """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'en_attente',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                lease TEXT,
+                leased_until REAL,
+                error TEXT,
+                UNIQUE (kind, conversation_id)
+            )
+        """,
+    ))
+
+# Fonction pour mettre un travail en file (une demande en attente par type et conversation: la dernière l'emporte)
+def enqueue(kind, conversation_id, messages, outbox_file=OUTBOX_FILE, **params):
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Type de travail inconnu: {kind}")
+    now = time.time()
+    with closing(_connect(outbox_file)) as connection, connection:
+        connection.execute(
+            """
+            INSERT INTO jobs (kind, conversation_id, messages, params, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (kind, conversation_id) DO UPDATE SET
+                messages = excluded.messages, params = excluded.params, status = 'en_attente', attempts = 0,
+                created_at = excluded.created_at, next_attempt_at = excluded.next_attempt_at, lease = NULL, error = NULL
+            WHERE jobs.status != 'en_cours'
+            """,
+            (kind, conversation_id, json.dumps(messages, ensure_ascii=False), json.dumps(params), now, now)
+        )
+    increment("tafahom_outbox_enqueued_total", kind=kind)
+    _publish(outbox_file)
+
+# Fonction pour connaître le statut du travail d'une conversation (None s'il n'y en a pas)
+def job_status(kind, conversation_id, outbox_file=OUTBOX_FILE):
+    with closing(_connect(outbox_file)) as connection:
+        row = connection.execute("SELECT status FROM jobs WHERE kind = ? AND conversation_id = ?", (kind, conversation_id)).fetchone()
+    return row[0] if row else None
+
+def list_jobs(include_delivered=False, outbox_file=OUTBOX_FILE):
+    query = "SELECT id, kind, conversation_id, status, attempts, created_at, error FROM jobs"
+    if not include_delivered:
+        query += " WHERE status != 'livre'"
+    with closing(_connect(outbox_file)) as connection:
+        rows = connection.execute(query + " ORDER BY id").fetchall()
+    return [
+        {"id": job_id, "kind": kind, "conversation_id": conversation_id, "status": status, "attempts": attempts, "created_at": created_at, "error": error}
+        for job_id, kind, conversation_id, status, attempts, created_at, error in rows
+    ]
+
+def pending_count(outbox_file=OUTBOX_FILE):
+    with closing(_connect(outbox_file)) as connection:
+        return connection.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('en_attente', 'en_cours')").fetchone()[0]
+
+def _publish(outbox_file=OUTBOX_FILE):
+    set_gauge("tafahom_outbox_pending", pending_count(outbox_file))
+
+# Fonction pour réserver le prochain travail prêt (une seule instruction: deux processus ne prennent pas le même)
+def _lease_next(outbox_file):
+    now, lease = time.time(), uuid.uuid4().hex
+    with closing(_connect(outbox_file)) as connection, connection:
+        connection.execute(
+            """
+            UPDATE jobs SET status = 'en_cours', lease = ?, leased_until = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'en_attente' AND next_attempt_at <= ?) OR (status = 'en_cours' AND leased_until < ?)
+                ORDER BY id LIMIT 1
+            )
+            """,
+            (lease, now + LEASE_SECONDS, now, now)
+        )
+        row = connection.execute("SELECT id, kind, conversation_id, messages, params, attempts FROM jobs WHERE lease = ?", (lease,)).fetchone()
+    if row is None:
+        return None
+    job_id, kind, conversation_id, messages, params, attempts = row
+    return {"id": job_id, "kind": kind, "conversation_id": conversation_id, "messages": json.loads(messages),
+            "params": json.loads(params), "attempts": attempts, "lease": lease}
+
+def _finish(job, outbox_file, status, delay=0.0, attempts=None, error=None):
+    with closing(_connect(outbox_file)) as connection, connection:
+        connection.execute(
+            "UPDATE jobs SET status = ?, next_attempt_at = ?, attempts = ?, error = ?, lease = NULL WHERE id = ? AND lease = ?",
+            (status, time.time() + delay, job["attempts"] if attempts is None else attempts, error, job["id"], job["lease"])
+        )
+
+# Fonction pour livrer le résultat d'un travail dans le stockage des profils (mêmes effets que dans les applications)
+def _deliver(client, job, response_text):
+    model, _ = JOB_KINDS[job["kind"]]
+    data = validated(model, extract_json(response_text))
+    conversation_id = job["conversation_id"]
+
+    if job["kind"] == "profile":
+        # Profil généré hors session: transmis directement à TAFAHOM-Agent
+        with span("file write profil"):
+            atomic_write_json(profile_path(conversation_id), data)
+        index_comments(conversation_id, data, kind="profil")
+        announce_profile(conversation_id, data)
+        log_event(conversation_id, "profile_generated", ias_score=data["profile"]["ias_score"], outbox=True)
+        log_event(conversation_id, "profile_exported", outbox=True)
+        precompute_questions(client, conversation_id, data, job["params"].get("model"))
+    elif job["kind"] == "evaluation":
+        with span("file write evaluation"):
+            atomic_write_json(evaluation_path(conversation_id), data)
+        index_comments(conversation_id, data, kind="evaluation")
+    else:
+        with span("file write profil enrichi"):
+            atomic_write_json(enriched_profile_path(conversation_id), data)
+    return data
+
+# Fonction pour décrire l'état du service et de la file (barre latérale des applications)
+def service_status(client, outbox_file=OUTBOX_FILE):
+    breaker = breaker_for(client)
+    status = "disponible" if breaker.state == "ferme" else f"indisponible (nouvel essai dans {breaker.retry_in():.0f} s)"
+    pending = pending_count(outbox_file)
+    if not pending:
+        return status
+    if quotas_enabled():
+        # Heure de fin estimée des travaux en file selon la part du quota laissée à l'arrière-plan
+        eta = estimate_completion([
+            JOB_KINDS[job["kind"]][1] for job in list_jobs(outbox_file=outbox_file) if job["status"] in ("en_attente", "en_cours")
+        ])
+        if eta is not None:
+            return f"{status}, {pending} travail(aux) en file (fin estimée vers {time.strftime('%H:%M', time.localtime(eta))})"
+    return f"{status}, {pending} travail(aux) en file"
+
+# Fonction pour traiter les travaux prêts tant que le service répond et que le quota le permet (priorité
+# des travaux d'arrière-plan); renvoie le nombre de travaux livrés
+def process_pending(client, outbox_file=OUTBOX_FILE):
+    with batch_priority():
+        return _process_pending(client, outbox_file)
+
+def _process_pending(client, outbox_file):
+    delivered = 0
+    while breaker_for(client).state != "ouvert" or breaker_for(client).retry_in() == 0:
+        job = _lease_next(outbox_file)
+        if job is None:
+            break
+        model, call_site = JOB_KINDS[job["kind"]]
+        try:
+            with span(f"outbox {job['kind']}", job["conversation_id"], service="outbox", **{"tafahom.job_id": job["id"]}):
+                try:
+                    response_text = chat_completion(client, call_site, job["messages"], conversation_id=job["conversation_id"],
+                                                    validate=lambda text: validated(model, extract_json(text)), **job["params"])
+                except LLMQuotaError as e:
+                    # Part du quota épuisée: le travail est reporté à la fin de l'attente annoncée, sans compter d'échec
+                    _finish(job, outbox_file, "en_attente", delay=e.retry_in)
+                    increment("tafahom_outbox_deferred_total", kind=job["kind"])
+                    break
+                except Exception as e:
+                    # Seules les erreurs de l'appel au service comptent comme une panne; une réponse inexploitable
+                    # (validation, livraison) est un échec du travail, compté ci-dessous, et le passage continue
+                    if not (isinstance(e, (LLMUnavailableError, LLMBusyError)) or is_outage(e)):
+                        raise
+                    # Service toujours indisponible: le travail attend le prochain passage, sans compter d'échec
+                    _finish(job, outbox_file, "en_attente", delay=POLL_INTERVAL)
+                    break
+                _deliver(client, job, response_text)
+        except Exception as e:
+            attempts = job["attempts"] + 1
+            status = "echec" if attempts >= MAX_ATTEMPTS else "en_attente"
+            _finish(job, outbox_file, status, delay=min(600, POLL_INTERVAL * 2 ** attempts), attempts=attempts, error=str(e))
+            increment("tafahom_outbox_failures_total", kind=job["kind"])
+        else:
+            _finish(job, outbox_file, "livre")
+            increment("tafahom_outbox_delivered_total", kind=job["kind"])
+            delivered += 1
+    _publish(outbox_file)
+    return delivered
+
+def _run_worker(client, outbox_file):
+    purged_at = None
+    while True:
+        try:
+            process_pending(client, outbox_file)
+            if quotas_enabled() and (purged_at is None or time.monotonic() - purged_at >= QUOTA_PURGE_INTERVAL):
+                purge()
+                purged_at = time.monotonic()
+        except Exception:
+            pass  # base momentanément verrouillée: nouvel essai au prochain passage
+        time.sleep(POLL_INTERVAL)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+# Fonction pour démarrer (une fois par processus) le traitement de la file en arrière-plan
+def start_worker(client, outbox_file=OUTBOX_FILE):
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, args=(client, outbox_file), daemon=True)
+            _worker.start()
+        return _worker
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        # Traitement ponctuel de la file (tâche planifiée, sans application ouverte)
+        from dotenv import load_dotenv
+        from together import Together
+
+        load_dotenv()
+        print(f"{process_pending(Together(api_key=os.getenv('TOGETHER_API_KEY')))} travaux livrés")
+    for job in list_jobs(include_delivered="--all" in sys.argv[1:]):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(job["created_at"]))
+        print(f"{job['id']:>5}  {job['kind']:<17} {job['conversation_id']}  {created}  {STATUS_LABELS[job['status']]}  "
+              f"essais: {job['attempts']}{'  ' + job['error'] if job['error'] else ''}")
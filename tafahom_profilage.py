@@ -0,0 +1,185 @@
+import html
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Profilage par échantillonnage des exécutions du script Streamlit (outil de développement): un thread relève
+# la pile du thread du script à intervalle régulier; les piles sont agrégées par application et par étape
+# (current_step) sur toutes les exécutions profilées du processus. Désactivé, il ne coûte qu'un test par exécution.
+
+# Intervalle d'échantillonnage (s)
+SAMPLE_INTERVAL = float(os.getenv("TAFAHOM_PROFILE_INTERVAL_MS", "5")) / 1000
+
+# Nombre maximal de piles distinctes conservées par étape (au-delà, les nouvelles piles sont regroupées)
+MAX_STACKS = 20000
+
+# Échantillonneur d'un thread: piles repliées (racine;...;feuille) et nombre d'échantillons
+class Sampler:
+    def __init__(self, thread_id, script_path, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.script_path = script_path
+        self.interval = interval
+        self.stacks = Counter()
+        self.started_at = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _frame_label(self, frame):
+        code = frame.f_code
+        label = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        # Code au niveau du module (scripts Streamlit): la ligne est le point chaud
+        return f"{label}:{frame.f_lineno}" if code.co_name == "<module>" else label
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                # La pile s'arrête au script: les couches d'exécution de Streamlit ne sont pas utiles
+                if frame.f_code.co_name == "<module>" and os.path.basename(frame.f_code.co_filename) == os.path.basename(self.script_path):
+                    break
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return time.perf_counter() - self.started_at
+
+
+# Profils agrégés du processus: (application, étape) -> piles, exécutions, durée totale
+_stacks = defaultdict(Counter)
+_runs = Counter()
+_durations = defaultdict(float)
+_lock = threading.Lock()
+
+# Échantillonneurs en cours, par session: (échantillonneur, application, étape)
+_active = {}
+
+def _finish(session_key):
+    with _lock:
+        active = _active.pop(session_key, None)
+    if active is None:
+        return
+    sampler, app, step = active
+    duration = sampler.stop()
+    with _lock:
+        key = (app, step)
+        _runs[key] += 1
+        _durations[key] += duration
+        stacks = _stacks[key]
+        for stack, count in sampler.stacks.items():
+            if stack in stacks or len(stacks) < MAX_STACKS:
+                stacks[stack] += count
+            else:
+                stacks["(autres piles)"] += count
+
+# Fonction pour démarrer le profilage de l'exécution en cours (appelée en tout début de script, imports compris);
+# une exécution précédente interrompue (st.rerun) est clôturée à cet instant
+def begin_profile(session_key, enabled, app, script_path):
+    if session_key in _active:
+        _finish(session_key)
+    if not enabled:
+        return
+    with _lock:
+        _active[session_key] = (Sampler(threading.get_ident(), script_path), app, "inconnue")
+
+# Fonction pour rattacher l'exécution en cours à une étape (après l'initialisation de l'état de session)
+def tag_profile(session_key, step):
+    with _lock:
+        if session_key in _active:
+            sampler, app, _ = _active[session_key]
+            _active[session_key] = (sampler, app, step)
+
+def end_profile(session_key):
+    if session_key in _active:
+        _finish(session_key)
+
+def reset_profiles(app):
+    with _lock:
+        for key in [key for key in _runs if key[0] == app]:
+            _stacks.pop(key, None)
+            _runs.pop(key, None)
+            _durations.pop(key, None)
+
+
+# Fonction pour résumer les exécutions profilées par étape (nombre, durée moyenne)
+def profile_summary(app):
+    with _lock:
+        return [
+            {"step": step, "runs": _runs[(app, step)], "mean_ms": _durations[(app, step)] / _runs[(app, step)] * 1000, "samples": sum(_stacks[(app, step)].values())}
+            for (run_app, step) in sorted(_runs) if run_app == app
+        ]
+
+def _merged_stacks(app, step=None):
+    merged = Counter()
+    with _lock:
+        for (run_app, run_step), stacks in _stacks.items():
+            if run_app == app and (step is None or run_step == step):
+                merged.update(stacks)
+    return merged
+
+# Fonction pour lister les points chauds: part des échantillons où la fonction (ou ligne) est en cours
+# d'exécution (propre) ou sur la pile (inclusive)
+def hotspots(app, step=None, limit=15):
+    stacks = _merged_stacks(app, step)
+    total = sum(stacks.values())
+    if not total:
+        return []
+    own, inclusive = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    return [
+        {"frame": frame, "self": own[frame] / total, "inclusive": inclusive[frame] / total}
+        for frame, _ in sorted(inclusive.items(), key=lambda item: (-own[item[0]], -item[1]))[:limit]
+    ]
+
+# Fonction pour exporter les piles au format replié (flamegraph.pl, speedscope, inferno)
+def folded(app, step=None):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(_merged_stacks(app, step).items()))
+
+# Fonction pour dessiner le flame graph en SVG (largeur proportionnelle au nombre d'échantillons)
+def flame_graph_svg(app, step=None, width=1200, row_height=18):
+    stacks = _merged_stacks(app, step)
+    total = sum(stacks.values())
+    tree = {"children": {}, "count": 0}
+    depth = 0
+    for stack, count in stacks.items():
+        node = tree
+        node["count"] += count
+        frames = stack.split(";")
+        depth = max(depth, len(frames))
+        for frame in frames:
+            node = node["children"].setdefault(frame, {"children": {}, "count": 0})
+            node["count"] += count
+
+    rects = []
+    def draw(node, x, level):
+        for name, child in sorted(node["children"].items()):
+            child_width = child["count"] / total * width
+            if child_width >= 0.5:
+                y = (depth - level - 1) * row_height
+                hue = 20 + sum(map(ord, name)) % 40
+                max_chars = int(child_width / 7)
+                label = html.escape(name if len(name) <= max_chars else (name[:max_chars - 1] + "…" if max_chars > 3 else ""))
+                rects.append(
+                    f'<g><title>{html.escape(name)} ({child["count"]} échantillons, {child["count"] / total:.1%})</title>'
+                    f'<rect x="{x:.1f}" y="{y}" width="{child_width:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+                    f'<text x="{x + 3:.1f}" y="{y + row_height - 5}" font-size="11" font-family="monospace">{label}</text></g>'
+                )
+                draw(child, x, level + 1)
+            x += child_width
+
+    if total:
+        draw(tree, 0.0, 0)
+    height = max(1, depth) * row_height
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+            + "".join(rects) + "</svg>")
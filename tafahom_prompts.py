@@ -0,0 +1,154 @@
+import glob
+import json
+import math
+import os
+import sys
+
+from tafahom_metriques import counter_value, increment
+from tafahom_stockage import DATA_DIR, read_json
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken optionnel: estimation par la taille en octets
+    tiktoken = None
+
+# Empaquetage des données (profil, réponses, évaluation) dans les prompts: JSON compact, champs utiles
+# au site d'appel seulement, comptage des tokens avant envoi et mesure des tokens économisés
+
+# Fenêtre de contexte du modèle (tokens): prompt + réponse attendue doivent y tenir
+CONTEXT_TOKENS = int(os.getenv("TAFAHOM_LLM_CONTEXT_TOKENS", "8192"))
+
+# Octets par token pour l'estimation sans tokenizer (texte français en UTF-8)
+BYTES_PER_TOKEN = 4
+
+# Champs des critères d'un profil ou d'une évaluation transmis au modèle
+CRITERION_FIELDS = ("name", "score", "comment")
+
+# Erreur levée quand un prompt ne tient pas dans la fenêtre de contexte
+class PromptBudgetError(Exception):
+    pass
+
+_encoding = tiktoken.get_encoding("cl100k_base") if tiktoken else None
+
+# Fonction pour compter (ou estimer) les tokens d'un texte
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text.encode("utf-8")) / BYTES_PER_TOKEN)
+
+def count_message_tokens(messages):
+    # ~4 tokens d'enveloppe par message (rôle, délimiteurs)
+    return sum(count_tokens(message["content"]) + 4 for message in messages)
+
+# Fonction pour sérialiser sans indentation ni espaces superflus
+def compact_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+# Fonction pour ne garder que les champs utiles d'un profil (critères: nom, score, commentaire)
+def prune_profile(profile_data, fields=("criteria", "ias_score", "summary")):
+    profile = profile_data.get("profile", {})
+    pruned = {key: profile[key] for key in fields if key in profile and key != "criteria"}
+    if "criteria" in fields:
+        pruned["criteria"] = [
+            {key: criterion[key] for key in CRITERION_FIELDS if key in criterion}
+            for criterion in profile.get("criteria", [])
+        ]
+    return {"profile": pruned}
+
+# Fonction pour ne garder que les champs utiles d'une évaluation
+def prune_evaluation(evaluation_data):
+    evaluation = evaluation_data.get("evaluation", {})
+    pruned = {key: evaluation[key] for key in ("global_score", "decision", "recommendations", "summary") if key in evaluation}
+    pruned["criteria"] = [
+        {key: criterion[key] for key in CRITERION_FIELDS if key in criterion}
+        for criterion in evaluation.get("criteria", [])
+    ]
+    return {"evaluation": pruned}
+
+# Fonction pour empaqueter les réponses du financier: le contexte de chaque question n'est pas répété
+# (le modèle l'a tiré du profil, qui figure déjà dans le prompt), seuls la question, l'avis et la note sont transmis
+def pack_responses(criteria, contextualized_questions, financier_responses):
+    return [
+        {
+            "criterion": criterion,
+            "question": contextualized_questions["questions"][i]["question"],
+            "text": financier_responses.get(f"question_{i}", ""),
+            "score": financier_responses.get(f"score_{i}", 5)
+        }
+        for i, criterion in enumerate(criteria)
+    ]
+
+# Format historique des réponses (contexte répété pour chaque question), conservé pour mesurer l'économie
+def unpacked_responses(criteria, contextualized_questions, financier_responses):
+    return {
+        criterion: {
+            "text": financier_responses.get(f"question_{i}", ""),
+            "score": financier_responses.get(f"score_{i}", 5),
+            "question_context": contextualized_questions["questions"][i]["context"],
+            "question": contextualized_questions["questions"][i]["question"]
+        }
+        for i, criterion in enumerate(criteria)
+    }
+
+# Empaquetage des données d'un prompt pour un site d'appel: chaque bloc est sérialisé de façon compacte,
+# et sa version non empaquetée (JSON indenté complet) sert à mesurer les tokens économisés
+class PromptPacker:
+    def __init__(self, call_site):
+        self.call_site = call_site
+        self.packed_tokens = 0
+        self.unpacked_tokens = 0
+
+    def add(self, packed_data, unpacked_data):
+        text = compact_json(packed_data)
+        self.packed_tokens += count_tokens(text)
+        self.unpacked_tokens += count_tokens(json.dumps(unpacked_data, ensure_ascii=False, indent=2))
+        return text
+
+    # Fonction pour vérifier le budget avant l'envoi et publier les tokens envoyés et économisés
+    def check(self, messages, max_tokens):
+        prompt_tokens = count_message_tokens(messages)
+        if prompt_tokens + max_tokens > CONTEXT_TOKENS:
+            increment("tafahom_prompt_over_budget_total", call_site=self.call_site)
+            raise PromptBudgetError(
+                f"Prompt trop long pour {self.call_site}: {prompt_tokens} tokens + {max_tokens} de réponse > {CONTEXT_TOKENS}"
+            )
+        saved = max(0, self.unpacked_tokens - self.packed_tokens)
+        increment("tafahom_prompt_calls_total", call_site=self.call_site)
+        increment("tafahom_prompt_tokens_total", prompt_tokens, call_site=self.call_site)
+        increment("tafahom_prompt_tokens_saved_total", saved, call_site=self.call_site)
+        return {"prompt_tokens": prompt_tokens, "saved_tokens": saved}
+
+# Fonction pour résumer les tokens envoyés et économisés par site d'appel depuis le démarrage du processus
+def savings_report(call_sites=("contextualize_questions", "contextualize_contexts", "generate_final_evaluation", "reevaluate_criteria", "refresh_synthesis", "generate_updated_artist_profile")):
+    report = {}
+    for call_site in call_sites:
+        sent = counter_value("tafahom_prompt_tokens_total", call_site=call_site)
+        saved = counter_value("tafahom_prompt_tokens_saved_total", call_site=call_site)
+        report[call_site] = {
+            "calls": int(counter_value("tafahom_prompt_calls_total", call_site=call_site)),
+            "sent": int(sent),
+            "saved": int(saved),
+            "ratio": saved / (sent + saved) if sent + saved else 0.0
+        }
+    return report
+
+
+if __name__ == "__main__":
+    # Mesure sur les profils et évaluations stockés: tokens des blocs de données, avant et après empaquetage
+    directory = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
+    totals = {"profil": [0, 0], "évaluation": [0, 0]}
+    for path in glob.glob(os.path.join(directory, "tafahom_profil_*.json")):
+        if os.path.basename(path).startswith("tafahom_profil_enrichi_"):
+            continue
+        profile_data = read_json(path)
+        totals["profil"][0] += count_tokens(json.dumps(profile_data, ensure_ascii=False, indent=2))
+        totals["profil"][1] += count_tokens(compact_json(prune_profile(profile_data)))
+    for path in glob.glob(os.path.join(directory, "tafahom_evaluation_*.json")):
+        evaluation_data = read_json(path)
+        totals["évaluation"][0] += count_tokens(json.dumps(evaluation_data, ensure_ascii=False, indent=2))
+        totals["évaluation"][1] += count_tokens(compact_json(prune_evaluation(evaluation_data)))
+
+    print(f"Comptage: {'tiktoken cl100k_base' if _encoding else f'estimation ({BYTES_PER_TOKEN} octets/token)'}")
+    for kind, (before, after) in totals.items():
+        if before:
+            print(f"{kind}: {before} -> {after} tokens ({(before - after) / before:.0%} économisés)")
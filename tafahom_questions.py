@@ -0,0 +1,259 @@
+import hashlib
+import json
+import threading
+
+from tafahom_cache import get_or_compute
+from tafahom_gabarits import find_scaffold, store_scaffold
+from tafahom_llm import chat_completion
+from tafahom_modeles import Questions, ValidationError, extract_json, validated
+from tafahom_prompts import PromptPacker, compact_json, prune_profile
+from tafahom_quotas import batch_priority
+from tafahom_stockage import atomic_write_json, questions_path, read_json
+from tafahom_traces import span, start_thread
+
+# Banque de questions du financier, partagée par le portail (précalcul à l'export) et TAFAHOM-Agent
+
+# Critères d'évaluation pour le financier
+EVALUATION_CRITERIA = [
+    "Capital culturel incorporé",
+    "Capital objectivé",
+    "Capital institutionnalisé",
+    "Capital symbolique reconnu",
+    "Alignement narratif interprétatif",
+    "Ancrage territorial / communautaire",
+    "Capacité de projection identitaire",
+    "Soutien socio-culturel mobilisable",
+    "Usage social du projet artistique",
+    "Continuité d'engagement culturel"
+]
+
+# Questions de base (qui seront contextualisées)
+BASE_QUESTIONS = [
+    "En analysant le savoir-faire transmis, pensez-vous que ce capital culturel incorporé représente un atout économique viable?",
+    "Ces productions tangibles (œuvres, spectacles, enregistrements) vous semblent-elles suffisamment valorisables sur le marché?",
+    "Les reconnaissances formelles ou distinctions mentionnées constituent-elles des garanties crédibles pour une institution financière?",
+    "La notoriété et la réputation locale du porteur représentent-elles une forme de garantie morale pour un financement?",
+    "La cohérence du récit et la capacité du porteur à formuler son projet sont-elles suffisantes pour assurer sa viabilité?",
+    "L'ancrage territorial du porteur peut-il constituer un atout commercial et une garantie de stabilité pour ce projet?",
+    "La vision de développement présentée vous paraît-elle réaliste et compatible avec nos contraintes de financement?",
+    "Les réseaux et soutiens mentionnés pourraient-ils jouer le rôle de garants implicites en cas de difficulté?",
+    "L'impact social et culturel de ce projet peut-il être converti en valeur ajoutée économique ou en notoriété positive?",
+    "L'engagement et la persévérance du porteur compensent-ils d'éventuelles faiblesses dans son modèle économique?"
+]
+
+# Système prompt pour la contextualisation
+CONTEXTUALIZE_SYSTEM_PROMPT = """Tu es TAFAHOM-AGENT, un système qui contextualise des questions d'évaluation financière à partir d'un profil artistique.
+
+🎯 Objectif principal :
+Pour chaque critère et sa question associée, tu dois:
+1. Extraire les informations pertinentes du profil artiste liées à ce critère
+2. Présenter ces informations de manière concise et factuelle
+3. Reformuler la question de base pour qu'elle soit directement liée au contenu du profil
+
+Format de sortie pour chaque question:
+```
+{
+  "questions": [
+    {
+      "criterion": "Nom du critère",
+      "context": "Présentation factuelle des éléments du profil liés à ce critère (3-4 phrases)",
+      "question": "Question reformulée et contextualisée"
+    },
+    ...
+  ]
+}
+```
+
+Note: La présentation des éléments du profil doit être objective et factuelle, tandis que la question doit inviter à l'analyse financière.
+"""
+
+# Système prompt pour régénérer les seuls contextes (questions reprises d'un profil quasi identique)
+CONTEXTS_SYSTEM_PROMPT = """Tu es TAFAHOM-AGENT, un système qui contextualise des questions d'évaluation financière à partir d'un profil artistique.
+
+Les questions sont déjà rédigées. Pour chaque critère, dans l'ordre donné, présente de manière concise et factuelle
+les informations du profil liées à ce critère (3-4 phrases).
+
+Format de sortie:
+```
+{
+  "contexts": ["Contexte du premier critère", "Contexte du deuxième critère", ...]
+}
+```
+"""
+
+# Fonction pour calculer la version du gabarit des questions (banque de questions + prompt + modèle), commune à tous les profils
+def scaffold_version(model):
+    payload = json.dumps([EVALUATION_CRITERIA, BASE_QUESTIONS, CONTEXTUALIZE_SYSTEM_PROMPT, model], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Fonction pour calculer la version des questions d'un profil (profil + banque de questions + prompt + modèle):
+# les questions précalculées ne sont réutilisées que si cette version n'a pas changé
+def questions_version(profile_data, model):
+    payload = json.dumps(
+        [profile_data, EVALUATION_CRITERIA, BASE_QUESTIONS, CONTEXTUALIZE_SYSTEM_PROMPT, model],
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Fonction pour contextualiser les questions en fonction du profil (lève une exception en cas d'échec), une seule
+# fois pour toutes les répliques (cache partagé par version des questions: le précalcul du portail et le financier
+# ne contextualisent pas le même profil en parallèle)
+def contextualize(client, profile_data, conversation_id, model):
+    return get_or_compute(
+        "questions", [questions_version(profile_data, model)],
+        lambda: _contextualize(client, profile_data, conversation_id, model)
+    )[0]
+
+# Si un profil quasi identique a déjà été contextualisé, ses questions sont reprises et seuls les contextes sont régénérés
+def _contextualize(client, profile_data, conversation_id, model):
+    version = scaffold_version(model)
+    with span("questions scaffold lookup", conversation_id) as lookup:
+        scaffold = find_scaffold(profile_data, version)
+        lookup.set(**{"tafahom.scaffold_hit": scaffold is not None})
+    if scaffold is not None:
+        try:
+            return contextualize_from_scaffold(client, profile_data, conversation_id, model, scaffold["questions"])
+        except Exception:
+            pass  # réponse inexploitable: contextualisation complète
+
+    questions = contextualize_full(client, profile_data, conversation_id, model)
+    store_scaffold(conversation_id, profile_data, version, questions)
+    return questions
+
+# Fonction pour régénérer les contextes d'un gabarit de questions (réponse courte: un contexte par critère)
+def contextualize_from_scaffold(client, profile_data, conversation_id, model, scaffold):
+    packer = PromptPacker("contextualize_contexts")
+    profile_context = packer.add(prune_profile(profile_data, fields=("criteria", "summary")), profile_data)
+    criteria = [item["criterion"] for item in scaffold]
+
+    messages = [
+        {"role": "system", "content": CONTEXTS_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Voici le profil d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici les critères, dans l'ordre:\n\n{compact_json({'criteria': criteria})}\n\nRetourne uniquement les contextes, dans le JSON structuré."}
+    ]
+    packer.check(messages, max_tokens=1500)
+
+    # Questions du gabarit complétées par les contextes reçus (lève une exception si la réponse est inexploitable)
+    def complete(response_text):
+        contexts = extract_json(response_text)["contexts"]
+        if len(contexts) != len(scaffold) or not all(isinstance(context, str) for context in contexts):
+            raise ValidationError(f"{len(contexts)} contextes reçus pour {len(scaffold)} questions")
+        return validated(Questions, {"questions": [
+            {"criterion": item["criterion"], "context": context, "question": item["question"]}
+            for item, context in zip(scaffold, contexts)
+        ]})
+
+    response_text = chat_completion(
+        client,
+        "contextualize_contexts",
+        messages,
+        conversation_id=conversation_id,
+        validate=complete,
+        model=model,
+        temperature=0.5,
+        max_tokens=1500,
+        top_p=0.9
+    )
+    return complete(response_text)
+
+# Fonction pour contextualiser toutes les questions (contextes et questions reformulées)
+def contextualize_full(client, profile_data, conversation_id, model):
+    packer = PromptPacker("contextualize_questions")
+
+    # Préparer le contexte du profil (le score IAS n'est pas utile pour contextualiser)
+    profile_context = packer.add(prune_profile(profile_data, fields=("criteria", "summary")), profile_data)
+
+    # Préparer les critères et questions
+    criteria_questions = []
+    for criterion, question in zip(EVALUATION_CRITERIA, BASE_QUESTIONS):
+        criteria_questions.append({"criterion": criterion, "base_question": question})
+
+    criteria_context = packer.add(criteria_questions, criteria_questions)
+
+    # Construire le message pour le modèle
+    messages = [
+        {"role": "system", "content": CONTEXTUALIZE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Voici le profil d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici les critères et questions de base pour l'évaluation financière:\n\n{criteria_context}\n\nContextualise chaque question en présentant d'abord les éléments pertinents du profil puis en posant la question adaptée. Retourne uniquement le JSON structuré."}
+    ]
+    packer.check(messages, max_tokens=2500)
+
+    # Appeler l'API
+    response_text = chat_completion(
+        client,
+        "contextualize_questions",
+        messages,
+        conversation_id=conversation_id,
+        hedge=True,
+        validate=lambda text: validated(Questions, extract_json(text)),
+        model=model,
+        temperature=0.5,
+        max_tokens=2500,
+        top_p=0.9
+    )
+
+    # Extraire, parser et valider le JSON
+    return validated(Questions, extract_json(response_text))
+
+# Fonction pour créer une version par défaut des questions (en cas d'échec de la contextualisation)
+def default_questions():
+    questions = {"questions": []}
+    for criterion, question in zip(EVALUATION_CRITERIA, BASE_QUESTIONS):
+        questions["questions"].append({
+            "criterion": criterion,
+            "context": f"Évaluez le porteur sur son {criterion}.",
+            "question": question
+        })
+    return questions
+
+# Fonction pour construire les questions sans appel au modèle (dossier tranché par le pré-examen): le contexte de
+# chaque question reprend l'évaluation du critère par TAFAHOM-Portail
+def profile_questions(profile_data):
+    criteria = {criterion.get("name"): criterion for criterion in profile_data.get("profile", {}).get("criteria", [])}
+    questions = default_questions()
+    for item in questions["questions"]:
+        criterion = criteria.get(item["criterion"])
+        if criterion:
+            item["context"] = f"Évaluation TAFAHOM-Portail ({criterion.get('score')}/10): {criterion.get('comment', '')}"
+    return questions
+
+# Fonction pour enregistrer des questions contextualisées à côté du profil, avec leur version
+def save_questions(conversation_id, profile_data, model, questions):
+    with span("file write questions", conversation_id):
+        atomic_write_json(questions_path(conversation_id), {
+            "version": questions_version(profile_data, model),
+            "questions": questions
+        })
+
+# Fonction pour charger les questions précalculées (None si absentes ou obsolètes)
+def load_precomputed_questions(conversation_id, profile_data, model):
+    with span("file read questions", conversation_id):
+        stored = read_json(questions_path(conversation_id))
+    if stored is None or stored.get("version") != questions_version(profile_data, model):
+        return None
+    return stored["questions"]
+
+# Précalculs en cours dans ce processus (un seul par conversation, même en cas de double clic)
+_pending = set()
+_pending_lock = threading.Lock()
+
+def _precompute(client, conversation_id, profile_data, model):
+    try:
+        # Précalcul en arrière-plan: il ne consomme pas la marge du quota réservée aux échanges interactifs
+        with span("questions precompute", conversation_id), batch_priority():
+            save_questions(conversation_id, profile_data, model, contextualize(client, profile_data, conversation_id, model))
+    except Exception:
+        pass  # pas de fichier: le financier contextualisera lui-même les questions
+    finally:
+        with _pending_lock:
+            _pending.discard(conversation_id)
+
+# Fonction pour lancer le précalcul des questions en arrière-plan, juste après l'export du profil
+def precompute_questions(client, conversation_id, profile_data, model):
+    if load_precomputed_questions(conversation_id, profile_data, model) is not None:
+        return False
+    with _pending_lock:
+        if conversation_id in _pending:
+            return False
+        _pending.add(conversation_id)
+    # Thread lancé dans le contexte courant: ses spans se rattachent à l'export du profil
+    start_thread(_precompute, (client, conversation_id, profile_data, model))
+    return True
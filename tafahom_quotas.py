@@ -0,0 +1,430 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+
+from tafahom_metriques import increment, set_gauge
+from tafahom_prompts import count_message_tokens
+from tafahom_stockage import connect_database, data_path
+
+# Ordonnancement des appels au modèle selon les quotas du service (requêtes et tokens par minute et par jour):
+# la consommation de tous les processus est suivie dans une base commune, une marge est réservée aux échanges
+# interactifs (entretien du portail, actions du financier) et les travaux d'arrière-plan (file des travaux
+# différés, précalcul des questions) sont reportés vers les heures creuses quand la part qui leur revient est épuisée
+USAGE_FILE = data_path("tafahom_quotas.sqlite")
+
+# Quotas du service (0: illimité): requêtes et tokens par minute, requêtes et tokens par jour (jour UTC)
+QUOTA_RPM = int(os.getenv("TAFAHOM_QUOTA_RPM", "0"))
+QUOTA_TPM = int(os.getenv("TAFAHOM_QUOTA_TPM", "0"))
+QUOTA_RPD = int(os.getenv("TAFAHOM_QUOTA_RPD", "0"))
+QUOTA_TPD = int(os.getenv("TAFAHOM_QUOTA_TPD", "0"))
+
+# Part de chaque quota réservée aux échanges interactifs (jamais consommée par les travaux d'arrière-plan)
+INTERACTIVE_RESERVE = float(os.getenv("TAFAHOM_QUOTA_INTERACTIVE_RESERVE", "0.3"))
+
+# Heures creuses (heure locale, "début-fin", éventuellement à cheval sur minuit)
+OFF_PEAK_HOURS = os.getenv("TAFAHOM_QUOTA_OFF_PEAK", "20-7")
+
+# Part des quotas par minute laissée aux travaux d'arrière-plan en heures pleines (0: heures creuses seulement)
+BATCH_PEAK_SHARE = float(os.getenv("TAFAHOM_QUOTA_BATCH_PEAK_SHARE", "0.1"))
+
+# Durée de la fenêtre courte des quotas (s); réduite par la simulation pour observer plusieurs fenêtres en peu de temps
+WINDOW_SECONDS = float(os.getenv("TAFAHOM_QUOTA_WINDOW_SECONDS", "60"))
+
+# Marge (s) ajoutée à la fenêtre courte: un appel réservé ici arrive un peu plus tard chez le service
+WINDOW_MARGIN = 1.0
+
+# Tokens estimés d'un travail d'un site d'appel jamais mesuré
+DEFAULT_JOB_TOKENS = 3000
+
+# Consommation conservée en base (mesure des tokens par travail), en jours
+RETENTION_DAYS = 7
+
+# Durée (s) pendant laquelle les tokens mesurés par travail sont réutilisés pour estimer les appels
+MEASURE_TTL = 300
+
+# Priorités des appels
+PRIORITIES = ("interactive", "batch")
+
+# Priorité des appels du contexte courant (threads lancés par start_thread: priorité du contexte parent)
+_priority = ContextVar("tafahom_llm_priority", default="interactive")
+
+def current_priority():
+    return _priority.get()
+
+# Contexte des travaux d'arrière-plan: leurs appels passent après les échanges interactifs
+@contextmanager
+def batch_priority():
+    token = _priority.set("batch")
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+# Fonction pour savoir si au moins un quota est configuré (sinon aucun suivi n'est fait)
+def quotas_enabled():
+    return any((QUOTA_RPM, QUOTA_TPM, QUOTA_RPD, QUOTA_TPD))
+
+# Fonction pour ouvrir la base et créer la table au besoin
+def _connect(usage_file=USAGE_FILE):
+    return connect_database(usage_file, schema=(
+        """
+            CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL NOT NULL,
+                priority TEXT NOT NULL,
+                call_site TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                settled INTEGER NOT NULL DEFAULT 0
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS usage_time ON usage (time)",
+    ), isolation_level=None)
+
+# Fonction pour savoir si un instant (horodatage) tombe en heures creuses
+def is_off_peak(now=None, hours=OFF_PEAK_HOURS):
+    start, end = (int(hour) for hour in hours.split("-"))
+    hour = time.localtime(now if now is not None else time.time()).tm_hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+# Fonction pour calculer le délai (s) avant le début des prochaines heures creuses (0 si on y est déjà)
+def seconds_until_off_peak(now=None, hours=OFF_PEAK_HOURS):
+    now = now if now is not None else time.time()
+    if is_off_peak(now, hours):
+        return 0.0
+    start = int(hours.split("-")[0])
+    local = time.localtime(now)
+    target = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, start, 0, 0, 0, 0, -1))
+    if target <= now:
+        target = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, start, 0, 0, 0, 0, -1))
+    return target - now
+
+def _day_start(now):
+    return now - now % 86400
+
+# Fonction pour calculer la part des quotas par minute que les travaux d'arrière-plan peuvent consommer eux-mêmes
+# (toute la part hors réserve en heures creuses, BATCH_PEAK_SHARE au plus en heures pleines)
+def batch_share(now=None):
+    reserve_share = max(0.0, 1 - INTERACTIVE_RESERVE)
+    return reserve_share if is_off_peak(now) else min(BATCH_PEAK_SHARE, reserve_share)
+
+def _window_usage(connection, since, priority=None):
+    query = "SELECT COUNT(*), COALESCE(SUM(prompt_tokens + completion_tokens), 0), MIN(time) FROM usage WHERE time >= ?"
+    if priority:
+        return connection.execute(query + " AND priority = ?", (since, priority)).fetchone()
+    return connection.execute(query, (since,)).fetchone()
+
+# Fonction pour savoir si un appel de tokens estimés dépasse une part des quotas, compte tenu de l'usage de la fenêtre
+# (fenêtre vide: un appel plus gros que la part passe quand même, il ne tiendrait jamais)
+def _exceeds(requests, used, tokens, request_limit, token_limit, share):
+    return bool(requests) and ((request_limit and requests + 1 > request_limit * share) or (token_limit and used + tokens > token_limit * share))
+
+# Fonction pour calculer l'attente (s) avant qu'un appel de tokens estimés soit admis pour une priorité (0: admis):
+# les échanges interactifs disposent de tout le quota; les travaux d'arrière-plan ne touchent pas à la réserve
+# interactive et ne consomment eux-mêmes que leur part de la minute
+def _wait_for(connection, priority, tokens, now):
+    total_share = 1.0 if priority == "interactive" else max(0.0, 1 - INTERACTIVE_RESERVE)
+    waits = []
+
+    since = now - WINDOW_SECONDS - WINDOW_MARGIN
+    requests, used, first = _window_usage(connection, since)
+    if _exceeds(requests, used, tokens, QUOTA_RPM, QUOTA_TPM, total_share):
+        waits.append(first - since)
+    if priority == "batch":
+        share = batch_share(now)
+        if share <= 0:
+            waits.append(seconds_until_off_peak(now))
+        requests, used, first = _window_usage(connection, since, "batch")
+        if share > 0 and _exceeds(requests, used, tokens, QUOTA_RPM, QUOTA_TPM, share):
+            waits.append(first - since)
+
+    requests, used, _ = _window_usage(connection, _day_start(now))
+    if _exceeds(requests, used, tokens, QUOTA_RPD, QUOTA_TPD, total_share):
+        waits.append(_day_start(now) + 86400 - now)
+    return max(1.0, max(waits)) if waits else 0.0
+
+# Fonction pour réserver le quota d'un appel: renvoie (identifiant de la réservation, 0) si l'appel est admis,
+# sinon (None, attente en s); la vérification et la réservation sont faites dans une même transaction
+def reserve(call_site, priority, prompt_tokens, completion_tokens, usage_file=USAGE_FILE, now=None):
+    now = now if now is not None else time.time()
+    with closing(_connect(usage_file)) as connection, connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            wait = _wait_for(connection, priority, prompt_tokens + completion_tokens, now)
+            if wait:
+                connection.execute("COMMIT")
+                increment("tafahom_quota_deferred_total", priority=priority)
+                return None, wait
+            reservation = connection.execute(
+                "INSERT INTO usage (time, priority, call_site, prompt_tokens, completion_tokens) VALUES (?, ?, ?, ?, ?)",
+                (now, priority, call_site, prompt_tokens, completion_tokens)
+            ).lastrowid
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    increment("tafahom_quota_admitted_total", priority=priority)
+    return reservation, 0.0
+
+# Fonction pour remplacer l'estimation d'une réservation par les tokens réellement consommés
+def settle(reservation, prompt_tokens, completion_tokens, usage_file=USAGE_FILE):
+    with closing(_connect(usage_file)) as connection, connection:
+        connection.execute(
+            "UPDATE usage SET prompt_tokens = ?, completion_tokens = ?, settled = 1 WHERE id = ?",
+            (prompt_tokens, completion_tokens, reservation)
+        )
+
+# Fonction pour annuler la réservation d'un appel qui a échoué (rien n'a été consommé)
+def release(reservation, usage_file=USAGE_FILE):
+    with closing(_connect(usage_file)) as connection, connection:
+        connection.execute("DELETE FROM usage WHERE id = ? AND settled = 0", (reservation,))
+
+# Fonction pour supprimer la consommation au-delà de la durée de conservation
+def purge(usage_file=USAGE_FILE, now=None):
+    now = now if now is not None else time.time()
+    with closing(_connect(usage_file)) as connection, connection:
+        return connection.execute("DELETE FROM usage WHERE time < ?", (now - RETENTION_DAYS * 86400,)).rowcount
+
+# Fonction pour mesurer les tokens moyens d'un travail par site d'appel (appels réglés des derniers jours)
+def tokens_per_job(usage_file=USAGE_FILE, now=None):
+    now = now if now is not None else time.time()
+    with closing(_connect(usage_file)) as connection:
+        rows = connection.execute(
+            "SELECT call_site, AVG(prompt_tokens), AVG(completion_tokens) FROM usage WHERE time >= ? AND settled = 1 GROUP BY call_site",
+            (now - RETENTION_DAYS * 86400,)
+        ).fetchall()
+    return {call_site: {"prompt": prompt, "completion": completion} for call_site, prompt, completion in rows}
+
+# Mesure des tokens par travail du processus, relue au plus une fois par MEASURE_TTL: (instant de la mesure, mesure)
+_measured = None
+_measured_lock = threading.Lock()
+
+def _measured_tokens():
+    global _measured
+    with _measured_lock:
+        if _measured is None or time.monotonic() - _measured[0] >= MEASURE_TTL:
+            _measured = (time.monotonic(), tokens_per_job())
+        return _measured[1]
+
+# Fonction pour estimer les tokens d'un appel avant envoi: prompt compté, réponse selon la moyenne mesurée du site
+# d'appel (bornée par max_tokens), à défaut max_tokens
+def estimate_call(call_site, messages, params, measured=None):
+    measured = measured if measured is not None else _measured_tokens()
+    max_tokens = params.get("max_tokens") or 512
+    completion = measured.get(call_site, {}).get("completion")
+    return count_message_tokens(messages), round(min(max_tokens, completion) if completion else max_tokens)
+
+# Fonction pour estimer l'heure de fin d'une liste de travaux d'arrière-plan (sites d'appel, dans l'ordre):
+# simulation minute par minute de la part des quotas accessible aux travaux d'arrière-plan (heures creuses,
+# remise à zéro quotidienne), à partir des tokens mesurés par travail; None au-delà de l'horizon
+# (l'usage interactif à venir est inconnu: l'estimation suppose qu'il laisse aux travaux toute leur part)
+def estimate_completion(call_sites, usage_file=USAGE_FILE, now=None, horizon_days=RETENTION_DAYS, measured=None):
+    now = now if now is not None else time.time()
+    if not call_sites:
+        return now
+    if measured is None:
+        measured = _measured_tokens() if usage_file == USAGE_FILE else tokens_per_job(usage_file)
+    costs = [
+        round(measured[call_site]["prompt"] + measured[call_site]["completion"]) if call_site in measured else DEFAULT_JOB_TOKENS
+        for call_site in call_sites
+    ]
+    if not quotas_enabled():
+        return now
+    with closing(_connect(usage_file)) as connection:
+        day_requests, day_tokens, _ = _window_usage(connection, _day_start(now))
+
+    day_share = max(0.0, 1 - INTERACTIVE_RESERVE)
+    position, t, day = 0, now, _day_start(now)
+    while t < now + horizon_days * 86400:
+        if _day_start(t) != day:
+            day, day_requests, day_tokens = _day_start(t), 0, 0
+        share = batch_share(t)
+        minute_requests, minute_tokens = 0, 0
+        while position < len(costs) and share > 0:
+            cost = costs[position]
+            if _exceeds(minute_requests, minute_tokens, cost, QUOTA_RPM, QUOTA_TPM, share):
+                break
+            if _exceeds(day_requests, day_tokens, cost, QUOTA_RPD, QUOTA_TPD, day_share):
+                break
+            minute_requests, minute_tokens = minute_requests + 1, minute_tokens + cost
+            day_requests, day_tokens = day_requests + 1, day_tokens + cost
+            position += 1
+        if position == len(costs):
+            return t + WINDOW_SECONDS
+        t += WINDOW_SECONDS + WINDOW_MARGIN
+    return None
+
+# Fonction pour résumer la consommation courante face aux quotas (barre latérale, ligne de commande)
+def quota_status(usage_file=USAGE_FILE, now=None):
+    now = now if now is not None else time.time()
+    with closing(_connect(usage_file)) as connection:
+        minute_requests, minute_tokens, _ = _window_usage(connection, now - WINDOW_SECONDS)
+        day_requests, day_tokens, _ = _window_usage(connection, _day_start(now))
+    status = {
+        "off_peak": is_off_peak(now),
+        "minute": {"requests": minute_requests, "tokens": minute_tokens, "rpm": QUOTA_RPM, "tpm": QUOTA_TPM},
+        "day": {"requests": day_requests, "tokens": day_tokens, "rpd": QUOTA_RPD, "tpd": QUOTA_TPD}
+    }
+    for name, used, limit in (("rpm", minute_requests, QUOTA_RPM), ("tpm", minute_tokens, QUOTA_TPM),
+                              ("rpd", day_requests, QUOTA_RPD), ("tpd", day_tokens, QUOTA_TPD)):
+        if limit:
+            set_gauge("tafahom_quota_used_ratio", used / limit, quota=name)
+    return status
+
+# Fonction pour formater l'état des quotas en une ligne (part la plus consommée de la minute et du jour)
+def status_line(status):
+    def used(window, pairs):
+        ratios = [window[used_key] / window[limit_key] for used_key, limit_key in pairs if window[limit_key]]
+        return f"{max(ratios):.0%}" if ratios else "illimité"
+    minute = used(status["minute"], (("requests", "rpm"), ("tokens", "tpm")))
+    day = used(status["day"], (("requests", "rpd"), ("tokens", "tpd")))
+    return f"minute {minute}, jour {day}, {'heures creuses' if status['off_peak'] else 'heures pleines'}"
+
+
+# Simulation: un LLM local limité (requêtes et tokens par fenêtre, 429 au-delà), des sessions interactives et des
+# travaux d'arrière-plan qui se partagent le quota, sans puis avec ordonnancement. Chaque variante tourne dans un
+# processus à part: l'environnement (données, quotas, fenêtre) doit être en place avant le premier import des modules
+def simulate(args):
+    import subprocess
+    import tempfile
+
+    for scheduled in (False, True):
+        with tempfile.TemporaryDirectory(prefix="tafahom_quotas_") as data_dir:
+            env = dict(
+                os.environ,
+                TAFAHOM_DATA_DIR=data_dir,
+                TAFAHOM_QUOTA_SIMULATION="1",
+                TAFAHOM_QUOTA_RPM=str(args.rpm if scheduled else 0),
+                TAFAHOM_QUOTA_TPM=str(args.tpm if scheduled else 0),
+                TAFAHOM_QUOTA_WINDOW_SECONDS=str(args.window),
+                TAFAHOM_QUOTA_OFF_PEAK="0-24" if args.off_peak else "0-0",
+                # Disjoncteur neutralisé: on mesure les refus du service, pas leur coupure
+                TAFAHOM_LLM_BREAKER_FAILURES=str(10 ** 9),
+                TAFAHOM_LLM_ADMISSION_TIMEOUT=str(args.window * 2)
+            )
+            subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:]], env=env, check=True)
+
+def _run_simulation(args):
+    import tafahom_llm
+    import tafahom_quotas
+    from tafahom_charge import percentile
+    from tafahom_mock_llm import MockLLMHandler, start_mock_server
+    from together import Together
+
+    scheduled = tafahom_quotas.quotas_enabled()
+    server = start_mock_server(latency=0.05, jitter=0.05, rpm=args.rpm, tpm=args.tpm, window=args.window)
+    client = Together(api_key="simulation", base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+
+    interview = [
+        {"role": "system", "content": "Tu es TAFAHOM, tu mènes un entretien bienveillant avec un porteur de projet culturel. " * 4},
+        {"role": "user", "content": "Je joue du oud depuis l'enfance et j'anime les fêtes du quartier. " * 6}
+    ]
+    # Prompt système de la génération du profil: le LLM simulé répond par une fiche complète
+    batch_job = [
+        {"role": "system", "content": "Tu rédiges la fiche de profil structurée d'un porteur de projet culturel. " * 4},
+        {"role": "user", "content": "Transcription de l'entretien: " + "Le porteur décrit son parcours et ses projets. " * 60}
+    ]
+
+    lock = threading.Lock()
+    results = {"interactive": [], "interactive_errors": 0, "batch_done": 0, "batch_deferrals": 0, "batch_errors": 0, "finished": None}
+    stop = threading.Event()
+
+    def interactive_user(user):
+        turn = 0
+        while not stop.is_set():
+            messages = interview + [{"role": "user", "content": f"Session {user}, tour {turn}."}]
+            start = time.perf_counter()
+            try:
+                tafahom_llm.chat_completion(client, "get_llm_response", messages, conversation_id=f"simulation-{user}",
+                                            model="mock", max_tokens=args.turn_tokens)
+                with lock:
+                    results["interactive"].append(time.perf_counter() - start)
+            except Exception:
+                with lock:
+                    results["interactive_errors"] += 1
+            turn += 1
+            stop.wait(args.think)
+
+    def batch_worker():
+        job = 1
+        with tafahom_quotas.batch_priority():
+            while not stop.is_set() and job < args.jobs:
+                messages = batch_job + [{"role": "user", "content": f"Dossier {job}."}]
+                try:
+                    tafahom_llm.chat_completion(client, "generate_profile", messages, conversation_id=f"dossier-{job}",
+                                                model="mock", max_tokens=args.job_tokens)
+                    with lock:
+                        results["batch_done"] += 1
+                    job += 1
+                    if job == args.jobs:
+                        results["finished"] = time.time()
+                except tafahom_llm.LLMQuotaError as e:
+                    # Comme la file des travaux différés: nouvel essai à la fin de l'attente annoncée
+                    with lock:
+                        results["batch_deferrals"] += 1
+                    stop.wait(e.retry_in)
+                except Exception:
+                    with lock:
+                        results["batch_errors"] += 1
+                    stop.wait(1)
+
+    # Premier travail seul: il mesure les tokens d'un travail, dont on déduit l'heure de fin des suivants
+    started = time.time()
+    with tafahom_quotas.batch_priority():
+        tafahom_llm.chat_completion(client, "generate_profile", batch_job + [{"role": "user", "content": "Dossier 0."}],
+                                    conversation_id="dossier-0", model="mock", max_tokens=args.job_tokens)
+    results["batch_done"] += 1
+    eta = tafahom_quotas.estimate_completion(["generate_profile"] * (args.jobs - 1), measured=tafahom_quotas.tokens_per_job()) if scheduled else None
+
+    threads = [threading.Thread(target=interactive_user, args=(user,)) for user in range(args.users)]
+    threads.append(threading.Thread(target=batch_worker))
+    for thread in threads:
+        thread.start()
+    # Durée fixe: les échanges interactifs se poursuivent après la fin éventuelle des travaux
+    stop.wait(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    print(f"{'Avec' if scheduled else 'Sans'} ordonnancement (quota simulé: {args.rpm} requêtes et {args.tpm} tokens par fenêtre de "
+          f"{args.window:g} s, {'heures creuses' if args.off_peak else 'heures pleines'})")
+    print(f"  échanges interactifs: {len(results['interactive'])} réussis, {results['interactive_errors']} refusés, "
+          f"p95 {percentile(results['interactive'], 95):.2f} s")
+    print(f"  travaux d'arrière-plan: {results['batch_done']}/{args.jobs} livrés, {results['batch_deferrals']} reports, "
+          f"{results['batch_errors']} refus du service")
+    print(f"  refus du service simulé (429): {MockLLMHandler.quota_rejections}")
+    if scheduled:
+        print(f"  fin estimée: {eta - started:.0f} s, fin réelle: " + (f"{results['finished'] - started:.0f} s" if results["finished"] else f"au-delà de {args.duration:g} s"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consommation des quotas du service de génération")
+    parser.add_argument("--purge", action="store_true", help="Supprimer la consommation au-delà de la durée de conservation")
+    parser.add_argument("--simulate", action="store_true", help="Simuler un quota sur le LLM local (avec et sans ordonnancement)")
+    parser.add_argument("--rpm", type=int, default=40, help="Requêtes par fenêtre du quota simulé")
+    parser.add_argument("--tpm", type=int, default=60000, help="Tokens par fenêtre du quota simulé")
+    parser.add_argument("--window", type=float, default=10, help="Durée de la fenêtre simulée (s)")
+    parser.add_argument("--users", type=int, default=4, help="Sessions interactives simultanées")
+    parser.add_argument("--think", type=float, default=2.0, help="Pause entre deux tours d'une session (s)")
+    parser.add_argument("--jobs", type=int, default=30, help="Travaux d'arrière-plan à traiter")
+    parser.add_argument("--turn-tokens", type=int, default=200, help="Tokens de réponse d'un tour interactif")
+    parser.add_argument("--job-tokens", type=int, default=1500, help="Tokens de réponse d'un travail")
+    parser.add_argument("--off-peak", action="store_true", help="Simuler en heures creuses (sinon heures pleines)")
+    parser.add_argument("--duration", type=float, default=90, help="Durée de chaque simulation (s)")
+    args = parser.parse_args()
+
+    if args.simulate:
+        _run_simulation(args) if os.getenv("TAFAHOM_QUOTA_SIMULATION") else simulate(args)
+        sys.exit(0)
+    if args.purge:
+        print(f"{purge()} appels supprimés")
+    if not quotas_enabled():
+        print("Aucun quota configuré (TAFAHOM_QUOTA_RPM, TAFAHOM_QUOTA_TPM, TAFAHOM_QUOTA_RPD, TAFAHOM_QUOTA_TPD)")
+    print(f"Consommation: {status_line(quota_status())}")
+    for call_site, tokens in sorted(tokens_per_job().items()):
+        print(f"{call_site:<35} {tokens['prompt']:>8.0f} tokens de prompt, {tokens['completion']:>6.0f} de réponse en moyenne")
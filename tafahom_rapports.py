@@ -0,0 +1,270 @@
+import argparse
+import html
+import json
+import os
+import sys
+import time
+
+import plotly
+import plotly.express as px
+from plotly.offline import get_plotlyjs
+
+from tafahom_export import conversation_date
+from tafahom_stockage import DATA_DIR, atomic_write_text, enriched_profile_path, evaluation_path, list_profile_ids, profile_path, read_json
+
+# Rapports statiques des dossiers terminés (profil, évaluation, profil enrichi et leurs graphiques) pour les lecteurs
+# qui ne font que consulter: chaque dossier est rendu une fois en page HTML, avec une page d'index consultable;
+# seuls les dossiers modifiés depuis le dernier passage sont régénérés. Le répertoire peut être servi tel quel
+# par n'importe quel serveur de fichiers statiques (python -m http.server, nginx, stockage objet).
+
+# Répertoire des rapports
+REPORTS_DIR = os.getenv("TAFAHOM_REPORTS_DIR", os.path.join(DATA_DIR, "rapports"))
+
+# Version du gabarit des pages: la changer régénère tous les rapports
+REPORT_VERSION = 1
+
+# Couleurs des applications (mêmes que TAFAHOM-Agent)
+PROFILE_COLOR = "#4CAF50"
+EVALUATION_COLOR = "#3366CC"
+DECISION_COLORS = {"Acceptation": "#4CAF50", "Acceptation conditionnelle": "#FFA500", "Rejet": "#FF5733"}
+
+STYLE = """
+body { font-family: -apple-system, "Segoe UI", Roboto, sans-serif; max-width: 1100px; margin: 2em auto; padding: 0 1em; color: #222; }
+h1 { font-size: 1.6em; } h2 { border-bottom: 1px solid #ddd; padding-bottom: .2em; margin-top: 2em; }
+table { border-collapse: collapse; width: 100%; margin: 1em 0; } th, td { text-align: left; padding: .4em .6em; border-bottom: 1px solid #eee; vertical-align: top; }
+th { background: #f6f6f6; } .bar { background: #eee; width: 100px; height: .8em; display: inline-block; }
+.bar span { display: block; height: 100%; } .charts { display: flex; flex-wrap: wrap; gap: 1em; } .charts > div { flex: 1 1 320px; }
+.decision { font-weight: bold; } .muted { color: #777; font-size: .9em; } input, select { font-size: 1em; padding: .3em; margin-right: .5em; }
+"""
+
+# Fonction pour obtenir le chemin de la page d'un dossier
+def report_path(conversation_id, reports_dir=REPORTS_DIR):
+    return os.path.join(reports_dir, f"{conversation_id}.html")
+
+# Fonction pour lister les dossiers terminés (profil et évaluation enregistrés)
+def completed_ids():
+    return [conversation_id for conversation_id in list_profile_ids() if os.path.exists(evaluation_path(conversation_id))]
+
+# Fonction pour calculer la signature des fichiers d'un dossier (taille et date de modification): une page
+# n'est régénérée que si cette signature a changé
+def dossier_signature(conversation_id):
+    signature = []
+    for path in (profile_path(conversation_id), evaluation_path(conversation_id), enriched_profile_path(conversation_id)):
+        try:
+            stat = os.stat(path)
+            signature.append([stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+# Fonction pour produire le HTML d'un graphique plotly (plotly.js chargé une fois par page)
+def _chart(fig, include_plotlyjs):
+    return fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs, config={"displayModeBar": False})
+
+def _donut(score, color):
+    fig = px.pie(values=[score, 100 - score], names=["Score", "Restant"], hole=0.7, color_discrete_sequence=[color, "#F0F0F0"])
+    fig.update_layout(showlegend=False, height=300, margin=dict(t=20, b=20, l=20, r=20),
+                      annotations=[dict(text=f"{score}%", x=0.5, y=0.5, font_size=20, showarrow=False)])
+    return fig
+
+def _radar(criteria, color):
+    fig = px.line_polar(
+        {"Critère": [criterion["name"] for criterion in criteria], "Score": [criterion["score"] for criterion in criteria]},
+        r="Score", theta="Critère", line_close=True, range_r=[0, 10], color_discrete_sequence=[color]
+    )
+    fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 10])), showlegend=False, height=420)
+    return fig
+
+def _comparison(ias_score, global_score):
+    fig = px.bar(
+        {"Type": ["IAS (Symbolique)", "Recevabilité (Financière)"], "Score": [ias_score, global_score]},
+        x="Type", y="Score", color="Type", text="Score", height=400,
+        color_discrete_map={"IAS (Symbolique)": PROFILE_COLOR, "Recevabilité (Financière)": EVALUATION_COLOR}
+    )
+    fig.update_layout(yaxis_range=[0, 100], yaxis_title="Score /100", xaxis_title="", showlegend=False)
+    return fig
+
+def _criteria_table(criteria, color, extra=None):
+    header = "<tr><th>Critère</th><th>Score</th><th>Évaluation</th>" + (f"<th>{html.escape(extra[1])}</th>" if extra else "") + "</tr>"
+    rows = []
+    for criterion in criteria:
+        score = criterion.get("score", 0)
+        rows.append(
+            f"<tr><td>{html.escape(str(criterion.get('name', '')))}</td>"
+            f"<td><span class='bar'><span style='width:{score * 10}%;background:{color}'></span></span> {score}/10</td>"
+            f"<td>{html.escape(str(criterion.get('comment', '')))}</td>"
+            + (f"<td>{html.escape(str(criterion.get(extra[0], '')))}</td>" if extra else "") + "</tr>"
+        )
+    return f"<table>{header}{''.join(rows)}</table>"
+
+def _list(items):
+    return "<ol>" + "".join(f"<li>{html.escape(str(item))}</li>" for item in items) + "</ol>"
+
+def _page(title, body, head=""):
+    return (f"<!DOCTYPE html><html lang='fr'><head><meta charset='utf-8'><title>{html.escape(title)}</title>"
+            f"<meta name='viewport' content='width=device-width, initial-scale=1'><style>{STYLE}</style>{head}</head>"
+            f"<body>{body}</body></html>")
+
+# Fonction pour rendre la page d'un dossier; plotly.js est soit intégré à la page (inline), soit chargé depuis
+# le fichier partagé du répertoire des rapports
+def render_dossier(conversation_id, plotlyjs_file=None):
+    profile = read_json(profile_path(conversation_id))["profile"]
+    evaluation_data = read_json(evaluation_path(conversation_id))
+    evaluation = evaluation_data["evaluation"]
+    enriched = read_json(enriched_profile_path(conversation_id))
+    created = conversation_date(conversation_id)
+    decision_color = DECISION_COLORS.get(evaluation["decision"], "#222")
+
+    # plotly.js intégré au premier graphique en mode autonome, sinon chargé une fois dans l'en-tête
+    charts = iter([True] + [False] * 10) if plotlyjs_file is None else iter([False] * 11)
+    head = f"<script src='{html.escape(plotlyjs_file)}'></script>" if plotlyjs_file else ""
+
+    body = [
+        "<p class='muted'><a href='index.html'>← Tous les dossiers</a></p>",
+        f"<h1>Dossier {html.escape(conversation_id)}</h1>",
+        f"<p class='muted'>Créé le {created.isoformat() if created else 'date inconnue'} · rapport généré le {time.strftime('%Y-%m-%d %H:%M')}</p>",
+        f"<p class='decision' style='color:{decision_color}'>Décision: {html.escape(evaluation['decision'])} "
+        f"({evaluation['global_score']}/100){' — évaluation provisoire (pré-examen par règles)' if evaluation_data.get('screening') else ''}</p>",
+
+        "<h2>Profil artiste (TAFAHOM-Portail)</h2>",
+        f"<p>{html.escape(profile.get('summary', ''))}</p>",
+        f"<div class='charts'><div>{_chart(_donut(profile['ias_score'], PROFILE_COLOR), next(charts))}</div>"
+        f"<div>{_chart(_radar(profile['criteria'], PROFILE_COLOR), next(charts))}</div></div>",
+        _criteria_table(profile["criteria"], PROFILE_COLOR),
+
+        "<h2>Évaluation financière</h2>",
+        f"<p>{html.escape(evaluation.get('summary', ''))}</p>",
+        f"<div class='charts'><div>{_chart(_donut(evaluation['global_score'], EVALUATION_COLOR), next(charts))}</div>"
+        f"<div>{_chart(_radar(evaluation['criteria'], EVALUATION_COLOR), next(charts))}</div></div>",
+        "<h3>Recommandations</h3>",
+        _list(evaluation.get("recommendations", [])),
+        _criteria_table(evaluation["criteria"], EVALUATION_COLOR),
+
+        "<h2>Comparaison IAS vs Recevabilité Financière</h2>",
+        _chart(_comparison(profile["ias_score"], evaluation["global_score"]), next(charts))
+    ]
+
+    if enriched:
+        enriched_profile = enriched["profile"]
+        body += [
+            "<h2>Profil artiste enrichi</h2>",
+            f"<p>Score IAS: <b>{enriched_profile['ias_score']}/100</b> · Score financier: <b>{enriched_profile['financial_score']}/100</b>"
+            f" · Score combiné: <b>{enriched_profile['combined_score']}/100</b></p>",
+            f"<p>{html.escape(enriched_profile.get('summary', ''))}</p>",
+            "<h3>Axes d'amélioration</h3>",
+            _list(enriched_profile.get("improvement_areas", [])),
+            _criteria_table(enriched_profile["criteria"], PROFILE_COLOR, extra=("financial_perspective", "Perspective financière"))
+        ]
+
+    entry = {
+        "date": created.isoformat() if created else "",
+        "ias_score": profile["ias_score"],
+        "global_score": evaluation["global_score"],
+        "decision": evaluation["decision"],
+        "provisional": bool(evaluation_data.get("screening")),
+        "enriched": enriched is not None,
+        "summary": evaluation.get("summary", "") or profile.get("summary", "")
+    }
+    return _page(f"Dossier {conversation_id}", "".join(body), head), entry
+
+# Fonction pour rendre la page d'index: recherche plein texte et filtre par décision, côté navigateur
+def render_index(entries):
+    rows = []
+    for conversation_id, entry in sorted(entries.items(), key=lambda item: (item[1]["date"], item[0]), reverse=True):
+        search_text = " ".join([conversation_id, entry["decision"], entry["summary"]]).lower()
+        rows.append(
+            f"<tr data-search='{html.escape(search_text, quote=True)}' data-decision='{html.escape(entry['decision'], quote=True)}'>"
+            f"<td><a href='{html.escape(conversation_id, quote=True)}.html'>{html.escape(conversation_id)}</a></td>"
+            f"<td>{entry['date']}</td><td>{entry['ias_score']}</td><td>{entry['global_score']}</td>"
+            f"<td style='color:{DECISION_COLORS.get(entry['decision'], '#222')}'>{html.escape(entry['decision'])}{' (provisoire)' if entry['provisional'] else ''}</td>"
+            f"<td>{'✓' if entry['enriched'] else ''}</td>"
+            f"<td class='muted'>{html.escape(entry['summary'][:200])}</td></tr>"
+        )
+    options = "".join(f"<option>{html.escape(decision)}</option>" for decision in DECISION_COLORS)
+    script = """<script>
+function filterRows() {
+  var query = document.getElementById('q').value.toLowerCase(), decision = document.getElementById('d').value, shown = 0;
+  document.querySelectorAll('tbody tr').forEach(function (row) {
+    var visible = row.dataset.search.indexOf(query) >= 0 && (!decision || row.dataset.decision === decision);
+    row.style.display = visible ? '' : 'none';
+    shown += visible ? 1 : 0;
+  });
+  document.getElementById('n').textContent = shown;
+}
+</script>"""
+    body = (
+        "<h1>Dossiers TAFAHOM évalués</h1>"
+        f"<p class='muted'>Index généré le {time.strftime('%Y-%m-%d %H:%M')} · <span id='n'>{len(rows)}</span> dossier(s)</p>"
+        "<p><input id='q' type='search' placeholder='Rechercher (identifiant, synthèse...)' oninput='filterRows()' size='40'>"
+        f"<select id='d' onchange='filterRows()'><option value=''>Toutes les décisions</option>{options}</select></p>"
+        "<table><thead><tr><th>Dossier</th><th>Date</th><th>IAS</th><th>Recevabilité</th><th>Décision</th><th>Enrichi</th><th>Synthèse</th></tr></thead>"
+        f"<tbody>{''.join(rows)}</tbody></table>"
+    )
+    return _page("Dossiers TAFAHOM", body, script)
+
+# Fonction pour mettre à jour les rapports: pages des dossiers nouveaux ou modifiés, suppression des pages des
+# dossiers disparus, index réécrit s'il y a eu un changement; renvoie le nombre de pages rendues, supprimées, inchangées
+def update_reports(reports_dir=REPORTS_DIR, force=False, inline=False, progress=None):
+    os.makedirs(reports_dir, exist_ok=True)
+    manifest_path = os.path.join(reports_dir, "manifest.json")
+    manifest = read_json(manifest_path) or {}
+    if manifest.get("version") != REPORT_VERSION or manifest.get("inline") != inline or manifest.get("plotly") != plotly.__version__:
+        manifest = {}
+    dossiers = {} if force else manifest.get("dossiers", {})
+
+    # Fichier plotly.js partagé par toutes les pages (une seule copie à servir)
+    plotlyjs_file = None
+    if not inline:
+        plotlyjs_file = f"plotly-{plotly.__version__}.min.js"
+        if not os.path.exists(os.path.join(reports_dir, plotlyjs_file)):
+            atomic_write_text(os.path.join(reports_dir, plotlyjs_file), get_plotlyjs())
+
+    conversation_ids = completed_ids()
+    rendered = unchanged = 0
+    for done, conversation_id in enumerate(conversation_ids, start=1):
+        signature = dossier_signature(conversation_id)
+        known = dossiers.get(conversation_id)
+        if known is None or known["signature"] != signature or not os.path.exists(report_path(conversation_id, reports_dir)):
+            try:
+                page, entry = render_dossier(conversation_id, plotlyjs_file)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Dossier {conversation_id} ignoré: {e}", file=sys.stderr)
+                continue
+            atomic_write_text(report_path(conversation_id, reports_dir), page)
+            dossiers[conversation_id] = {"signature": signature, **entry}
+            rendered += 1
+        else:
+            unchanged += 1
+        if progress:
+            progress(done, len(conversation_ids), conversation_id)
+
+    removed = 0
+    for conversation_id in set(dossiers) - set(conversation_ids):
+        del dossiers[conversation_id]
+        if os.path.exists(report_path(conversation_id, reports_dir)):
+            os.remove(report_path(conversation_id, reports_dir))
+        removed += 1
+
+    if rendered or removed or not os.path.exists(os.path.join(reports_dir, "index.html")):
+        atomic_write_text(os.path.join(reports_dir, "index.html"), render_index(dossiers))
+        atomic_write_text(manifest_path, json.dumps(
+            {"version": REPORT_VERSION, "inline": inline, "plotly": plotly.__version__, "dossiers": dossiers}, ensure_ascii=False
+        ))
+    return {"rendered": rendered, "removed": removed, "unchanged": unchanged}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rapports HTML statiques des dossiers TAFAHOM évalués")
+    parser.add_argument("-o", "--output", default=REPORTS_DIR, help="Répertoire des rapports")
+    parser.add_argument("--force", action="store_true", help="Régénérer toutes les pages")
+    parser.add_argument("--inline", action="store_true", help="Intégrer plotly.js à chaque page (pages autonomes, plus lourdes)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = update_reports(args.output, force=args.force, inline=args.inline)
+    print(f"{result['rendered']} page(s) rendue(s), {result['unchanged']} inchangée(s), {result['removed']} supprimée(s) "
+          f"en {time.perf_counter() - start:.1f} s → {os.path.join(args.output, 'index.html')}")
+
+
+if __name__ == "__main__":
+    main()
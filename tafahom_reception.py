@@ -0,0 +1,218 @@
+import os
+import sys
+import threading
+import time
+from contextlib import closing
+
+from tafahom_stockage import DATA_DIR, connect_database, data_path, list_profile_ids, profile_path, read_json
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+except ImportError:  # watchdog absent: suivi du fil des arrivées dans la base
+    FileSystemEventHandler = object
+    Observer = PollingObserver = None
+
+# Boîte de réception des profils exportés par le portail (SQLite partagé: arrivées, lecture, prise en charge)
+INBOX_FILE = data_path("tafahom_reception.sqlite")
+
+# Surveillance par scrutation (montage réseau sans notifications inotify): "on" ou "off"
+USE_POLLING = os.getenv("TAFAHOM_INBOX_POLLING", "off")
+
+# Intervalle de scrutation (s), pour la surveillance par scrutation ou le suivi du fil des arrivées
+POLL_INTERVAL = float(os.getenv("TAFAHOM_INBOX_POLL_INTERVAL", "2"))
+
+# Une prise en charge abandonnée depuis ce délai (s) peut être reprise par un autre financier
+CLAIM_TTL = 2 * 3600
+
+# Statuts d'un profil dans la boîte de réception
+STATUS_LABELS = {
+    "non_lu": "🆕 Nouveau",
+    "lu": "Lu",
+    "pris": "Pris en charge",
+    "evalue": "✅ Évalué"
+}
+
+# Fonction pour ouvrir la base et créer la table au besoin
+def _connect(inbox_file=INBOX_FILE):
+    return connect_database(inbox_file, schema=(
+        # seq croissant: fil des arrivées, que chaque processus suit sans parcourir le répertoire de données
+        """
+            CREATE TABLE IF NOT EXISTS inbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL UNIQUE,
+                received_at REAL NOT NULL,
+                ias_score INTEGER,
+                summary TEXT,
+                status TEXT NOT NULL DEFAULT 'non_lu',
+                claimed_by TEXT,
+                claimed_at REAL
+            )
+        """,
+    ))
+
+# Fonction pour déposer un profil exporté dans la boîte de réception (sans effet s'il y est déjà)
+def announce_profile(conversation_id, profile_data=None, inbox_file=INBOX_FILE):
+    if profile_data is None:
+        profile_data = read_json(profile_path(conversation_id))
+    profile = (profile_data or {}).get("profile", {})
+
+    with closing(_connect(inbox_file)) as connection, connection:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO inbox (conversation_id, received_at, ias_score, summary) VALUES (?, ?, ?, ?)",
+            (conversation_id, time.time(), profile.get("ias_score"), profile.get("summary"))
+        )
+    if cursor.rowcount:
+        _notify(conversation_id)
+    return bool(cursor.rowcount)
+
+# Fonction pour lister la boîte de réception (plus récents d'abord), avec l'état de prise en charge
+def list_inbox(limit=50, include_evaluated=False, inbox_file=INBOX_FILE):
+    query = "SELECT conversation_id, received_at, ias_score, summary, status, claimed_by, claimed_at FROM inbox"
+    if not include_evaluated:
+        query += " WHERE status != 'evalue'"
+    with closing(_connect(inbox_file)) as connection:
+        rows = connection.execute(query + " ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+
+    now = time.time()
+    entries = []
+    for conversation_id, received_at, ias_score, summary, status, claimed_by, claimed_at in rows:
+        # Une prise en charge expirée redevient disponible
+        if status == "pris" and claimed_at and now - claimed_at >= CLAIM_TTL:
+            status, claimed_by = "lu", None
+        entries.append({
+            "conversation_id": conversation_id,
+            "received_at": received_at,
+            "ias_score": ias_score,
+            "summary": summary,
+            "status": status,
+            "claimed_by": claimed_by
+        })
+    return entries
+
+def unread_count(inbox_file=INBOX_FILE):
+    with closing(_connect(inbox_file)) as connection:
+        return connection.execute("SELECT COUNT(*) FROM inbox WHERE status = 'non_lu'").fetchone()[0]
+
+# Fonction pour prendre en charge un profil: réussit seulement s'il est libre, déjà à ce financier ou abandonné
+def claim(conversation_id, financier_id, inbox_file=INBOX_FILE):
+    now = time.time()
+    with closing(_connect(inbox_file)) as connection, connection:
+        cursor = connection.execute(
+            """
+            UPDATE inbox SET status = 'pris', claimed_by = ?, claimed_at = ?
+            WHERE conversation_id = ?
+              AND (claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)
+              AND status != 'evalue'
+            """,
+            (financier_id, now, conversation_id, financier_id, now - CLAIM_TTL)
+        )
+    return bool(cursor.rowcount)
+
+# Fonction pour libérer un profil pris en charge (retour dans la boîte, marqué comme lu)
+def release(conversation_id, financier_id, inbox_file=INBOX_FILE):
+    with closing(_connect(inbox_file)) as connection, connection:
+        connection.execute(
+            "UPDATE inbox SET status = 'lu', claimed_by = NULL, claimed_at = NULL WHERE conversation_id = ? AND claimed_by = ?",
+            (conversation_id, financier_id)
+        )
+
+# Fonction pour marquer un profil comme évalué (il sort de la boîte de réception): réussit seulement s'il est
+# libre ou pris en charge par ce financier (pas s'il a été repris par un autre après abandon)
+def complete(conversation_id, financier_id, inbox_file=INBOX_FILE):
+    with closing(_connect(inbox_file)) as connection, connection:
+        cursor = connection.execute(
+            "UPDATE inbox SET status = 'evalue', claimed_by = ?, claimed_at = ? WHERE conversation_id = ? AND (claimed_by IS NULL OR claimed_by = ?)",
+            (financier_id, time.time(), conversation_id, financier_id)
+        )
+    return bool(cursor.rowcount)
+
+def last_sequence(inbox_file=INBOX_FILE):
+    with closing(_connect(inbox_file)) as connection:
+        return connection.execute("SELECT COALESCE(MAX(seq), 0) FROM inbox").fetchone()[0]
+
+
+# Abonnés aux arrivées de ce processus (ex: sessions financières à rafraîchir)
+_subscribers = {}
+_subscribers_lock = threading.Lock()
+
+def subscribe(key, callback):
+    with _subscribers_lock:
+        _subscribers[key] = callback
+
+def unsubscribe(key):
+    with _subscribers_lock:
+        _subscribers.pop(key, None)
+
+def _notify(conversation_id):
+    with _subscribers_lock:
+        callbacks = list(_subscribers.items())
+    for key, callback in callbacks:
+        try:
+            if callback(conversation_id) is False:
+                unsubscribe(key)
+        except Exception as e:
+            # Abonné défaillant: signalé puis retiré (il ne doit pas faire échouer les suivants à chaque arrivée)
+            print(f"Abonné {key} retiré des arrivées de la boîte de réception: {e!r}", file=sys.stderr)
+            unsubscribe(key)
+
+# Gestionnaire des notifications du système de fichiers: un profil écrit (ou renommé, écriture atomique) arrive
+class ProfileEventHandler(FileSystemEventHandler):
+    def _handle(self, path):
+        name = os.path.basename(path)
+        if name.startswith("tafahom_profil_") and name.endswith(".json") and not name.startswith("tafahom_profil_enrichi_"):
+            conversation_id = name[len("tafahom_profil_"):-len(".json")]
+            # Déjà déposé par le portail (autre processus): prévenir quand même les abonnés de ce processus
+            if not announce_profile(conversation_id):
+                _notify(conversation_id)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._handle(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._handle(event.dest_path)
+
+# Fonction pour suivre le fil des arrivées de la base (profils déposés par d'autres processus)
+def _follow_feed(inbox_file):
+    seen = last_sequence(inbox_file)
+    while True:
+        time.sleep(POLL_INTERVAL)
+        sequence = last_sequence(inbox_file)
+        if sequence > seen:
+            seen = sequence
+            _notify(None)
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+# Fonction pour démarrer (une fois par processus) la surveillance des arrivées: reprise des profils existants,
+# puis notifications inotify (watchdog), scrutation si demandée, ou suivi du fil de la base sans watchdog
+def start_watcher(directory=DATA_DIR):
+    global _watcher
+    with _watcher_lock:
+        if _watcher is not None:
+            return _watcher
+
+        for conversation_id in list_profile_ids():
+            announce_profile(conversation_id)
+
+        if Observer is None:
+            _watcher = threading.Thread(target=_follow_feed, args=(INBOX_FILE,), daemon=True)
+            _watcher.start()
+        else:
+            _watcher = PollingObserver(timeout=POLL_INTERVAL) if USE_POLLING == "on" else Observer()
+            _watcher.schedule(ProfileEventHandler(), directory, recursive=False)
+            _watcher.daemon = True
+            _watcher.start()
+        return _watcher
+
+
+if __name__ == "__main__":
+    # Reprise des profils existants puis affichage de la boîte de réception
+    start_watcher()
+    for entry in list_inbox(include_evaluated="--all" in sys.argv[1:]):
+        received = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["received_at"]))
+        print(f"{entry['conversation_id']}  {received}  IAS {entry['ias_score']}  {STATUS_LABELS[entry['status']]}")
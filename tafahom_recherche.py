@@ -0,0 +1,154 @@
+import os
+import re
+import sys
+from contextlib import closing
+
+from tafahom_journal import read_events
+from tafahom_similarite import FRENCH_STOPWORDS, fold_accents
+from tafahom_stockage import DATA_DIR, connect_database, data_path
+
+# Fichier de l'index plein texte (SQLite FTS5, mis à jour à chaque écriture)
+INDEX_FILE = data_path("tafahom_recherche.sqlite")
+
+# Nombre maximal de documents examinés avant regroupement par conversation
+MAX_MATCHES = 200
+
+# Fonction pour ouvrir l'index et créer les tables au besoin
+def _connect(index_file=INDEX_FILE):
+    return connect_database(index_file, schema=(
+        # Un document par conversation et par type: le classement reste rapide même avec des milliers de tours
+        # unicode61 + remove_diacritics: insensible à la casse et aux accents, coupe sur les apostrophes (l'art -> l, art)
+        """
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+                conversation_id UNINDEXED,
+                kind UNINDEXED,
+                content,
+                tokenize = "unicode61 remove_diacritics 2"
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS entries (
+                conversation_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                PRIMARY KEY (conversation_id, kind)
+            )
+        """,
+    ))
+
+# Fonction pour écrire le document (conversation, type), en ajoutant au contenu existant ou en le remplaçant
+def _write_document(connection, conversation_id, kind, content, append=False):
+    row = connection.execute(
+        "SELECT doc_id FROM entries WHERE conversation_id = ? AND kind = ?", (conversation_id, kind)
+    ).fetchone()
+    if row is None:
+        cursor = connection.execute(
+            "INSERT INTO documents (conversation_id, kind, content) VALUES (?, ?, ?)", (conversation_id, kind, content)
+        )
+        connection.execute(
+            "INSERT INTO entries (conversation_id, kind, doc_id) VALUES (?, ?, ?)", (conversation_id, kind, cursor.lastrowid)
+        )
+        return
+
+    if append:
+        previous = connection.execute("SELECT content FROM documents WHERE rowid = ?", (row[0],)).fetchone()[0]
+        content = f"{previous}\n{content}"
+    connection.execute("UPDATE documents SET content = ? WHERE rowid = ?", (content, row[0]))
+
+# Fonction pour ajouter un tour de conversation à l'index (seul le document de cette conversation est réécrit)
+def index_turn(conversation_id, role, content, index_file=INDEX_FILE):
+    with closing(_connect(index_file)) as connection, connection:
+        _write_document(connection, str(conversation_id), "transcription", f"{role}: {content}", append=True)
+
+# Fonction pour indexer les commentaires d'un profil ou d'une évaluation (remplace l'entrée précédente)
+def index_comments(conversation_id, data, kind="profil", index_file=INDEX_FILE):
+    section = data.get("profile") or data.get("evaluation") or {}
+    lines = [f"{criterion.get('name', '')}: {criterion.get('comment', '')}" for criterion in section.get("criteria", [])]
+    if section.get("summary"):
+        lines.append(section["summary"])
+
+    with closing(_connect(index_file)) as connection, connection:
+        _write_document(connection, str(conversation_id), kind, "\n".join(lines))
+
+# Fonction pour normaliser un mot de requête (accents, pluriels simples)
+def _query_stem(token):
+    if len(token) > 3 and token[-1] in "sx":
+        token = token[:-1]
+    return token
+
+# Fonction pour transformer une saisie libre en requête FTS5 (mots vides retirés, préfixes pour pluriels et flexions)
+def build_match_query(text):
+    tokens = [_query_stem(token) for token in re.findall(r"[a-z0-9]+", fold_accents(text)) if token not in FRENCH_STOPWORDS]
+    return " AND ".join(f'"{token}"*' for token in tokens)
+
+# Fonction pour rechercher les conversations correspondant à une requête, classées par pertinence
+def search(text, limit=10, index_file=INDEX_FILE):
+    match_query = build_match_query(text)
+    if not match_query or not os.path.exists(index_file):
+        return []
+
+    with closing(_connect(index_file)) as connection:
+        rows = connection.execute(
+            """
+            SELECT conversation_id, kind, rank,
+                   snippet(documents, 2, '**', '**', '…', 24)
+            FROM documents
+            WHERE documents MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """,
+            (match_query, MAX_MATCHES)
+        ).fetchall()
+
+    # Regrouper les documents (transcription, profil, évaluation) par conversation: score cumulé, meilleur extrait conservé
+    results = {}
+    for conversation_id, kind, rank, snippet in rows:
+        if conversation_id not in results:
+            results[conversation_id] = {
+                "conversation_id": conversation_id,
+                "score": 0.0,
+                "matches": 0,
+                "kind": kind,
+                "snippet": snippet
+            }
+        results[conversation_id]["score"] += -rank
+        results[conversation_id]["matches"] += 1
+
+    return sorted(results.values(), key=lambda result: result["score"], reverse=True)[:limit]
+
+# Fonction pour indexer les transcriptions existantes (reprise de l'historique): journaux d'événements,
+# puis anciennes transcriptions texte des conversations sans journal
+def reindex_transcripts(directory=DATA_DIR, index_file=INDEX_FILE):
+    count = 0
+    journal_root = os.path.join(directory, "journal")
+    journal_ids = sorted(os.listdir(journal_root)) if os.path.isdir(journal_root) else []
+    for conversation_id in journal_ids:
+        content = "\n".join(f"{record['role']}: {record['content']}" for record in read_events(conversation_id, event="message"))
+        with closing(_connect(index_file)) as connection, connection:
+            _write_document(connection, conversation_id, "transcription", content)
+        count += 1
+
+    for path in sorted(os.listdir(directory)):
+        if not (path.startswith("tafahom_portail_") and path.endswith(".txt")):
+            continue
+        path = os.path.join(directory, path)
+        conversation_id = os.path.basename(path).replace("tafahom_portail_", "").replace(".txt", "")
+        if conversation_id in journal_ids:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read().partition("\n\n")[2]
+
+        with closing(_connect(index_file)) as connection, connection:
+            _write_document(connection, conversation_id, "transcription", content)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--reindex"]:
+        print(f"{reindex_transcripts()} transcriptions indexées dans {INDEX_FILE}")
+    elif len(sys.argv) > 1:
+        for result in search(" ".join(sys.argv[1:])):
+            print(f"{result['conversation_id']} ({result['kind']}): {result['snippet']}")
+    else:
+        print("Usage: python tafahom_recherche.py --reindex | <requête>")
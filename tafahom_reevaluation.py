@@ -0,0 +1,155 @@
+from tafahom_llm import chat_completion
+from tafahom_metriques import increment
+from tafahom_modeles import Criterion, Evaluation, ValidationError, extract_json, validated
+from tafahom_prompts import PromptPacker, compact_json, pack_responses, prune_evaluation, prune_profile, unpacked_responses
+
+# Réévaluation incrémentale après modification des réponses du financier: seuls les critères dont la réponse ou la
+# note a changé sont réévalués par le modèle, le score global est recalculé localement à partir des critères,
+# puis la décision, les recommandations et la synthèse sont actualisées par un court appel
+
+# Système prompt pour réévaluer les critères modifiés
+CRITERIA_SYSTEM_PROMPT = """Tu es TAFAHOM-AGENT. Tu réévalues certains critères d'une évaluation financière d'un porteur de projet culturel,
+après que l'agent financier humain a modifié son analyse ou sa note sur ces critères.
+
+Pour chaque critère transmis, donne une note /10 et un commentaire basé sur la nouvelle analyse de l'agent financier,
+en respectant fidèlement son avis.
+
+Format de sortie:
+```
+{
+  "criteria": [
+    {"name": "Nom du critère", "score": X, "comment": "Commentaire basé sur l'avis de l'agent financier"},
+    ...
+  ]
+}
+```
+"""
+
+# Système prompt pour actualiser la décision, les recommandations et la synthèse
+SYNTHESIS_SYSTEM_PROMPT = """Tu es TAFAHOM-AGENT. Tu actualises la décision, les recommandations et la synthèse d'une évaluation financière
+dont certains critères viennent d'être réévalués (le score global a déjà été recalculé).
+
+Format de sortie:
+```
+{
+  "decision": "Acceptation conditionnelle", // Ou "Acceptation" ou "Rejet"
+  "recommendations": ["Recommandation 1", "Recommandation 2", ...],
+  "summary": "Synthèse globale de l'évaluation"
+}
+```
+"""
+
+# Tokens de réponse par critère réévalué, et pour la synthèse
+CRITERION_MAX_TOKENS = 250
+SYNTHESIS_MAX_TOKENS = 600
+
+# Fonction pour trouver les critères dont la réponse ou la note du financier a changé depuis la dernière évaluation
+def changed_criteria(previous_responses, responses, count):
+    return [
+        i for i in range(count)
+        if any(previous_responses.get(f"{field}_{i}") != responses.get(f"{field}_{i}") for field in ("question", "score"))
+    ]
+
+# Fonction pour recalculer le score global localement: il suit l'évolution de la moyenne des critères
+# (un point de moyenne sur 10 vaut 10 points sur 100), sans revenir sur l'appréciation d'ensemble du modèle
+def local_global_score(previous_evaluation, criteria):
+    previous_scores = [criterion["score"] for criterion in previous_evaluation["criteria"]]
+    scores = [criterion["score"] for criterion in criteria]
+    delta = (sum(scores) / len(scores) - sum(previous_scores) / len(previous_scores)) * 10
+    return max(0, min(100, round(previous_evaluation["global_score"] + delta)))
+
+# Fonction pour réévaluer les critères modifiés (un seul appel, réponse limitée à ces critères)
+def reevaluate_criteria(client, profile_data, criteria, questions, responses, evaluation_data, changed, conversation_id, model):
+    packer = PromptPacker("reevaluate_criteria")
+    profile_context = packer.add(prune_profile(profile_data, fields=("criteria", "summary")), profile_data)
+    packed = pack_responses(criteria, questions, responses)
+    unpacked = unpacked_responses(criteria, questions, responses)
+    previous = evaluation_data["evaluation"]["criteria"]
+    changed_context = packer.add(
+        [{**packed[i], "previous": previous[i]} for i in changed],
+        {criteria[i]: {**unpacked[criteria[i]], "previous": previous[i]} for i in changed}
+    )
+
+    messages = [
+        {"role": "system", "content": CRITERIA_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Voici le profil d'un porteur de projet culturel:\n\n{profile_context}\n\nEt voici les critères dont l'agent financier a modifié l'analyse ou la note, avec leur évaluation précédente:\n\n{changed_context}\n\nRéévalue uniquement ces critères. Retourne uniquement le JSON structuré."}
+    ]
+    max_tokens = CRITERION_MAX_TOKENS * len(changed)
+    packer.check(messages, max_tokens=max_tokens)
+
+    # Critères réévalués reconnus par leur nom (à défaut, par leur ordre dans la réponse); lève une exception
+    # si la réponse est inexploitable (vérifiée aussi avant la mise en cache partagé)
+    def merge(response_text):
+        updated = {criterion.get("name"): criterion for criterion in extract_json(response_text)["criteria"]}
+        ordered = list(updated.values())
+        merged = [dict(criterion) for criterion in previous]
+        for position, i in enumerate(changed):
+            criterion = updated.get(criteria[i]) or (ordered[position] if position < len(ordered) else None)
+            if criterion is None:
+                raise ValueError(f"Critère non réévalué: {criteria[i]}")
+            merged[i] = Criterion.from_dict(
+                {"name": previous[i]["name"], "score": criterion.get("score"), "comment": criterion.get("comment")}, f"criteria[{i}]"
+            ).to_dict()
+        return merged
+
+    response_text = chat_completion(
+        client,
+        "reevaluate_criteria",
+        messages,
+        conversation_id=conversation_id,
+        validate=merge,
+        model=model,
+        temperature=0.5,
+        max_tokens=max_tokens,
+        top_p=0.9
+    )
+    return merge(response_text)
+
+# Fonction pour lire la synthèse actualisée (objet JSON attendu)
+def _synthesis(response_text):
+    synthesis = extract_json(response_text)
+    if not isinstance(synthesis, dict):
+        raise ValidationError("synthèse: objet JSON attendu")
+    return synthesis
+
+# Fonction pour actualiser la décision, les recommandations et la synthèse d'une évaluation mise à jour
+def refresh_synthesis(client, evaluation, changed_names, conversation_id, model):
+    packer = PromptPacker("refresh_synthesis")
+    evaluation_context = packer.add(prune_evaluation({"evaluation": evaluation}), {"evaluation": evaluation})
+
+    messages = [
+        {"role": "system", "content": SYNTHESIS_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Voici l'évaluation mise à jour:\n\n{evaluation_context}\n\nCritères réévalués: {compact_json(changed_names)}\n\nActualise la décision, les recommandations et la synthèse. Retourne uniquement le JSON structuré."}
+    ]
+    packer.check(messages, max_tokens=SYNTHESIS_MAX_TOKENS)
+
+    response_text = chat_completion(
+        client,
+        "refresh_synthesis",
+        messages,
+        conversation_id=conversation_id,
+        validate=_synthesis,
+        model=model,
+        temperature=0.5,
+        max_tokens=SYNTHESIS_MAX_TOKENS,
+        top_p=0.9
+    )
+    return _synthesis(response_text)
+
+# Fonction pour réévaluer une évaluation après modification de certains critères: critères modifiés par le modèle,
+# score global recalculé localement, décision, recommandations et synthèse actualisées (lève une exception en cas d'échec)
+def reevaluate(client, profile_data, criteria, questions, responses, evaluation_data, changed, conversation_id, model):
+    previous = evaluation_data["evaluation"]
+    updated_criteria = reevaluate_criteria(client, profile_data, criteria, questions, responses, evaluation_data, changed, conversation_id, model)
+    evaluation = {
+        "criteria": updated_criteria,
+        "global_score": local_global_score(previous, updated_criteria),
+        "decision": previous["decision"],
+        "recommendations": previous.get("recommendations", []),
+        "summary": previous.get("summary", "")
+    }
+    synthesis = refresh_synthesis(client, evaluation, [criteria[i] for i in changed], conversation_id, model)
+    evaluation.update({key: synthesis[key] for key in ("decision", "recommendations", "summary") if key in synthesis})
+    increment("tafahom_reevaluations_total")
+    increment("tafahom_reevaluated_criteria_total", len(changed))
+    return validated(Evaluation, {"evaluation": evaluation})
@@ -0,0 +1,179 @@
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+from tafahom_metriques import increment, percentile
+from tafahom_modeles import DECISIONS, Evaluation, validated
+from tafahom_stockage import append_text, data_path, read_json
+
+# Pré-examen par règles des dossiers: à partir des 10 scores du profil, de l'IAS et des notes du financier,
+# une décision et un score global provisoires sont calculés immédiatement; le modèle n'est sollicité que pour
+# les dossiers limites ou quand le financier demande l'évaluation rédigée
+
+# Fichier de configuration des règles (les valeurs absentes reprennent celles de DEFAULT_RULES)
+RULES_FILE = os.getenv("TAFAHOM_RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tafahom_regles.json"))
+
+# Journal des pré-examens (une ligne par dossier et par étape)
+SCREENING_LOG = data_path("tafahom_preexamen.jsonl")
+
+DEFAULT_RULES = {
+    # Pré-examen actif (sinon tous les dossiers passent par le modèle)
+    "enabled": True,
+    # Poids de l'IAS, de la moyenne des scores du profil et de la moyenne des notes du financier dans le score global
+    "weights": {"ias": 0.2, "profile": 0.2, "financier": 0.6},
+    # Score global minimal de chaque décision (en dessous du plus bas: rejet)
+    "thresholds": {"Acceptation": 70, "Acceptation conditionnelle": 50},
+    # Un score à moins de cette marge d'un seuil est un cas limite
+    "margin": 5,
+    # Écart maximal (points sur 10) entre les moyennes du profil et du financier avant de demander l'avis du modèle
+    "max_disagreement": 3,
+    # Une note inférieure ou égale à ce score sur un critère empêche de trancher une acceptation par les règles
+    "blocking_score": 2,
+    # Durée estimée (s) des appels évités, quand aucune mesure récente n'est disponible dans le processus
+    "estimated_seconds": {"contextualize_questions": 20, "generate_final_evaluation": 25}
+}
+
+# Fonction pour charger les règles (configuration fusionnée avec les valeurs par défaut)
+def load_rules(path=RULES_FILE):
+    rules = json.loads(json.dumps(DEFAULT_RULES))
+    for key, value in (read_json(path) or {}).items():
+        if isinstance(value, dict) and isinstance(rules.get(key), dict):
+            rules[key].update(value)
+        else:
+            rules[key] = value
+    return rules
+
+def _decision(score, thresholds):
+    for decision in DECISIONS:
+        if decision in thresholds and score >= thresholds[decision]:
+            return decision
+    return "Rejet"
+
+# Fonction pour pré-examiner un dossier: profil seul (étape de revue) ou avec les notes du financier (liste de 10
+# scores sur 10); renvoie la décision et le score provisoires, et les raisons d'un éventuel cas limite
+def screen(profile_data, financier_scores=None, criteria_names=None, rules=None):
+    rules = rules or load_rules()
+    profile = profile_data["profile"]
+    profile_scores = [float(criterion.get("score", 0)) for criterion in profile.get("criteria", [])]
+    profile_mean = sum(profile_scores) / len(profile_scores) if profile_scores else 0.0
+    components = {"ias": float(profile.get("ias_score", profile_mean * 10)), "profile": profile_mean * 10}
+    if financier_scores:
+        financier_mean = sum(financier_scores) / len(financier_scores)
+        components["financier"] = financier_mean * 10
+
+    # Poids renormalisés sur les composantes disponibles (sans les notes du financier à l'étape de revue)
+    weights = {key: rules["weights"].get(key, 0) for key in components}
+    total_weight = sum(weights.values()) or 1.0
+    global_score = round(sum(components[key] * weights[key] for key in components) / total_weight)
+    decision = _decision(global_score, rules["thresholds"])
+
+    reasons = []
+    for name, threshold in rules["thresholds"].items():
+        if abs(global_score - threshold) < rules["margin"]:
+            reasons.append(f"score global à moins de {rules['margin']} points du seuil « {name} » ({threshold})")
+    if financier_scores and abs(financier_mean - profile_mean) > rules["max_disagreement"]:
+        reasons.append(f"écart de {abs(financier_mean - profile_mean):.1f} points entre le profil et le financier")
+    if decision != "Rejet":
+        scores = financier_scores or profile_scores
+        names = criteria_names or [criterion.get("name", f"critère {i + 1}") for i, criterion in enumerate(profile.get("criteria", []))]
+        for name, score in zip(names, scores):
+            if score <= rules["blocking_score"]:
+                reasons.append(f"critère bloquant: {name} ({score:g}/10)")
+
+    return {
+        "stage": "summary" if financier_scores else "review",
+        "decision": decision,
+        "global_score": global_score,
+        "settled": bool(rules["enabled"]) and not reasons,
+        "reasons": reasons
+    }
+
+# Fonction pour établir l'évaluation provisoire d'un dossier tranché par les règles (format de l'évaluation du modèle):
+# notes et analyses du financier par critère, recommandations sur les critères sous la moyenne
+def rules_evaluation(screening, criteria_names, financier_scores, financier_comments):
+    weak = [(name, score) for name, score in zip(criteria_names, financier_scores) if score < 5]
+    evaluation = validated(Evaluation, {"evaluation": {
+        "criteria": [
+            {"name": name, "score": score, "comment": comment or "Pas d'analyse du financier."}
+            for name, score, comment in zip(criteria_names, financier_scores, financier_comments)
+        ],
+        "global_score": screening["global_score"],
+        "decision": screening["decision"],
+        "recommendations": [f"Renforcer le critère « {name} » (note {score}/10)." for name, score in weak]
+                           or ["Aucun critère sous la moyenne: suivi habituel du financement."],
+        "summary": f"Évaluation provisoire établie par les règles de pré-examen (score global {screening['global_score']}/100), "
+                   f"sans synthèse rédigée par le modèle."
+    }})
+    evaluation["screening"] = screening
+    return evaluation
+
+# Fonction pour estimer la durée d'un appel évité (médiane récente si mesurée, sinon estimation configurée)
+def estimated_seconds(call_site, rules=None):
+    rules = rules or load_rules()
+    measured = percentile("tafahom_llm_latency_seconds", 50, call_site=call_site)
+    return measured if measured is not None else float(rules["estimated_seconds"].get(call_site, 0))
+
+# Fonction pour enregistrer le résultat d'un pré-examen et les appels évités (ou, pour une évaluation rédigée
+# demandée ensuite, l'appel finalement fait: durée économisée négative)
+def record_screening(conversation_id, stage, screening, skipped=(), performed=(), log_file=SCREENING_LOG):
+    saved = sum(estimated_seconds(call_site) for call_site in skipped) - sum(estimated_seconds(call_site) for call_site in performed)
+    record = {
+        "time": time.time(),
+        "conversation_id": conversation_id,
+        "stage": stage,
+        "settled": screening["settled"] if screening else False,
+        "decision": screening["decision"] if screening else None,
+        "global_score": screening["global_score"] if screening else None,
+        "skipped": list(skipped),
+        "performed": list(performed),
+        "saved_seconds": round(saved, 1)
+    }
+    append_text(log_file, json.dumps(record, ensure_ascii=False) + "\n")
+    increment("tafahom_screening_total", stage=stage, outcome="tranche" if record["settled"] else "limite")
+    if saved:
+        increment("tafahom_screening_saved_seconds_total", saved)
+
+# Fonction pour résumer le pré-examen: part des dossiers évalués sans appel au modèle, durée économisée
+def screening_report(log_file=SCREENING_LOG):
+    if not os.path.exists(log_file):
+        return {"dossiers": 0, "settled": 0, "share": None, "saved_seconds": 0.0, "decisions": {}}
+    evaluated = {}
+    saved = 0.0
+    with open(log_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            saved += record["saved_seconds"]
+            # Dernier état de chaque dossier: tranché par les règles, sauf si l'évaluation rédigée a été demandée ensuite
+            if record["stage"] == "summary":
+                evaluated[record["conversation_id"]] = record["decision"] if record["settled"] else None
+            elif record["stage"] == "narrative":
+                evaluated[record["conversation_id"]] = None
+    settled = [decision for decision in evaluated.values() if decision]
+    decisions = defaultdict(int)
+    for decision in settled:
+        decisions[decision] += 1
+    return {
+        "dossiers": len(evaluated),
+        "settled": len(settled),
+        "share": len(settled) / len(evaluated) if evaluated else None,
+        "saved_seconds": saved,
+        "decisions": dict(decisions)
+    }
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--rules"]:
+        print(json.dumps(load_rules(), ensure_ascii=False, indent=2))
+    else:
+        report = screening_report()
+        if not report["dossiers"]:
+            print("Aucun dossier pré-examiné")
+            sys.exit(0)
+        print(f"{report['settled']}/{report['dossiers']} dossiers évalués sans appel au modèle ({report['share']:.0%}), "
+              f"{report['saved_seconds'] / 60:.1f} min de génération économisées")
+        for decision, count in sorted(report["decisions"].items()):
+            print(f"{count:>6}  {decision}")
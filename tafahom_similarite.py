@@ -0,0 +1,291 @@
+import os
+import re
+import threading
+import unicodedata
+import zlib
+
+import numpy as np
+
+from tafahom_stockage import DATA_DIR, evaluation_path, list_profile_ids, profile_path, read_json
+
+# Ordre des critères utilisé pour construire les vecteurs de scores
+CRITERIA = [
+    "Capital culturel incorporé",
+    "Capital objectivé",
+    "Capital institutionnalisé",
+    "Capital symbolique reconnu",
+    "Alignement narratif interprétatif",
+    "Ancrage territorial / communautaire",
+    "Capacité de projection identitaire",
+    "Soutien socio-culturel mobilisable",
+    "Usage social du projet artistique",
+    "Continuité d'engagement culturel"
+]
+
+# Milieu de l'échelle 1-10: les vecteurs sont centrés pour que le niveau des scores compte, pas seulement leur forme
+SCORE_CENTER = 5.5
+
+# Dimension des vecteurs TF-IDF hachés (commentaires et synthèse)
+TEXT_DIM = 256
+
+# Mots vides français ignorés lors de la vectorisation du texte
+FRENCH_STOPWORDS = {
+    "a", "au", "aux", "avec", "ce", "ces", "dans", "de", "des", "du", "elle", "en", "et", "eux", "il", "je",
+    "la", "le", "les", "leur", "lui", "ma", "mais", "me", "meme", "mes", "moi", "mon", "ne", "nos", "notre",
+    "nous", "on", "ou", "par", "pas", "pour", "qu", "que", "qui", "sa", "se", "ses", "son", "sur", "ta", "te",
+    "tes", "toi", "ton", "tu", "un", "une", "vos", "votre", "vous", "c", "d", "j", "l", "m", "n", "s", "t",
+    "y", "est", "sont", "ete", "etre", "cette", "cet", "son", "plus", "tres", "aussi", "comme"
+}
+
+# Fonction pour retirer les accents et mettre en minuscules
+def fold_accents(text):
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in normalized if not unicodedata.combining(c))
+
+# Fonction pour découper un texte français en mots normalisés
+def tokenize(text):
+    return [token for token in re.findall(r"[a-z0-9]+", fold_accents(text)) if token not in FRENCH_STOPWORDS]
+
+# Fonction pour extraire le vecteur des 10 scores d'un profil (dans l'ordre de CRITERIA)
+def score_vector(profile):
+    scores = {criterion.get("name"): criterion.get("score", 0) for criterion in profile.get("criteria", [])}
+    vector = []
+    for i, name in enumerate(CRITERIA):
+        if name in scores:
+            value = scores[name]
+        elif i < len(profile.get("criteria", [])):
+            value = profile["criteria"][i].get("score", 0)
+        else:
+            value = SCORE_CENTER
+        try:
+            vector.append(float(value))
+        except (TypeError, ValueError):
+            vector.append(SCORE_CENTER)
+    return vector
+
+# Fonction pour extraire le texte (commentaires + synthèse) d'un profil
+def profile_text(profile):
+    parts = [criterion.get("comment", "") for criterion in profile.get("criteria", [])]
+    parts.append(profile.get("summary", ""))
+    return " ".join(str(part) for part in parts)
+
+# Fonction pour compter les termes hachés d'un texte
+def hashed_counts(text, dim=TEXT_DIM):
+    counts = np.zeros(dim, dtype=np.float32)
+    for token in tokenize(text):
+        counts[zlib.crc32(token.encode("utf-8")) % dim] += 1
+    return counts
+
+# Fonction pour compter les n-grammes de mots hachés d'un texte (mots seuls et suites de n mots)
+def hashed_ngram_counts(text, dim=TEXT_DIM, n=2):
+    tokens = tokenize(text)
+    counts = np.zeros(dim, dtype=np.float32)
+    for size in range(1, n + 1):
+        for i in range(len(tokens) - size + 1):
+            counts[zlib.crc32(" ".join(tokens[i:i + size]).encode("utf-8")) % dim] += 1
+    return counts
+
+# Fonction pour normaliser les lignes d'une matrice (norme L2)
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+# Fonction pour charger un profil stocké avec sa décision éventuelle (None si le profil est illisible)
+def load_profile_record(conversation_id):
+    try:
+        profile = read_json(profile_path(conversation_id))["profile"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    record = {
+        "conversation_id": conversation_id,
+        "scores": score_vector(profile),
+        "ias_score": profile.get("ias_score"),
+        "text": profile_text(profile),
+        "decision": None,
+        "global_score": None
+    }
+
+    # L'évaluation financière, si elle existe, fournit la décision et le score global
+    try:
+        evaluation = read_json(evaluation_path(conversation_id))
+        if evaluation:
+            record["decision"] = evaluation["evaluation"].get("decision")
+            record["global_score"] = evaluation["evaluation"].get("global_score")
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return record
+
+# Fonction pour charger les profils stockés avec leur décision éventuelle
+def load_profile_records():
+    return [record for record in map(load_profile_record, list_profile_ids()) if record is not None]
+
+# Index de similarité entre profils: scores (cosinus centré) et, en option, texte (TF-IDF haché). Les profils
+# peuvent être ajoutés, remplacés ou retirés sans revectoriser les autres: seule la pondération IDF, qui dépend
+# de tout le corpus, est recalculée, à partir des comptes de termes conservés
+class ProfileSimilarityIndex:
+    def __init__(self, records, use_text=False, text_weight=0.3):
+        self.text_enabled = use_text
+        self.base_text_weight = text_weight
+        self.records = []
+        self.positions = {}
+        self.score_matrix = np.zeros((0, len(CRITERIA)), dtype=np.float32)
+        self.log_counts = np.zeros((0, TEXT_DIM), dtype=np.float32) if use_text else None
+        self.update(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    # Fonction pour ajouter ou remplacer des profils (par identifiant de conversation) et en retirer d'autres
+    def update(self, records=(), removed=()):
+        removed = sorted(self.positions[conversation_id] for conversation_id in set(removed) if conversation_id in self.positions)
+        if removed:
+            keep = np.ones(len(self.records), dtype=bool)
+            keep[removed] = False
+            self.records = [record for record, kept in zip(self.records, keep) if kept]
+            self.score_matrix = self.score_matrix[keep]
+            if self.text_enabled:
+                self.log_counts = self.log_counts[keep]
+            self.positions = {record["conversation_id"]: i for i, record in enumerate(self.records)}
+
+        added = []
+        for record in {record["conversation_id"]: record for record in records}.values():
+            scores = _normalize_rows(np.array([record["scores"]], dtype=np.float32) - SCORE_CENTER)[0]
+            log_counts = np.log1p(hashed_counts(record["text"])) if self.text_enabled else None
+            position = self.positions.get(record["conversation_id"])
+            if position is None:
+                added.append((record, scores, log_counts))
+                continue
+            self.records[position] = record
+            self.score_matrix[position] = scores
+            if self.text_enabled:
+                self.log_counts[position] = log_counts
+        if added:
+            for record, _, _ in added:
+                self.positions[record["conversation_id"]] = len(self.records)
+                self.records.append(record)
+            self.score_matrix = np.concatenate([self.score_matrix, np.stack([scores for _, scores, _ in added])])
+            if self.text_enabled:
+                self.log_counts = np.concatenate([self.log_counts, np.stack([counts for _, _, counts in added])])
+
+        # Pondération IDF et normes des lignes pondérées (la matrice TF-IDF normalisée n'est pas matérialisée)
+        self.use_text = self.text_enabled and bool(self.records)
+        self.text_weight = self.base_text_weight if self.use_text else 0.0
+        self.idf = None
+        self.text_norms = None
+        if self.use_text:
+            document_frequency = np.count_nonzero(self.log_counts, axis=0)
+            self.idf = np.log((1 + len(self.records)) / (1 + document_frequency)).astype(np.float32) + 1.0
+            self.text_norms = np.sqrt(np.square(self.log_counts) @ np.square(self.idf))
+            self.text_norms[self.text_norms == 0] = 1.0
+
+    # Fonction pour calculer la similarité d'un profil avec tous les profils indexés (un seul produit matriciel)
+    def similarities(self, profile):
+        query = np.array(score_vector(profile), dtype=np.float32) - SCORE_CENTER
+        norm = np.linalg.norm(query)
+        similarity = self.score_matrix @ (query / norm if norm else query)
+
+        if self.use_text:
+            text_query = np.log1p(hashed_counts(profile_text(profile))) * self.idf
+            text_norm = np.linalg.norm(text_query)
+            if text_norm:
+                text_similarity = (self.log_counts @ (self.idf * text_query / text_norm)) / self.text_norms
+                similarity = (1 - self.text_weight) * similarity + self.text_weight * text_similarity
+        return similarity
+
+    # Fonction pour retrouver les k profils les plus proches
+    def query(self, profile, k=5, exclude_id=None):
+        if not self.records:
+            return []
+
+        similarity = self.similarities(profile)
+        if exclude_id in self.positions:
+            similarity[self.positions[exclude_id]] = -np.inf
+
+        k = min(k, len(self.records))
+        candidates = np.argpartition(-similarity, k - 1)[:k]
+        candidates = candidates[np.argsort(-similarity[candidates])]
+
+        results = []
+        for i in candidates:
+            if not np.isfinite(similarity[i]):
+                continue
+            record = self.records[i]
+            results.append({
+                "conversation_id": record["conversation_id"],
+                "similarity": float(similarity[i]),
+                "ias_score": record["ias_score"],
+                "decision": record["decision"],
+                "global_score": record["global_score"]
+            })
+        return results
+
+# Index partagé du processus, tenu à jour d'après les fichiers du stockage: tant que le répertoire de données n'a
+# pas changé, rien n'est relu; sinon seuls les profils et évaluations nouveaux ou modifiés (taille, date) sont
+# relus et mis à jour dans l'index, et les profils supprimés en sont retirés
+_index = None
+_signatures = {}
+_directory_signature = None
+_index_lock = threading.Lock()
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def _refresh_index():
+    global _index, _directory_signature
+    if _index is None:
+        _index = ProfileSimilarityIndex([], use_text=True)
+    directory_signature = _file_signature(DATA_DIR)
+    if directory_signature == _directory_signature:
+        return _index
+    _directory_signature = directory_signature
+
+    signatures = {
+        conversation_id: (_file_signature(profile_path(conversation_id)), _file_signature(evaluation_path(conversation_id)))
+        for conversation_id in list_profile_ids()
+    }
+    changed = [conversation_id for conversation_id, signature in signatures.items() if _signatures.get(conversation_id) != signature]
+    removed = [conversation_id for conversation_id in _signatures if conversation_id not in signatures]
+    records = [record for record in map(load_profile_record, changed) if record is not None]
+    unreadable = set(changed) - {record["conversation_id"] for record in records}
+    if records or removed or unreadable:
+        _index.update(records, removed=removed + sorted(unreadable))
+    _signatures.clear()
+    _signatures.update(signatures)
+    return _index
+
+# Fonction pour retrouver les k profils stockés les plus proches d'un profil (index partagé, tenu à jour)
+def similar_profiles(profile, k=5, exclude_id=None):
+    with _index_lock:
+        return _refresh_index().query(profile, k=k, exclude_id=exclude_id)
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    # Mesure du temps de requête sur 100 000 profils synthétiques
+    random.seed(0)
+    records = [
+        {
+            "conversation_id": str(i),
+            "scores": [random.randint(1, 10) for _ in CRITERIA],
+            "ias_score": None,
+            "text": " ".join(random.choice(["musique", "danse", "artisanat", "transmission", "quartier", "troupe"]) for _ in range(30)),
+            "decision": None,
+            "global_score": None
+        }
+        for i in range(100_000)
+    ]
+    query_profile = {"criteria": [{"name": name, "score": 6, "comment": "musique de quartier"} for name in CRITERIA], "summary": "troupe"}
+
+    for use_text in (False, True):
+        index = ProfileSimilarityIndex(records, use_text=use_text)
+        start = time.perf_counter()
+        for _ in range(20):
+            index.query(query_profile, k=5, exclude_id="0")
+        print(f"texte={use_text}: {(time.perf_counter() - start) / 20 * 1000:.1f} ms par requête sur {len(index)} profils")
@@ -0,0 +1,221 @@
+import glob
+import json
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Répertoire de données partagé entre les répliques (montage commun), le répertoire courant par défaut
+DATA_DIR = os.getenv("TAFAHOM_DATA_DIR", ".")
+
+# Fonction pour construire un chemin dans le répertoire de données (créé au besoin)
+def data_path(*parts):
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+# Fonction pour générer un identifiant de conversation unique (horodatage lisible + suffixe aléatoire de 48 bits)
+def new_conversation_id():
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(6)}"
+
+# Chemins des fichiers d'une conversation
+def transcript_path(conversation_id):
+    return data_path(f"tafahom_portail_{conversation_id}.txt")
+
+def profile_path(conversation_id):
+    return data_path(f"tafahom_profil_{conversation_id}.json")
+
+def questions_path(conversation_id):
+    return data_path(f"tafahom_questions_{conversation_id}.json")
+
+def evaluation_path(conversation_id):
+    return data_path(f"tafahom_evaluation_{conversation_id}.json")
+
+def enriched_profile_path(conversation_id):
+    return data_path(f"tafahom_profil_enrichi_{conversation_id}.json")
+
+# Fonction pour lister les identifiants des profils exportés (profils enrichis exclus)
+def list_profile_ids():
+    ids = []
+    for path in glob.glob(os.path.join(DATA_DIR, "tafahom_profil_*.json")):
+        conversation_id = os.path.basename(path)[len("tafahom_profil_"):-len(".json")]
+        if not conversation_id.startswith("enrichi_"):
+            ids.append(conversation_id)
+    return sorted(ids)
+
+# Verrou exclusif inter-processus (et inter-répliques sur un montage partagé) sur un fichier ouvert
+@contextmanager
+def _locked(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+    try:
+        yield f
+    finally:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Verrou associé à un chemin (fichier .lock à côté de la ressource protégée)
+@contextmanager
+def file_lock(path):
+    with open(f"{path}.lock", "a+b") as lock_file, _locked(lock_file):
+        yield
+
+# Mode de journal des bases SQLite du répertoire de données: DELETE par défaut, sûr sur le montage réseau partagé
+# par les répliques; WAL suppose que toutes les répliques tournent sur le même hôte (l'index -shm du journal est
+# une mémoire partagée locale, non cohérente entre hôtes) et ne doit être activé que dans ce cas
+SQLITE_JOURNAL_MODE = os.getenv("TAFAHOM_SQLITE_JOURNAL_MODE", "DELETE").upper()
+
+# Connexion à une base partagée: "with connection:" est une transaction d'écriture, sérialisée entre processus et
+# répliques par le verrou de fichier de la base (les verrous POSIX de SQLite ne sont pas fiables sur tous les montages)
+class SharedConnection(sqlite3.Connection):
+    def __enter__(self):
+        self._write_lock = file_lock(self.database_path)
+        self._write_lock.__enter__()
+        try:
+            return super().__enter__()
+        except BaseException:
+            self._write_lock.__exit__(None, None, None)
+            raise
+
+    def __exit__(self, *exc_info):
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            self._write_lock.__exit__(None, None, None)
+
+# Fonction pour ouvrir une base SQLite du répertoire de données et créer son schéma (instructions DDL) au besoin
+def connect_database(path, schema=(), **kwargs):
+    connection = sqlite3.connect(path, timeout=10, factory=SharedConnection, **kwargs)
+    connection.database_path = path
+    connection.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    with connection:
+        for statement in schema:
+            connection.execute(statement)
+    return connection
+
+# Fonction pour écrire un fichier de manière atomique (fichier temporaire puis renommage)
+def atomic_write_text(path, text):
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def atomic_write_json(path, data):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=2))
+
+# Fonction pour lire un fichier JSON (None s'il n'existe pas)
+def read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# Fonction pour ajouter du texte à un fichier sous verrou (plusieurs écrivains possibles)
+def append_text(path, text):
+    if fcntl:
+        with open(path, "a", encoding="utf-8") as f, _locked(f):
+            f.write(text)
+    else:
+        with file_lock(path), open(path, "a", encoding="utf-8") as f:
+            f.write(text)
+
+def append_bytes(path, data):
+    if fcntl:
+        with open(path, "ab") as f, _locked(f):
+            f.write(data)
+    else:
+        with file_lock(path), open(path, "ab") as f:
+            f.write(data)
+
+# Fonction pour créer un fichier seulement s'il n'existe pas encore
+def create_text(path, text):
+    with open(path, "x", encoding="utf-8") as f:
+        f.write(text)
+
+
+# Test de charge: écrivains concurrents sur les mêmes fichiers, lecteurs qui ne doivent jamais voir d'état partiel
+def _stress_writer(worker, iterations, queue):
+    ids = [new_conversation_id() for _ in range(iterations)]
+    payload = {"profile": {"criteria": [{"name": str(i), "score": worker, "comment": "x" * 2000} for i in range(10)]}}
+    for i in range(iterations):
+        atomic_write_json(profile_path("stress"), payload)
+        append_text(transcript_path("stress"), f"{worker}:{i}:" + "y" * 500 + "\n")
+    queue.put(ids)
+
+def _stress_reader(iterations, queue):
+    errors = 0
+    for _ in range(iterations):
+        try:
+            data = read_json(profile_path("stress"))
+            if data and len({criterion["score"] for criterion in data["profile"]["criteria"]}) != 1:
+                errors += 1
+        except ValueError:
+            errors += 1
+    queue.put(errors)
+
+# Le test tourne dans un processus à part, sur un répertoire de données temporaire: ses fichiers "stress" ne doivent
+# pas apparaître dans le vrai répertoire (le suivi de la boîte de réception les annoncerait comme un profil)
+def stress_test(writers=8, readers=4, iterations=200):
+    import subprocess
+
+    with tempfile.TemporaryDirectory(prefix="tafahom_stress_") as data_dir:
+        env = dict(os.environ, TAFAHOM_DATA_DIR=data_dir, TAFAHOM_STORAGE_STRESS="1")
+        command = [sys.executable, os.path.abspath(__file__), "--stress", str(writers), str(readers), str(iterations)]
+        return subprocess.run(command, env=env).returncode == 0
+
+def _run_stress_test(writers=8, readers=4, iterations=200):
+    import multiprocessing
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_stress_writer, args=(w, iterations, queue)) for w in range(writers)]
+    processes += [multiprocessing.Process(target=_stress_reader, args=(iterations * 5, queue)) for _ in range(readers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    ids = [conversation_id for result in results if isinstance(result, list) for conversation_id in result]
+    read_errors = sum(result for result in results if isinstance(result, int))
+    with open(transcript_path("stress"), "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    corrupted_lines = [line for line in lines if len(line.split(":")[-1]) != 500]
+
+    print(f"{writers} écrivains, {readers} lecteurs, {iterations} itérations en {time.perf_counter() - start:.1f} s")
+    print(f"Identifiants: {len(ids)} générés, {len(ids) - len(set(ids))} collisions")
+    print(f"Lectures de profil partielles ou mélangées: {read_errors}")
+    print(f"Lignes de transcription: {len(lines)}/{writers * iterations}, corrompues: {len(corrupted_lines)}")
+    return len(ids) == len(set(ids)) and read_errors == 0 and not corrupted_lines and len(lines) == writers * iterations
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--stress"]:
+        counts = [int(arg) for arg in sys.argv[2:5]]
+        run = _run_stress_test if os.getenv("TAFAHOM_STORAGE_STRESS") else stress_test
+        sys.exit(0 if run(*counts) else 1)
+    print("Usage: python tafahom_stockage.py --stress [écrivains lecteurs itérations]")
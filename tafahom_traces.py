@@ -0,0 +1,251 @@
+import contextvars
+import glob
+import hashlib
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from tafahom_stockage import DATA_DIR, append_text, data_path
+
+# Traces légères d'un dossier à travers le portail et TAFAHOM-Agent: un span par étape (exécution du script,
+# appel LLM, lecture du JSON, accès fichier), au format des spans OTLP/JSON d'OpenTelemetry, écrits dans
+# <données>/traces/<conversation_id>.jsonl; l'identifiant de trace est dérivé de l'identifiant de conversation,
+# les spans des deux applications d'un même dossier appartiennent donc à la même trace
+
+# Traçage: "on" ou "off"
+TRACING = os.getenv("TAFAHOM_TRACING", "on")
+
+# Span courant du contexte d'exécution (thread du script, threads lancés avec le contexte copié)
+_current = contextvars.ContextVar("tafahom_span", default=None)
+
+# Fonction pour dériver l'identifiant de trace OpenTelemetry (16 octets) d'une conversation
+def trace_id(conversation_id):
+    return hashlib.sha256(str(conversation_id).encode("utf-8")).hexdigest()[:32]
+
+# Fonction pour obtenir le fichier de traces d'une conversation (sans le créer)
+def traces_path(conversation_id):
+    return os.path.join(DATA_DIR, "traces", f"{conversation_id}.jsonl")
+
+class Span:
+    __slots__ = ("name", "conversation_id", "service", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "token")
+
+    def set(self, **attributes):
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+# Fonction pour ouvrir un span (enfant du span courant; conversation et service hérités du parent)
+def start_span(name, conversation_id=None, service=None, **attributes):
+    parent = _current.get()
+    span = Span()
+    span.name = name
+    span.conversation_id = conversation_id or (parent.conversation_id if parent else None)
+    span.service = service or (parent.service if parent else "tafahom")
+    span.span_id = secrets.token_hex(8)
+    span.parent_id = parent.span_id if parent and parent.conversation_id == span.conversation_id else None
+    span.start_ns = time.time_ns()
+    span.end_ns = None
+    span.attributes = {}
+    span.error = None
+    span.set(**attributes)
+    span.token = _current.set(span)
+    return span
+
+# Fonction pour fermer un span et l'exporter (un span sans conversation n'est pas conservé)
+def end_span(span, error=None):
+    span.end_ns = time.time_ns()
+    if _current.get() is span:
+        _current.reset(span.token)
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    if TRACING == "on" and span.conversation_id:
+        append_text(data_path("traces", f"{span.conversation_id}.jsonl"), json.dumps(_to_otlp_span(span), ensure_ascii=False) + "\n")
+
+@contextmanager
+def span(name, conversation_id=None, **attributes):
+    current = start_span(name, conversation_id, **attributes)
+    try:
+        yield current
+    except Exception as e:
+        end_span(current, error=e)
+        raise
+    except BaseException:
+        end_span(current)  # arrêt ou relance du script Streamlit: pas une erreur
+        raise
+    end_span(current)
+
+# Fonction pour lancer un thread dans le contexte courant (ses spans restent rattachés au span parent)
+def start_thread(target, args=()):
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target, *args), daemon=True)
+    thread.start()
+    return thread
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _to_otlp_span(span):
+    attributes = {"tafahom.conversation_id": span.conversation_id, **span.attributes}
+    return {
+        "service": span.service,
+        "traceId": trace_id(span.conversation_id),
+        "spanId": span.span_id,
+        "parentSpanId": span.parent_id or "",
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+    }
+
+
+# Span racine de l'exécution en cours du script, par session Streamlit
+_runs = {}
+_runs_lock = threading.Lock()
+
+# Fonction pour ouvrir le span racine d'une exécution du script; celui de l'exécution précédente, s'il n'a pas
+# été fermé (st.rerun, interruption par l'utilisateur), est fermé à cet instant
+def begin_run(session_key, service, conversation_id, **attributes):
+    with _runs_lock:
+        previous = _runs.pop(session_key, None)
+    if previous is not None:
+        previous.set(**{"tafahom.interrupted": True})
+        end_span(previous)
+    _current.set(None)
+    run = start_span(f"{service} run", conversation_id, service=service, **attributes)
+    with _runs_lock:
+        _runs[session_key] = run
+    return run
+
+def end_run(session_key):
+    with _runs_lock:
+        run = _runs.pop(session_key, None)
+    if run is not None:
+        end_span(run)
+
+
+# Fonction pour lire les spans d'un dossier (format interne: temps en secondes, attributs à plat)
+def read_spans(conversation_id):
+    path = traces_path(conversation_id)
+    if not os.path.exists(path):
+        return []
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                record["start"] = int(record["startTimeUnixNano"]) / 1e9
+                record["end"] = int(record["endTimeUnixNano"]) / 1e9
+                spans.append(record)
+    return spans
+
+# Fonction pour regrouper les spans d'un dossier en document OTLP/JSON (import dans un collecteur ou Jaeger)
+def to_otlp(conversation_id):
+    by_service = defaultdict(list)
+    for record in read_spans(conversation_id):
+        by_service[record["service"]].append({key: value for key, value in record.items() if key not in ("service", "start", "end")})
+    return {"resourceSpans": [
+        {
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+            "scopeSpans": [{"scope": {"name": "tafahom"}, "spans": spans}]
+        }
+        for service, spans in by_service.items()
+    ]}
+
+# Fonction pour suivre le chemin critique sous un span: en partant de la fin, l'enfant qui se termine le plus tard,
+# puis, avant son début, le suivant, etc.; renvoie (profondeur, span, temps propre sur le chemin) dans l'ordre
+def _critical(span, children, depth):
+    chain, cursor = [], span["end"]
+    candidates = children.get(span["spanId"], [])
+    while True:
+        candidates = [child for child in candidates if child["end"] <= cursor + 1e-6]
+        if not candidates:
+            break
+        last = max(candidates, key=lambda child: child["end"])
+        chain.append(last)
+        cursor = last["start"]
+        candidates = [child for child in candidates if child is not last]
+    chain.reverse()
+
+    self_time = (span["end"] - span["start"]) - sum(child["end"] - child["start"] for child in chain)
+    entries = [(depth, span, max(0.0, self_time))]
+    for child in chain:
+        entries.extend(_critical(child, children, depth + 1))
+    return entries
+
+# Fonction pour calculer le chemin critique d'un dossier: les exécutions successives des deux applications
+# (et les traitements d'arrière-plan) qui déterminent la durée totale, les attentes entre elles étant du temps
+# humain (réponses de l'artiste, prise en charge par un financier)
+def critical_path(conversation_id):
+    spans = read_spans(conversation_id)
+    if not spans:
+        return []
+    ids = {record["spanId"] for record in spans}
+    children = defaultdict(list)
+    roots = []
+    for record in spans:
+        if record["parentSpanId"] in ids:
+            children[record["parentSpanId"]].append(record)
+        else:
+            roots.append(record)
+
+    dossier = {"spanId": "", "name": "dossier", "service": "", "start": min(r["start"] for r in roots), "end": max(r["end"] for r in roots)}
+    children[""] = roots
+    path = []
+    for depth, record, self_time in _critical(dossier, children, -1)[1:]:
+        path.append({
+            "depth": depth,
+            "name": record["name"],
+            "service": record["service"],
+            "start": record["start"],
+            "duration": record["end"] - record["start"],
+            "self": self_time,
+            "error": record["status"].get("message")
+        })
+    return path
+
+# Fonction pour résumer le chemin critique par étape (temps propre cumulé), hors attente humaine
+def critical_summary(conversation_id):
+    totals = defaultdict(float)
+    for entry in critical_path(conversation_id):
+        totals[entry["name"]] += entry["self"]
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--otlp":
+        print(json.dumps(to_otlp(sys.argv[2]), ensure_ascii=False, indent=2))
+    elif len(sys.argv) == 2 and sys.argv[1] != "--list":
+        path = critical_path(sys.argv[1])
+        if not path:
+            print(f"Aucune trace pour {sys.argv[1]}")
+            sys.exit(1)
+        start = path[0]["start"]
+        busy = sum(entry["self"] for entry in path)
+        print(f"Chemin critique du dossier {sys.argv[1]} (trace {trace_id(sys.argv[1])})")
+        print(f"{'début (s)':>10} {'durée (s)':>10} {'propre (s)':>11}  étape")
+        previous_end = None
+        for entry in path:
+            if entry["depth"] == 0 and previous_end is not None and entry["start"] - previous_end > 0.001:
+                print(f"{'':>10} {entry['start'] - previous_end:>10.3f} {'':>11}  · attente")
+            print(f"{entry['start'] - start:>10.3f} {entry['duration']:>10.3f} {entry['self']:>11.3f}  {'  ' * entry['depth']}{entry['name']}"
+                  f"{' [' + entry['service'] + ']' if entry['depth'] == 0 else ''}{' ⚠ ' + entry['error'] if entry['error'] else ''}")
+            if entry["depth"] == 0:
+                previous_end = entry["start"] + entry["duration"]
+        print(f"\nTemps de traitement sur le chemin critique: {busy:.3f} s")
+        for name, total in critical_summary(sys.argv[1])[:10]:
+            print(f"{total:>10.3f} s  {total / busy if busy else 0:>5.0%}  {name}")
+    elif sys.argv[1:] == ["--list"]:
+        for path in sorted(glob.glob(os.path.join(DATA_DIR, "traces", "*.jsonl"))):
+            print(os.path.basename(path)[:-len(".jsonl")])
+    else:
+        print("Usage: python tafahom_traces.py <conversation_id> | --otlp <conversation_id> | --list")